@@ -6,6 +6,8 @@
 // author: Michael Cohen <scudette@gmail.com>
 
 
+// All "s#" length arguments in this file are Py_ssize_t.
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
 // Number of bits used to hold type info in a proto tag.
@@ -98,7 +100,7 @@ int varint_decode(unsigned PY_LONG_LONG *result,
     }
 
     shift += 7;
-  } while (shift < 64);
+  }
 
   // Error decoding varint - buffer too short.
   return 0;
@@ -161,7 +163,11 @@ PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
     int tag_type;
 
     // Read the tag off the buffer.
-    varint_decode(&tag, buffer, length, &decoded_length);
+    if (!varint_decode(&tag, buffer, length, &decoded_length)) {
+      PyErr_SetString(PyExc_ValueError, "Invalid tag");
+      Py_DECREF(result);
+      return NULL;
+    }
 
     // Prepare to pass the encoded tag into the result tuple.
     encoded_tag = PyString_FromStringAndSize(buffer, decoded_length);
@@ -176,7 +182,10 @@ PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
         Py_ssize_t tag_length = 0;
         PyObject *entry = NULL;
 
-        varint_decode(&tag, buffer, length, &tag_length);
+        if (!varint_decode(&tag, buffer, length, &tag_length)) {
+          PyErr_SetString(PyExc_ValueError, "Truncated varint.");
+          goto error;
+        }
 
         // Create an entry to add to the result set. Note: We use
         // PyTuple_SetItem which steals the references here instead of
@@ -206,8 +215,15 @@ PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
       case WIRETYPE_FIXED64: {
         // Fixed size data.
         Py_ssize_t tag_length = 8;
+        PyObject *entry = NULL;
 
-        PyObject *entry = PyTuple_New(3);
+        if (tag_length > length) {
+          PyErr_SetString(
+              PyExc_ValueError, "Fixed size field exceeds available buffer.");
+          goto error;
+        }
+
+        entry = PyTuple_New(3);
         PyTuple_SET_ITEM(
             entry, 0, encoded_tag);
 
@@ -232,8 +248,15 @@ PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
       case WIRETYPE_FIXED32: {
         // Fixed size data.
         Py_ssize_t tag_length = 4;
+        PyObject *entry = NULL;
+
+        if (tag_length > length) {
+          PyErr_SetString(
+              PyExc_ValueError, "Fixed size field exceeds available buffer.");
+          goto error;
+        }
 
-        PyObject *entry = PyTuple_New(3);
+        entry = PyTuple_New(3);
         PyTuple_SET_ITEM(
             entry, 0, encoded_tag);
 
@@ -262,10 +285,9 @@ PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
         unsigned PY_LONG_LONG data_size;
         PyObject *entry = NULL;
 
-        varint_decode(&data_size, buffer, length, &decoded_length);
-
         // Check that we do not exceed the available buffer here.
-        if (data_size + decoded_length > (unsigned int)length) {
+        if (!varint_decode(&data_size, buffer, length, &decoded_length) ||
+            data_size + decoded_length > (unsigned PY_LONG_LONG)length) {
           PyErr_SetString(
               PyExc_ValueError, "Length tag exceeds available buffer.");
 
@@ -306,9 +328,491 @@ PyObject *py_split_buffer(PyObject *self, PyObject *args, PyObject *kwargs) {
 
 error:
   Py_DECREF(encoded_tag);
+  Py_DECREF(result);
+  return NULL;
+}
+
+// Decode a single field from the buffer. On success returns 1 and sets
+// tag_length to the size of the encoded tag, data_offset to the start of the
+// field data (relative to buffer) and data_length to its size. Returns 0 and
+// sets a python exception on failure.
+static int decode_field(const char *buffer, Py_ssize_t length,
+                        Py_ssize_t *tag_length, Py_ssize_t *data_offset,
+                        Py_ssize_t *data_length) {
+  unsigned PY_LONG_LONG tag;
+  unsigned PY_LONG_LONG value;
+  Py_ssize_t value_length = 0;
+
+  if (!varint_decode(&tag, buffer, length, tag_length)) {
+    PyErr_SetString(PyExc_ValueError, "Invalid tag");
+    return 0;
+  }
+
+  buffer += *tag_length;
+  length -= *tag_length;
+
+  switch (tag & TAG_TYPE_MASK) {
+    case WIRETYPE_VARINT:
+      if (!varint_decode(&value, buffer, length, &value_length)) {
+        PyErr_SetString(PyExc_ValueError, "Truncated varint.");
+        return 0;
+      }
+      *data_offset = *tag_length;
+      *data_length = value_length;
+      break;
+
+    case WIRETYPE_FIXED64:
+      *data_offset = *tag_length;
+      *data_length = 8;
+      break;
+
+    case WIRETYPE_FIXED32:
+      *data_offset = *tag_length;
+      *data_length = 4;
+      break;
+
+    case WIRETYPE_LENGTH_DELIMITED:
+      if (!varint_decode(&value, buffer, length, &value_length) ||
+          value > (unsigned PY_LONG_LONG)(length - value_length)) {
+        PyErr_SetString(
+            PyExc_ValueError, "Length tag exceeds available buffer.");
+        return 0;
+      }
+      *data_offset = *tag_length + value_length;
+      *data_length = (Py_ssize_t)value;
+      break;
+
+    default:
+      PyErr_SetString(PyExc_ValueError, "Unexpected Tag");
+      return 0;
+  }
+
+  if (*data_length > length - (*data_offset - *tag_length)) {
+    PyErr_SetString(PyExc_ValueError, "Field exceeds available buffer.");
+    return 0;
+  }
+
+  return 1;
+}
+
+
+// Decodes all the fields in a buffer directly into the raw data dict of an
+// RDFStruct. This is the C equivalent of structs.ReadIntoObject().
+//
+// tag_table maps the encoded tag of each known field to a tuple of
+// (field_name, type_descriptor, is_repeated). It is precomputed per class by
+// the RDFStructMetaclass. Unknown fields are stored under integer keys so they
+// are written back when re-serializing.
+//
+// Repeated fields can not be stored directly in raw_data since they need a
+// RepeatedFieldHelper, so we return a dict mapping the field name to a list of
+// (None, wire_format) tuples and let the caller attach them.
+PyObject *py_decode_struct(PyObject *self, PyObject *args, PyObject *kwargs) {
+  char *buffer;
+  Py_ssize_t buffer_len = 0;
+  Py_ssize_t length = 0;
+  Py_ssize_t index = 0;
+  Py_ssize_t unknown_count = 0;
+  PyObject *tag_table = NULL;
+  PyObject *raw_data = NULL;
+  PyObject *repeated = NULL;
+  static const char *kwlist[] = {
+    "buffer", "tag_table", "raw_data", "index", "length", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s#O!O!|nn", (char **)kwlist,
+                                   &buffer, &buffer_len,
+                                   &PyDict_Type, &tag_table,
+                                   &PyDict_Type, &raw_data,
+                                   &index, &length))
+    return NULL;
+
+  if (index < 0 || length < 0 || index > buffer_len) {
+    PyErr_SetString(
+        PyExc_ValueError, "Invalid parameters.");
+    return NULL;
+  }
+
+  buffer += index;
+  if (length == 0 || length > buffer_len - index) {
+    length = buffer_len - index;
+  }
+
+  repeated = PyDict_New();
+  if (!repeated)
+    return NULL;
+
+  while (length > 0) {
+    Py_ssize_t tag_length = 0;
+    Py_ssize_t data_offset = 0;
+    Py_ssize_t data_length = 0;
+    PyObject *wire_format = NULL;
+    PyObject *field_info = NULL;
+    PyObject *entry = NULL;
+    PyObject *key = NULL;
+    int result = 0;
+
+    if (!decode_field(buffer, length, &tag_length, &data_offset,
+                      &data_length))
+      goto error;
+
+    wire_format = Py_BuildValue(
+        "(s#s#s#)",
+        buffer, tag_length,
+        buffer + tag_length, data_offset - tag_length,
+        buffer + data_offset, data_length);
+    if (!wire_format)
+      goto error;
+
+    // Borrowed reference.
+    field_info = PyDict_GetItem(
+        tag_table, PyTuple_GET_ITEM(wire_format, 0));
+
+    if (field_info == NULL) {
+      // Unknown field: keep the wire format so we can write it back.
+      key = PyInt_FromSsize_t(unknown_count++);
+      entry = PyTuple_Pack(3, Py_None, wire_format, Py_None);
+      result = key && entry && PyDict_SetItem(raw_data, key, entry) == 0;
+
+    } else if (PyObject_IsTrue(PyTuple_GET_ITEM(field_info, 2))) {
+      // Repeated field: collect the wire formats for the caller.
+      PyObject *items = NULL;
+
+      key = PyTuple_GET_ITEM(field_info, 0);
+      Py_INCREF(key);
+
+      items = PyDict_GetItem(repeated, key);
+      if (items == NULL) {
+        items = PyList_New(0);
+        if (items && PyDict_SetItem(repeated, key, items) == 0)
+          Py_DECREF(items);
+        else
+          Py_CLEAR(items);
+      }
+
+      entry = PyTuple_Pack(2, Py_None, wire_format);
+      result = items && entry && PyList_Append(items, entry) == 0;
+
+    } else {
+      // The python format is set to None so it gets decoded lazily.
+      key = PyTuple_GET_ITEM(field_info, 0);
+      Py_INCREF(key);
+
+      entry = PyTuple_Pack(3, Py_None, wire_format,
+                           PyTuple_GET_ITEM(field_info, 1));
+      result = entry && PyDict_SetItem(raw_data, key, entry) == 0;
+    }
+
+    Py_XDECREF(key);
+    Py_XDECREF(entry);
+    Py_DECREF(wire_format);
+
+    if (!result)
+      goto error;
+
+    buffer += data_offset + data_length;
+    length -= data_offset + data_length;
+  }
+
+  return repeated;
+
+error:
+  Py_DECREF(repeated);
   return NULL;
 }
 
+
+// Encodings assigned to type descriptors by a serialization plan. These must
+// match the ENCODING_* constants in structs.py.
+#define ENCODING_GENERIC 0
+#define ENCODING_BINARY 1
+#define ENCODING_STRING 2
+#define ENCODING_VARINT 3
+
+
+// Appends the wire format of a primitive value to the output list without
+// calling back into its type descriptor. Returns 1 if the value was encoded,
+// 0 if it must be converted by the descriptor instead and -1 on error.
+static int encode_primitive(PyObject *output, long encoding,
+                            PyObject *encoded_tag, PyObject *value) {
+  unsigned char buffer[20];
+  Py_ssize_t buffer_length = sizeof(buffer);
+  PyObject *data = NULL;
+  PyObject *encoded_length = NULL;
+  unsigned PY_LONG_LONG number;
+  int result = -1;
+
+  switch (encoding) {
+    case ENCODING_BINARY:
+      if (!PyString_CheckExact(value))
+        return 0;
+
+      Py_INCREF(value);
+      data = value;
+      break;
+
+    case ENCODING_STRING:
+      if (!PyUnicode_CheckExact(value))
+        return 0;
+
+      data = PyUnicode_AsUTF8String(value);
+      if (!data)
+        return -1;
+      break;
+
+    case ENCODING_VARINT:
+      if (PyInt_CheckExact(value)) {
+        long v = PyInt_AS_LONG(value);
+        if (v < 0)
+          return 0;
+        number = v;
+
+      } else if (PyLong_CheckExact(value)) {
+        number = PyLong_AsUnsignedLongLong(value);
+        if (number == (unsigned PY_LONG_LONG)-1 && PyErr_Occurred()) {
+          // Negative or too large, let the descriptor raise.
+          PyErr_Clear();
+          return 0;
+        }
+
+      } else {
+        return 0;
+      }
+
+      if (!varint_encode(number, buffer, &buffer_length)) {
+        PyErr_SetString(PyExc_RuntimeError, "Internal Error");
+        return -1;
+      }
+
+      if (PyList_Append(output, encoded_tag) < 0)
+        return -1;
+
+      data = PyString_FromStringAndSize((char *)buffer, buffer_length);
+      if (!data)
+        return -1;
+
+      result = PyList_Append(output, data) < 0 ? -1 : 1;
+      Py_DECREF(data);
+      return result;
+
+    default:
+      return 0;
+  }
+
+  if (!varint_encode(PyString_GET_SIZE(data), buffer, &buffer_length)) {
+    PyErr_SetString(PyExc_RuntimeError, "Internal Error");
+    goto exit;
+  }
+
+  encoded_length = PyString_FromStringAndSize((char *)buffer, buffer_length);
+  if (!encoded_length)
+    goto exit;
+
+  if (PyList_Append(output, encoded_tag) < 0 ||
+      PyList_Append(output, encoded_length) < 0 ||
+      PyList_Append(output, data) < 0)
+    goto exit;
+
+  result = 1;
+
+exit:
+  Py_XDECREF(encoded_length);
+  Py_DECREF(data);
+  return result;
+}
+
+
+// Serializes an iterable of (python_format, wire_format, type_descriptor)
+// triplets. This is the C equivalent of structs.SerializeEntries(). Python
+// formats are only converted (by calling back into their type descriptor) when
+// there is no cached wire format or the python object is dirty.
+//
+// The optional plan maps type descriptors to (encoding, encoded_tag). Values of
+// planned descriptors are never dirty, and primitive encodings are written
+// directly without calling ConvertToWireFormat().
+PyObject *py_serialize_entries(PyObject *self, PyObject *args,
+                               PyObject *kwargs) {
+  static char *kwlist[] = {"entries", "plan", NULL};
+  static PyObject *is_dirty = NULL;
+  static PyObject *convert_to_wire_format = NULL;
+  PyObject *entries = NULL;
+  PyObject *plan = Py_None;
+  PyObject *iterator = NULL;
+  PyObject *output = NULL;
+  PyObject *item = NULL;
+  PyObject *empty = NULL;
+  PyObject *result = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|O", kwlist,
+                                   &entries, &plan))
+    return NULL;
+
+  if (plan == Py_None) {
+    plan = NULL;
+  } else if (!PyDict_Check(plan)) {
+    PyErr_SetString(PyExc_TypeError, "Plan must be a dict.");
+    return NULL;
+  }
+
+  if (!is_dirty) {
+    is_dirty = PyString_InternFromString("IsDirty");
+    convert_to_wire_format = PyString_InternFromString("ConvertToWireFormat");
+    if (!is_dirty || !convert_to_wire_format)
+      return NULL;
+  }
+
+  iterator = PyObject_GetIter(entries);
+  if (!iterator)
+    return NULL;
+
+  output = PyList_New(0);
+  if (!output)
+    goto exit;
+
+  while ((item = PyIter_Next(iterator))) {
+    PyObject *python_format;
+    PyObject *wire_format;
+    PyObject *type_descriptor;
+    PyObject *planned = NULL;
+    PyObject *extended;
+    int convert = 0;
+
+    if (!PyTuple_Check(item) || PyTuple_GET_SIZE(item) != 3) {
+      PyErr_SetString(PyExc_TypeError, "Expected a triplet.");
+      goto exit;
+    }
+
+    python_format = PyTuple_GET_ITEM(item, 0);
+    wire_format = PyTuple_GET_ITEM(item, 1);
+    type_descriptor = PyTuple_GET_ITEM(item, 2);
+
+    if (plan && type_descriptor != Py_None) {
+      // Borrowed reference.
+      planned = PyDict_GetItem(plan, type_descriptor);
+      if (planned && (!PyTuple_Check(planned) ||
+                      PyTuple_GET_SIZE(planned) != 2)) {
+        PyErr_SetString(PyExc_TypeError, "Expected an encoding pair.");
+        goto exit;
+      }
+    }
+
+    if (wire_format == Py_None) {
+      convert = 1;
+
+      if (planned) {
+        long encoding = PyInt_AsLong(PyTuple_GET_ITEM(planned, 0));
+        int encoded;
+
+        if (encoding == -1 && PyErr_Occurred())
+          goto exit;
+
+        encoded = encode_primitive(output, encoding,
+                                   PyTuple_GET_ITEM(planned, 1),
+                                   python_format);
+        if (encoded < 0)
+          goto exit;
+
+        if (encoded) {
+          Py_CLEAR(item);
+          continue;
+        }
+      }
+
+    } else if (!planned) {
+      int truth = PyObject_IsTrue(python_format);
+      if (truth < 0)
+        goto exit;
+
+      if (truth) {
+        PyObject *dirty = PyObject_CallMethodObjArgs(
+            type_descriptor, is_dirty, python_format, NULL);
+        if (!dirty)
+          goto exit;
+
+        convert = PyObject_IsTrue(dirty);
+        Py_DECREF(dirty);
+        if (convert < 0)
+          goto exit;
+      }
+    }
+
+    if (convert) {
+      wire_format = PyObject_CallMethodObjArgs(
+          type_descriptor, convert_to_wire_format, python_format, NULL);
+      if (!wire_format)
+        goto exit;
+    } else {
+      Py_INCREF(wire_format);
+    }
+
+    extended = _PyList_Extend((PyListObject *)output, wire_format);
+    Py_DECREF(wire_format);
+    if (!extended)
+      goto exit;
+
+    Py_DECREF(extended);
+    Py_CLEAR(item);
+  }
+
+  if (PyErr_Occurred())
+    goto exit;
+
+  empty = PyString_FromStringAndSize(NULL, 0);
+  if (empty)
+    result = _PyString_Join(empty, output);
+
+exit:
+  Py_XDECREF(item);
+  Py_XDECREF(empty);
+  Py_XDECREF(output);
+  Py_DECREF(iterator);
+  return result;
+}
+
+// Finds the first content defined chunk boundary in buffer[start:end].
+//
+// gear_table holds the 256 32 bit gear values, little endian. A boundary is
+// found after the byte where the gear rolling hash started at start has all
+// bits of mask cleared, once at least window_size bytes were hashed. Returns
+// the offset of the boundary in buffer, or end if there is none.
+PyObject *py_gear_boundary(PyObject *self, PyObject *args) {
+  const unsigned char *buffer;
+  Py_ssize_t buffer_len = 0;
+  const unsigned char *table;
+  Py_ssize_t table_len = 0;
+  Py_ssize_t start = 0;
+  Py_ssize_t end = 0;
+  unsigned long mask = 0;
+  Py_ssize_t window_size = 0;
+  unsigned long gear[256];
+  unsigned long rolling_hash = 0;
+  Py_ssize_t i;
+
+  if (!PyArg_ParseTuple(args, "s#s#nnkn", &buffer, &buffer_len, &table,
+                        &table_len, &start, &end, &mask, &window_size))
+    return NULL;
+
+  if (table_len != 256 * 4 || start < 0 || start > end || end > buffer_len) {
+    PyErr_SetString(PyExc_ValueError, "Invalid parameters.");
+    return NULL;
+  }
+
+  for (i = 0; i < 256; i++) {
+    gear[i] = (unsigned long)table[4 * i] |
+              (unsigned long)table[4 * i + 1] << 8 |
+              (unsigned long)table[4 * i + 2] << 16 |
+              (unsigned long)table[4 * i + 3] << 24;
+  }
+
+  mask &= 0xFFFFFFFFUL;
+  for (i = start; i < end; i++) {
+    rolling_hash = ((rolling_hash << 1) + gear[buffer[i]]) & 0xFFFFFFFFUL;
+    if (!(rolling_hash & mask) && i - start >= window_size - 1)
+      return PyInt_FromSsize_t(i + 1);
+  }
+
+  return PyInt_FromSsize_t(end);
+}
+
 /* Retrieves the semantic protobuf version
  * Returns a Python object if successful or NULL on error
  */
@@ -340,6 +844,21 @@ static PyMethodDef _semantic_methods[] = {
      METH_VARARGS | METH_KEYWORDS,
      "Split a buffer into tags and wire format data."},
 
+    {"decode_struct",
+     (PyCFunction)py_decode_struct,
+     METH_VARARGS | METH_KEYWORDS,
+     "Decode a buffer into the raw data of a struct."},
+
+    {"serialize_entries",
+     (PyCFunction)py_serialize_entries,
+     METH_VARARGS | METH_KEYWORDS,
+     "Serialize struct entries into a buffer."},
+
+    {"gear_boundary",
+     (PyCFunction)py_gear_boundary,
+     METH_VARARGS,
+     "Find the first content defined chunk boundary in a buffer."},
+
     {NULL}  /* Sentinel */
 };
 
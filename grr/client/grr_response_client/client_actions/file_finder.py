@@ -92,8 +92,10 @@ class FileFinderOS(actions.ActionPlugin):
         raise _SkipFileException()
 
   def _ValidateContent(self, args, filepath, matches):
-    for content_condition in _ParseContentConditions(args):
-      result = list(content_condition.Search(filepath))
+    content_conditions = list(_ParseContentConditions(args))
+    results = conditions.ContentCondition.SearchMany(filepath,
+                                                     content_conditions)
+    for result in results:
       if not result:
         raise _SkipFileException()
       matches.extend(result)
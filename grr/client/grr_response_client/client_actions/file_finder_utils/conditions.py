@@ -3,11 +3,16 @@
 
 import abc
 import collections
+import heapq
+import re
+import sre_constants
+import sre_parse
 
 from grr_response_client import streaming
 from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
+from grr.lib.rdfvalues import standard as rdf_standard
 
 
 class MetadataCondition(object):
@@ -171,6 +176,69 @@ class ContentCondition(object):
       except KeyError:
         pass
 
+  @staticmethod
+  def SearchMany(path, content_conditions):
+    """Searches specified file for the content of many conditions at once.
+
+    Conditions looking at the same region of the file are streamed together,
+    and every chunk is scanned once by a single multi-pattern matcher per
+    condition type rather than once per condition.
+
+    Args:
+      path: A path to the file that is going to be searched.
+      content_conditions: A list of `ContentCondition` objects.
+
+    Returns:
+      A list of `BufferReference` lists, one for each of the conditions.
+    """
+    results = [[] for _ in content_conditions]
+
+    regions = collections.OrderedDict()
+    for index, condition in enumerate(content_conditions):
+      region = (condition.params.start_offset, condition.params.length)
+      regions.setdefault(region, []).append(index)
+
+    for (offset, amount), indices in regions.iteritems():
+      kinds = collections.OrderedDict()
+      for index in indices:
+        kinds.setdefault(type(content_conditions[index]), []).append(index)
+
+      matchers = []
+      for kind, kind_indices in kinds.iteritems():
+        patterns = [content_conditions[i].Pattern() for i in kind_indices]
+        matchers.append((kind.MultiMatcher(patterns), kind_indices))
+
+      pending = set(indices)
+      streamer = streaming.Streamer(
+          chunk_size=ContentCondition.CHUNK_SIZE,
+          overlap_size=ContentCondition.OVERLAP_SIZE)
+      for chunk in streamer.StreamFilePath(path, offset=offset, amount=amount):
+        for matcher, kind_indices in matchers:
+          # Like `Chunk.Scan`, hits of a pattern do not overlap each other.
+          positions = [0] * len(kind_indices)
+          for hit in matcher.FindAll(chunk.data, overlap=chunk.overlap):
+            index = kind_indices[hit.index]
+            if index not in pending:
+              continue
+            if hit.span.begin < positions[hit.index]:
+              continue
+
+            positions[hit.index] = hit.span.end
+
+            condition = content_conditions[index]
+            reference = condition._BufferReference(chunk, hit.span)  # pylint: disable=protected-access
+            results[index].append(reference)
+
+            if condition.params.mode == condition.params.Mode.FIRST_HIT:
+              pending.remove(index)
+              if not pending:
+                break
+
+        if not pending:
+          break
+
+    return results
+
   OVERLAP_SIZE = 1024 * 1024
   CHUNK_SIZE = 10 * 1024 * 1024
 
@@ -191,18 +259,20 @@ class ContentCondition(object):
     amount = self.params.length
     for chunk in streamer.StreamFilePath(path, offset=offset, amount=amount):
       for span in chunk.Scan(matcher):
-        ctx_begin = max(span.begin - self.params.bytes_before, 0)
-        ctx_end = min(span.end + self.params.bytes_after, len(chunk.data))
-        ctx_data = chunk.data[ctx_begin:ctx_end]
-
-        yield rdf_client.BufferReference(
-            offset=chunk.offset + ctx_begin,
-            length=len(ctx_data),
-            data=ctx_data)
+        yield self._BufferReference(chunk, span)
 
         if self.params.mode == self.params.Mode.FIRST_HIT:
           return
 
+  def _BufferReference(self, chunk, span):
+    """Creates a reference to a match together with its requested context."""
+    ctx_begin = max(span.begin - self.params.bytes_before, 0)
+    ctx_end = min(span.end + self.params.bytes_after, len(chunk.data))
+    ctx_data = chunk.data[ctx_begin:ctx_end]
+
+    return rdf_client.BufferReference(
+        offset=chunk.offset + ctx_begin, length=len(ctx_data), data=ctx_data)
+
 
 class LiteralMatchCondition(ContentCondition):
   """A content condition that lookups a literal pattern."""
@@ -212,10 +282,17 @@ class LiteralMatchCondition(ContentCondition):
     self.params = params.contents_literal_match
 
   def Search(self, path):
-    matcher = LiteralMatcher(utils.SmartStr(self.params.literal))
+    matcher = LiteralMatcher(self.Pattern())
     for match in self.Scan(path, matcher):
       yield match
 
+  def Pattern(self):
+    return utils.SmartStr(self.params.literal)
+
+  @staticmethod
+  def MultiMatcher(patterns):
+    return MultiLiteralMatcher(patterns)
+
 
 class RegexMatchCondition(ContentCondition):
   """A content condition that lookups regular expressions."""
@@ -225,10 +302,17 @@ class RegexMatchCondition(ContentCondition):
     self.params = params.contents_regex_match
 
   def Search(self, path):
-    matcher = RegexMatcher(self.params.regex)
+    matcher = RegexMatcher(self.Pattern())
     for match in self.Scan(path, matcher):
       yield match
 
+  def Pattern(self):
+    return self.params.regex
+
+  @staticmethod
+  def MultiMatcher(patterns):
+    return MultiRegexMatcher(patterns)
+
 
 class Matcher(object):
   """An abstract class for objects able to lookup byte strings."""
@@ -266,7 +350,9 @@ class RegexMatcher(Matcher):
     self.regex = regex
 
   def Match(self, data, position):
-    match = self.regex.Search(data[position:])
+    # The data is searched as if it started at the given position (so that `^`
+    # and lookbehinds behave as if it was sliced there) without copying it.
+    match = self.regex.Search(buffer(data, position))
     if not match:
       return None
 
@@ -291,3 +377,242 @@ class LiteralMatcher(Matcher):
       return None
 
     return Matcher.Span(begin=offset, end=offset + len(self.literal))
+
+
+class MultiMatcher(object):
+  """An abstract class for objects able to lookup many byte strings at once."""
+
+  __metaclass__ = abc.ABCMeta
+
+  Hit = collections.namedtuple("Hit", ["index", "span"])  # pylint: disable=invalid-name
+
+  @abc.abstractmethod
+  def FindAll(self, data, overlap=0):
+    """Scans the given data object for all the patterns.
+
+    Args:
+      data: A byte string to pattern match on.
+      overlap: A size of the overlap-only zone at the beginning of the data.
+        Like in `Chunk.Scan`, hits lying completely within it are not reported.
+
+    Yields:
+      `Hit` objects with the index of the matching pattern and its `Span`. Hits
+      of each pattern are ordered by position.
+    """
+    pass
+
+
+class MultiRegexMatcher(MultiMatcher):
+  """A matcher looking up a set of regexes at once.
+
+  Each regex is scanned for the same way `Chunk.Scan` does it with a
+  `RegexMatcher`: hits of a regex do not overlap each other and every search
+  sees the data as if it started where the previous hit of the regex ended.
+
+  Regexes starting with a literal are only tried where one of the literals
+  occurs. The literals are looked up all at once (ignoring case, just like the
+  regexes do) with a `MultiLiteralMatcher`. The remaining regexes are searched
+  for one by one.
+
+  Args:
+    regexes: A list of RDF regular expressions that the matcher represents.
+  """
+
+  # Shorter literals are too common to skip much of the data.
+  MIN_PREFIX_SIZE = 3
+
+  def __init__(self, regexes):
+    super(MultiRegexMatcher, self).__init__()
+    self.regexes = regexes
+
+    # Indices of the regexes that start with the corresponding prefixes.
+    self._prefixed = []
+    prefixes = []
+
+    # Indices of the regexes that are searched for on their own.
+    self._unprefixed = []
+
+    default_flags = re.compile("").flags
+    for index, regex in enumerate(regexes):
+      pattern = regex.SerializeToString()
+      prefix = self._LiteralPrefix(pattern)
+      if (re.compile(pattern).flags == default_flags and
+          len(prefix) >= self.MIN_PREFIX_SIZE):
+        self._prefixed.append(index)
+        prefixes.append(prefix.lower())
+      else:
+        self._unprefixed.append(index)
+
+    self._prefix_matcher = MultiLiteralMatcher(prefixes)
+
+  @staticmethod
+  def _LiteralPrefix(pattern):
+    """Returns the literal every match of the given regex has to start with."""
+    prefix = []
+    for op, value in sre_parse.parse(pattern):
+      if op != sre_constants.LITERAL:
+        break
+      prefix.append(chr(value))
+
+    return "".join(prefix)
+
+  @staticmethod
+  def _NextPosition(span, overlap):
+    """Returns the position at which the search resumes after the given hit."""
+    # Just like `Chunk.Scan`, the search resumes just after the beginning of
+    # hits within the overlap-only zone and at the end of the other ones (unless
+    # they are empty, which would make the search find them over and over).
+    if span.end <= overlap or span.end == span.begin:
+      return span.begin + 1
+    return span.end
+
+  def FindAll(self, data, overlap=0):
+    positions = [0] * len(self.regexes)
+
+    if self._prefixed:
+      for hit in self._prefix_matcher.FindAll(data.lower()):
+        index = self._prefixed[hit.index]
+        position = positions[index]
+        if hit.span.begin < position:
+          continue
+
+        match = self.regexes[index].Match(
+            buffer(data, position), hit.span.begin - position)
+        if not match:
+          continue
+
+        span = Matcher.Span(begin=hit.span.begin, end=position + match.end())
+        positions[index] = self._NextPosition(span, overlap)
+        if span.end > overlap:
+          yield MultiMatcher.Hit(index=index, span=span)
+
+    for index in self._unprefixed:
+      matcher = RegexMatcher(self.regexes[index])
+      # Searching past the end would match empty patterns at the end again.
+      while positions[index] <= len(data):
+        span = matcher.Match(data, positions[index])
+        if span is None:
+          break
+
+        positions[index] = self._NextPosition(span, overlap)
+        if span.end > overlap:
+          yield MultiMatcher.Hit(index=index, span=span)
+
+
+class MultiLiteralMatcher(MultiMatcher):
+  """A matcher looking up a set of byte strings in a single pass over the data.
+
+  The literals are stored in a trie, which is compiled into a single regex
+  alternation with shared prefixes factored out. The regex engine skips over
+  bytes no literal starts with and follows the trie otherwise, and the trie is
+  walked again only where the regex stops to report every literal found there.
+
+  The regex engine pays for every byte it looks at and for every branch of the
+  alternation it tries, while a plain string search is much faster per byte. For
+  a handful of literals, or literals starting with too many different bytes, the
+  matcher searches for each literal on its own and merges the hits instead.
+
+  Args:
+    literals: A list of byte string patterns that the matcher matches.
+  """
+
+  # Literals ending at a trie node are stored under a key that is never a byte.
+  _END = None
+
+  def __init__(self, literals):
+    super(MultiLiteralMatcher, self).__init__()
+    self.literals = literals
+
+    self._indices = collections.OrderedDict()
+    for index, literal in enumerate(literals):
+      self._indices.setdefault(literal, []).append(index)
+
+    self._trie = {}
+    for literal, indices in self._indices.iteritems():
+      node = self._trie
+      for byte in literal:
+        node = node.setdefault(byte, {})
+      node[self._END] = indices
+
+    # Measured costs of scanning random data: the regex costs about as much as
+    # 25 string searches, plus the square of the number of different first
+    # bytes (each tried branch times the chance of trying them) over 32.
+    first_bytes = len([byte for byte in self._trie if byte is not self._END])
+    if len(self._indices) > 25 + first_bytes * first_bytes // 32:
+      self._regex = re.compile(self._TriePattern(self._trie))
+    else:
+      self._regex = None
+
+  @classmethod
+  def _TriePattern(cls, node):
+    """Builds a regex matching any of the literals in the given trie."""
+    branches = [
+        re.escape(byte) + cls._TriePattern(child)
+        for byte, child in sorted(node.iteritems())
+        if byte is not cls._END
+    ]
+    if not branches:
+      return ""
+
+    pattern = "|".join(branches)
+    if cls._END in node:
+      return "(?:%s)?" % pattern
+    if len(branches) > 1:
+      return "(?:%s)" % pattern
+    return pattern
+
+  def FindAll(self, data, overlap=0):
+    if self._regex is None:
+      hits = self._FindEach(data)
+    else:
+      hits = self._FindAny(data)
+
+    for hit in hits:
+      if hit.span.end > overlap:
+        yield hit
+
+  def _FindAny(self, data):
+    """Yields hits of all the literals using the trie regex."""
+    position = 0
+    while position <= len(data):
+      match = self._regex.search(data, position)
+      if not match:
+        return
+
+      begin = match.start()
+      node = self._trie
+      end = begin
+      while True:
+        for index in node.get(self._END, []):
+          yield MultiMatcher.Hit(
+              index=index, span=Matcher.Span(begin=begin, end=end))
+
+        if end == len(data):
+          break
+        node = node.get(data[end])
+        if node is None:
+          break
+        end += 1
+
+      position = begin + 1
+
+  def _FindEach(self, data):
+    """Yields hits of all the literals merged from a search for each of them."""
+    heap = []
+    for literal, indices in self._indices.iteritems():
+      begin = data.find(literal)
+      if begin != -1:
+        heap.append((begin, len(literal), literal, indices))
+    heapq.heapify(heap)
+
+    while heap:
+      begin, length, literal, indices = heap[0]
+      for index in indices:
+        yield MultiMatcher.Hit(
+            index=index, span=Matcher.Span(begin=begin, end=begin + length))
+
+      begin = data.find(literal, begin + 1)
+      if begin == -1:
+        heapq.heappop(heap)
+      else:
+        heapq.heapreplace(heap, (begin, length, literal, indices))
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 import os
 import platform
+import random
 import subprocess
+import time
 import unittest
 
 import unittest
@@ -12,6 +14,7 @@ from grr.lib import rdfvalue
 from grr.lib import utils
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
 from grr.lib.rdfvalues import standard as rdf_standard
+from grr.test_lib import benchmark_test_lib
 from grr.test_lib import test_lib
 
 
@@ -71,6 +74,30 @@ class RegexMatcherTest(unittest.TestCase):
     span = matcher.Match("qvvvvx", 0)
     self.assertFalse(span)
 
+  def testMatchAnchoredAtPosition(self):
+    matcher = self._RegexMatcher("^foo")
+
+    span = matcher.Match("foofoo", 3)
+    self.assertTrue(span)
+    self.assertEqual(span.begin, 3)
+    self.assertEqual(span.end, 6)
+
+    span = matcher.Match("xfoo", 0)
+    self.assertFalse(span)
+
+  def testMatchLookbehindStopsAtPosition(self):
+    matcher = self._RegexMatcher("(?<=a)b")
+
+    span = matcher.Match("abab", 0)
+    self.assertTrue(span)
+    self.assertEqual(span.begin, 1)
+    self.assertEqual(span.end, 2)
+
+    span = matcher.Match("abab", 1)
+    self.assertTrue(span)
+    self.assertEqual(span.begin, 3)
+    self.assertEqual(span.end, 4)
+
 
 class LiteralMatcherTest(unittest.TestCase):
 
@@ -105,6 +132,141 @@ class LiteralMatcherTest(unittest.TestCase):
     self.assertFalse(span)
 
 
+class MultiLiteralMatcherTest(unittest.TestCase):
+
+  def testFindAll(self):
+    matcher = conditions.MultiLiteralMatcher(["bar", "foo", "foobar", "quux"])
+
+    hits = list(matcher.FindAll("foobarbazfoo"))
+    self.assertEqual(hits, [
+        (1, (0, 3)),
+        (2, (0, 6)),
+        (0, (3, 6)),
+        (1, (9, 12)),
+    ])
+
+  def testFindAllOverlapping(self):
+    matcher = conditions.MultiLiteralMatcher(["aa", "a"])
+
+    hits = list(matcher.FindAll("baaa"))
+    self.assertEqual(hits, [
+        (1, (1, 2)),
+        (0, (1, 3)),
+        (1, (2, 3)),
+        (0, (2, 4)),
+        (1, (3, 4)),
+    ])
+
+  def testFindAllDuplicates(self):
+    matcher = conditions.MultiLiteralMatcher(["foo", "bar", "foo"])
+
+    hits = list(matcher.FindAll("barfoo"))
+    self.assertEqual(hits, [(1, (0, 3)), (0, (3, 6)), (2, (3, 6))])
+
+  def testFindAllSpecialBytes(self):
+    matcher = conditions.MultiLiteralMatcher(["a.b", "\x00*", "(?"])
+
+    hits = list(matcher.FindAll("axb a.b \x00\x00* (?"))
+    self.assertEqual(hits, [(0, (4, 7)), (1, (9, 11)), (2, (12, 14))])
+
+  def testFindAllSingle(self):
+    matcher = conditions.MultiLiteralMatcher(["oo"])
+
+    hits = list(matcher.FindAll("fooo"))
+    self.assertEqual(hits, [(0, (1, 3)), (0, (2, 4))])
+
+  def testFindAllMany(self):
+    literals = ["foo%d" % i for i in range(100)] + ["foo", "bar", "fo"]
+    matcher = conditions.MultiLiteralMatcher(literals)
+
+    data = "foo1 foo10 barfoo99 fo"
+    expected = []
+    for begin in range(len(data)):
+      for end in range(begin, len(data) + 1):
+        for index, literal in enumerate(literals):
+          if data[begin:end] == literal:
+            expected.append((index, (begin, end)))
+
+    self.assertEqual(list(matcher.FindAll(data)), expected)
+
+  def testNoMatch(self):
+    matcher = conditions.MultiLiteralMatcher(["foo", "bar"])
+
+    self.assertFalse(list(matcher.FindAll("quux norf")))
+
+
+class MultiRegexMatcherTest(unittest.TestCase):
+
+  @staticmethod
+  def _MultiRegexMatcher(patterns):
+    regexes = [rdf_standard.RegularExpression(pattern) for pattern in patterns]
+    return conditions.MultiRegexMatcher(regexes)
+
+  def testFindAll(self):
+    matcher = self._MultiRegexMatcher(["\\d+", "[a-z]+", "o+"])
+
+    hits = sorted(matcher.FindAll("foo 42"))
+    self.assertEqual(hits, [(0, (4, 6)), (1, (0, 3)), (2, (1, 3))])
+
+  def testFindAllDense(self):
+    matcher = self._MultiRegexMatcher(["a+", "aaaa+"])
+
+    hits = sorted(matcher.FindAll("a" * 1000))
+    self.assertEqual(hits, [(0, (0, 1000)), (1, (0, 1000))])
+
+  def testFindAllPrefixes(self):
+    matcher = self._MultiRegexMatcher(["foo\\d+", "FOO\\d", "bar.*quux"])
+
+    hits = sorted(matcher.FindAll("foo1 Foo23 bar quux fooz"))
+    self.assertEqual(hits, [
+        (0, (0, 4)),
+        (0, (5, 10)),
+        (1, (0, 4)),
+        (1, (5, 9)),
+        (2, (11, 19)),
+    ])
+
+  def testFindAllGroups(self):
+    matcher = self._MultiRegexMatcher(["(a)\\1", "(b)\\1"])
+
+    hits = sorted(matcher.FindAll("abba aa"))
+    self.assertEqual(hits, [(0, (5, 7)), (1, (1, 3))])
+
+  def testFindAllInlineFlags(self):
+    matcher = self._MultiRegexMatcher(["(?x) f o o", "b a r"])
+
+    hits = sorted(matcher.FindAll("foo b a r"))
+    self.assertEqual(hits, [(0, (0, 3)), (1, (4, 9))])
+
+  def testFindAllAnchored(self):
+    matcher = self._MultiRegexMatcher(["^foo", "(?<=[or])bar", "bar(?<=rbar)"])
+
+    # Like with `RegexMatcher`, the data is searched as if it started at the
+    # end of the previous hit.
+    hits = sorted(matcher.FindAll("foofoo xfoo\nfoo obarbar"))
+    self.assertEqual(hits, [
+        (0, (0, 3)),
+        (0, (3, 6)),
+        (0, (12, 15)),
+        (1, (17, 20)),
+        (2, (20, 23)),
+    ])
+
+  def testFindAllOverlap(self):
+    matcher = self._MultiRegexMatcher(["ab|bcd", "foo\\d+"])
+
+    hits = sorted(matcher.FindAll("abcd foo1 foo2", overlap=2))
+    self.assertEqual(hits, [(0, (1, 4)), (1, (5, 9)), (1, (10, 14))])
+
+    hits = sorted(matcher.FindAll("abcd foo1 foo2", overlap=9))
+    self.assertEqual(hits, [(1, (10, 14))])
+
+  def testNoMatch(self):
+    matcher = self._MultiRegexMatcher(["\\d+", "ba+r"])
+
+    self.assertFalse(list(matcher.FindAll("foo baz")))
+
+
 class ConditionTestMixin(object):
 
   def setUp(self):
@@ -558,6 +720,182 @@ class RegexMatchCondition(ConditionTestMixin, unittest.TestCase):
     self.assertEqual(results[0].length, 4)
 
 
+class SearchManyTest(ConditionTestMixin, unittest.TestCase):
+
+  @staticmethod
+  def _LiteralCondition(literal, **kwargs):
+    params = rdf_file_finder.FileFinderCondition()
+    params.contents_literal_match.literal = literal
+    params.contents_literal_match.mode = "ALL_HITS"
+    for name, value in kwargs.iteritems():
+      setattr(params.contents_literal_match, name, value)
+    return conditions.LiteralMatchCondition(params)
+
+  @staticmethod
+  def _RegexCondition(regex, **kwargs):
+    params = rdf_file_finder.FileFinderCondition()
+    params.contents_regex_match.regex = regex
+    params.contents_regex_match.mode = "ALL_HITS"
+    for name, value in kwargs.iteritems():
+      setattr(params.contents_regex_match, name, value)
+    return conditions.RegexMatchCondition(params)
+
+  def testNoConditions(self):
+    self.assertEqual(conditions.ContentCondition.SearchMany("/foo/bar", []), [])
+
+  def testMixedConditions(self):
+    with open(self.temp_filepath, "wb") as fd:
+      fd.write("foo 7 bar 49 foo")
+
+    results = conditions.ContentCondition.SearchMany(self.temp_filepath, [
+        self._LiteralCondition("foo"),
+        self._RegexCondition("\\d+", bytes_before=1),
+        self._LiteralCondition("baz"),
+        self._LiteralCondition("bar", mode="FIRST_HIT"),
+    ])
+    self.assertEqual(len(results), 4)
+    self.assertEqual([(ref.offset, ref.data) for ref in results[0]],
+                     [(0, "foo"), (13, "foo")])
+    self.assertEqual([(ref.offset, ref.data) for ref in results[1]],
+                     [(3, " 7"), (9, " 49")])
+    self.assertEqual(results[2], [])
+    self.assertEqual([(ref.offset, ref.data) for ref in results[3]],
+                     [(6, "bar")])
+
+  def testFirstHit(self):
+    with open(self.temp_filepath, "wb") as fd:
+      fd.write("foo bar foo bar")
+
+    results = conditions.ContentCondition.SearchMany(self.temp_filepath, [
+        self._LiteralCondition("foo", mode="FIRST_HIT"),
+        self._RegexCondition("ba+r", mode="FIRST_HIT"),
+    ])
+    self.assertEqual([(ref.offset, ref.data) for ref in results[0]],
+                     [(0, "foo")])
+    self.assertEqual([(ref.offset, ref.data) for ref in results[1]],
+                     [(4, "bar")])
+
+  def testStartOffset(self):
+    with open(self.temp_filepath, "wb") as fd:
+      fd.write("oooooooo")
+
+    results = conditions.ContentCondition.SearchMany(self.temp_filepath, [
+        self._LiteralCondition("ooo", start_offset=2),
+        self._LiteralCondition("ooo"),
+        self._RegexCondition("o+", start_offset=6),
+    ])
+    self.assertEqual([ref.offset for ref in results[0]], [2, 5])
+    self.assertEqual([ref.offset for ref in results[1]], [0, 3])
+    self.assertEqual([(ref.offset, ref.data) for ref in results[2]],
+                     [(6, "oo")])
+
+  def testSameAsSearch(self):
+    with open(self.temp_filepath, "wb") as fd:
+      fd.write("foobarbaz" * 10 + "quux" * 10 + "barbar")
+
+    content_conditions = [
+        self._LiteralCondition("bar", bytes_after=2),
+        self._LiteralCondition("baz"),
+        self._LiteralCondition("uxqu"),
+        self._LiteralCondition("norf"),
+        self._RegexCondition("ba+r"),
+        self._RegexCondition("(?:quux)+", bytes_before=3),
+        self._RegexCondition("^bar"),
+        self._RegexCondition("(?<=o)bar"),
+        self._RegexCondition("z\\b"),
+    ]
+
+    # Small chunks make the hits cross chunk boundaries and overlap zones.
+    with utils.MultiStubber((conditions.ContentCondition, "CHUNK_SIZE", 16),
+                            (conditions.ContentCondition, "OVERLAP_SIZE", 8)):
+      results = conditions.ContentCondition.SearchMany(self.temp_filepath,
+                                                       content_conditions)
+      expected = [
+          list(condition.Search(self.temp_filepath))
+          for condition in content_conditions
+      ]
+
+    self.assertEqual(results, expected)
+    self.assertTrue(results[0])
+    self.assertFalse(results[3])
+
+
+class ContentConditionBenchmark(benchmark_test_lib.MicroBenchmarks):
+  """Scanning files for many content conditions."""
+
+  units = "s"
+
+  # Sizes are kept small enough for a test run, raise them to benchmark scans
+  # of multi-GB files.
+  FILE_SIZE = 64 * 1024 * 1024
+  PATTERN_COUNTS = [1, 100, 1000]
+
+  def setUp(self):
+    super(ContentConditionBenchmark, self).setUp(
+        extra_fields=["Bytes/sec"], extra_format=["<20"])
+
+    self.temp_filepath = test_lib.TempFilePath()
+    with open(self.temp_filepath, "wb") as fd:
+      for _ in range(self.FILE_SIZE // (1024 * 1024)):
+        fd.write(os.urandom(1024 * 1024))
+
+  def tearDown(self):
+    super(ContentConditionBenchmark, self).tearDown()
+    os.remove(self.temp_filepath)
+
+  def _AddResult(self, name, start_time, count):
+    time_taken = time.time() - start_time
+    self.AddResult(name, time_taken, count,
+                   "%.0f" % (self.FILE_SIZE / time_taken))
+
+  def _Benchmark(self, make_condition, max_search_count):
+    for count in self.PATTERN_COUNTS:
+      content_conditions = [make_condition() for _ in range(count)]
+
+      start_time = time.time()
+      results = conditions.ContentCondition.SearchMany(self.temp_filepath,
+                                                       content_conditions)
+      self._AddResult("SearchMany, %d patterns" % count, start_time, count)
+      self.assertEqual(len(results), count)
+
+      if count > max_search_count:
+        # A separate pass for each of the conditions takes too long.
+        continue
+
+      start_time = time.time()
+      for condition in content_conditions:
+        list(condition.Search(self.temp_filepath))
+      self._AddResult("Search, %d patterns" % count, start_time, count)
+
+  @staticmethod
+  def _RandomString():
+    length = random.randint(8, 16)
+    letters = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return "".join(random.choice(letters) for _ in range(length))
+
+  def testLiterals(self):
+    """Searching for random 8-16 letter literals."""
+
+    def MakeCondition():
+      params = rdf_file_finder.FileFinderCondition()
+      params.contents_literal_match.literal = self._RandomString()
+      params.contents_literal_match.mode = "ALL_HITS"
+      return conditions.LiteralMatchCondition(params)
+
+    self._Benchmark(MakeCondition, max_search_count=100)
+
+  def testRegexes(self):
+    """Searching for regexes with random 8-16 letter literal prefixes."""
+
+    def MakeCondition():
+      params = rdf_file_finder.FileFinderCondition()
+      params.contents_regex_match.regex = self._RandomString() + "[0-9]+"
+      params.contents_regex_match.mode = "ALL_HITS"
+      return conditions.RegexMatchCondition(params)
+
+    self._Benchmark(MakeCondition, max_search_count=1)
+
+
 def main(argv):
   test_lib.main(argv)
 
@@ -120,6 +120,96 @@ class HashBuffer(actions.ActionPlugin):
             offset=args.offset, length=len(data), data=digest))
 
 
+class HashBufferManifest(actions.ActionPlugin):
+  """Hash a buffer from a file in fixed size chunks and return all digests."""
+  in_rdfvalue = rdf_client.BlobManifestRequest
+  out_rdfvalues = [rdf_client.BlobManifest]
+
+  # Large files are reported in several manifests, each of them holds at most
+  # this many digests (128KiB).
+  MAX_DIGESTS_PER_MANIFEST = 4096
+
+  def _SendManifest(self, offset, length, chunk_size, digests):
+    self.SendReply(
+        rdf_client.BlobManifest(
+            offset=offset,
+            length=length,
+            chunk_size=chunk_size,
+            digests="".join(digests)))
+
+  def Run(self, args):
+    """Hashes all chunks of the buffer and sends their digests."""
+    # Make sure we limit the size of our output
+    if args.chunk_size > constants.CLIENT_MAX_BUFFER_SIZE:
+      raise RuntimeError("Can not read buffers this large.")
+
+    with vfs.VFSOpen(args.pathspec, progress_callback=self.Progress) as fd:
+      fd.Seek(args.offset)
+
+      manifest_offset = args.offset
+      manifest_length = 0
+      digests = []
+      remaining = args.length
+      while True:
+        data = fd.Read(min(remaining, args.chunk_size))
+        self.Progress()
+
+        # Like HashBuffer, a short read at the end still gets a hash.
+        digests.append(hashlib.sha256(data).digest())
+        manifest_length += len(data)
+        remaining -= len(data)
+        if len(data) < args.chunk_size or remaining <= 0:
+          break
+
+        if len(digests) >= self.MAX_DIGESTS_PER_MANIFEST:
+          self._SendManifest(manifest_offset, manifest_length, args.chunk_size,
+                             digests)
+          manifest_offset += manifest_length
+          manifest_length = 0
+          digests = []
+
+    self._SendManifest(manifest_offset, manifest_length, args.chunk_size,
+                       digests)
+
+
+class HashBufferChunks(actions.ActionPlugin):
+  """Hash a buffer from a file in content defined chunks."""
+  in_rdfvalue = rdf_client.HashBufferChunksRequest
+  out_rdfvalues = [rdf_client.BufferReference]
+
+  def Run(self, args):
+    """Splits the buffer into chunks and reports each chunk's hash."""
+    chunker = client_utils_common.ContentDefinedChunker(
+        args.min_chunk_size,
+        args.average_chunk_size,
+        args.max_chunk_size,
+        progress=self.Progress)
+
+    # Make sure we limit the size of each chunk.
+    if chunker.max_chunk_size > constants.CLIENT_MAX_BUFFER_SIZE:
+      raise RuntimeError("Can not read buffers this large.")
+
+    with vfs.VFSOpen(args.pathspec, progress_callback=self.Progress) as fd:
+      fd.Seek(args.offset)
+
+      chunk_count = 0
+      for offset, data in chunker.ChunkFile(fd, args.length):
+        chunk_count += 1
+        self.SendReply(
+            rdf_client.BufferReference(
+                offset=args.offset + offset,
+                length=len(data),
+                data=hashlib.sha256(data).digest()))
+
+    # Like HashBuffer, an empty buffer still gets a hash.
+    if not chunk_count:
+      self.SendReply(
+          rdf_client.BufferReference(
+              offset=args.offset,
+              length=0,
+              data=hashlib.sha256("").digest()))
+
+
 class HashFile(actions.ActionPlugin):
   """Hash an entire file using multiple algorithms."""
   in_rdfvalue = rdf_client.FingerprintRequest
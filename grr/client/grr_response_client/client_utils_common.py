@@ -5,10 +5,17 @@ import hashlib
 import logging
 import os
 import platform
+import struct
 import subprocess
 import threading
 import time
 
+# pylint: disable=g-import-not-at-top
+try:
+  from grr import _semantic
+except ImportError:
+  _semantic = None
+# pylint: enable=g-import-not-at-top
 
 from grr import config
 from grr_response_client.local import binary_whitelist
@@ -266,3 +273,114 @@ class MultiHasher(object):
     for algorithm in self._hashers:
       setattr(hash_object, algorithm, self._hashers[algorithm].digest())
     return hash_object
+
+
+class ContentDefinedChunker(object):
+  """Splits data into chunks at boundaries defined by the data itself.
+
+  A chunk ends where a gear rolling hash over the preceding WINDOW_SIZE bytes
+  has all of its top bits cleared. Since a boundary only depends on the bytes
+  right before it, inserting or removing data only changes the chunks around
+  the edit while all later chunks (and therefore their blob hashes) stay the
+  same.
+
+  Args:
+    min_chunk_size: No chunk except the last one is smaller than this.
+    average_chunk_size: The expected distance between boundaries past
+        min_chunk_size. Must be a power of two.
+    max_chunk_size: Chunks are cut at this size if no boundary was found.
+    progress: An (optional) progress callback called for every chunk.
+  """
+
+  # Every bit of the 32 bit gear hash depends on at most this many bytes.
+  WINDOW_SIZE = 32
+
+  # Boundaries computed by different client versions have to match for blobs
+  # to be deduplicated so this table must never change.
+  _GEAR = [
+      struct.unpack("<I", hashlib.sha256(chr(i)).digest()[:4])[0]
+      for i in range(256)
+  ]
+  _GEAR_TABLE = struct.pack("<256I", *_GEAR)
+
+  def __init__(self,
+               min_chunk_size,
+               average_chunk_size,
+               max_chunk_size,
+               progress=None):
+    bits = average_chunk_size.bit_length() - 1
+    if average_chunk_size != 1 << bits or bits > 32:
+      raise ValueError(
+          "Invalid average chunk size: %d" % average_chunk_size)
+
+    if not self.WINDOW_SIZE <= min_chunk_size <= max_chunk_size:
+      raise ValueError("Invalid chunk size limits: %d-%d" % (min_chunk_size,
+                                                             max_chunk_size))
+
+    self.min_chunk_size = min_chunk_size
+    self.max_chunk_size = max_chunk_size
+    self._mask = ((1 << bits) - 1) << (32 - bits)
+    self._progress = progress
+
+  def _FindBoundary(self, data):
+    """Returns the length of the first chunk in data."""
+    end = min(len(data), self.max_chunk_size)
+    if end <= self.min_chunk_size:
+      return end
+
+    # Only the last WINDOW_SIZE bytes influence the hash so we can skip
+    # everything before that.
+    start = self.min_chunk_size - self.WINDOW_SIZE
+    if _semantic:
+      return _semantic.gear_boundary(data, self._GEAR_TABLE, start, end,
+                                     self._mask, self.WINDOW_SIZE)
+
+    return self._PythonFindBoundary(data, start, end)
+
+  def _PythonFindBoundary(self, data, start, end):
+    """The pure python version of the boundary scan in _FindBoundary."""
+    gear = self._GEAR
+    mask = self._mask
+    rolling_hash = 0
+    for i, byte in enumerate(bytearray(data[start:end])):
+      rolling_hash = ((rolling_hash << 1) + gear[byte]) & 0xFFFFFFFF
+      if not rolling_hash & mask and i >= self.WINDOW_SIZE - 1:
+        return start + i + 1
+
+    return end
+
+  def ChunkFile(self, fd, byte_count):
+    """Splits the content of a file into chunks.
+
+    Args:
+      fd: A file object to read the data from.
+      byte_count: A maximum number of bytes that are going to be processed.
+
+    Yields:
+      Tuples (offset, data) of each chunk where offset is relative to the
+      position of fd.
+    """
+    offset = 0
+    data = ""
+    while True:
+      # Chunks shorter than max_chunk_size may only occur at the end of data.
+      while len(data) < self.max_chunk_size and byte_count > 0:
+        buf = fd.read(min(byte_count, constants.CLIENT_MAX_BUFFER_SIZE))
+        if not buf:
+          byte_count = 0
+          break
+
+        byte_count -= len(buf)
+        data += buf
+
+      if not data:
+        return
+
+      length = self._FindBoundary(data)
+      if self._progress:
+        self._progress()
+
+      yield offset, data[:length]
+
+      offset += length
+      data = data[length:]
@@ -5,6 +5,7 @@
 import hashlib
 import imp
 import os
+import StringIO
 import sys
 import mock
 
@@ -12,6 +13,7 @@ import unittest
 from grr_response_client import client_utils_common
 from grr_response_client import client_utils_osx
 from grr.lib import flags
+from grr.lib import utils
 from grr.test_lib import test_lib
 
 
@@ -191,6 +193,74 @@ class MultiHasherTest(unittest.TestCase):
     self.assertEqual(hasher.GetHashObject().num_bytes, 108)
 
 
+class ContentDefinedChunkerTest(unittest.TestCase):
+
+  @staticmethod
+  def _Data(size):
+    return "".join(hashlib.sha256(str(i)).digest() for i in xrange(size / 32))
+
+  def _Chunks(self, data, byte_count=None):
+    chunker = client_utils_common.ContentDefinedChunker(1024, 4096, 16384)
+    if byte_count is None:
+      byte_count = len(data)
+    return list(chunker.ChunkFile(StringIO.StringIO(data), byte_count))
+
+  def testChunksCoverData(self):
+    data = self._Data(1024 * 1024)
+    chunks = self._Chunks(data)
+
+    self.assertEqual("".join(chunk for _, chunk in chunks), data)
+    offset = 0
+    for chunk_offset, chunk in chunks:
+      self.assertEqual(chunk_offset, offset)
+      offset += len(chunk)
+
+    for _, chunk in chunks[:-1]:
+      self.assertGreaterEqual(len(chunk), 1024)
+      self.assertLessEqual(len(chunk), 16384)
+
+    # Chunks are not just cut at the maximum size.
+    self.assertLess(len(chunks), len(data) / 4096 * 2)
+    self.assertGreater(len(chunks), len(data) / 16384)
+
+  def testByteCount(self):
+    data = self._Data(100 * 1024)
+    chunks = self._Chunks(data, byte_count=50000)
+    self.assertEqual("".join(chunk for _, chunk in chunks), data[:50000])
+
+  def testBoundariesResyncAfterInsertion(self):
+    data = self._Data(1024 * 1024)
+    modified = data[:100000] + "inserted" + data[100000:]
+
+    chunks = set(chunk for _, chunk in self._Chunks(data))
+    modified_chunks = [chunk for _, chunk in self._Chunks(modified)]
+    new_chunks = [chunk for chunk in modified_chunks if chunk not in chunks]
+
+    self.assertEqual(len(new_chunks), 1)
+    self.assertTrue("inserted" in new_chunks[0])
+
+  def testEmptyData(self):
+    self.assertEqual(self._Chunks(""), [])
+
+  def testAcceleratedBoundariesMatchPython(self):
+    if not client_utils_common._semantic:  # pylint: disable=protected-access
+      self.skipTest("The C accelerator is not available.")
+
+    data = self._Data(1024 * 1024)
+    accelerated_chunks = self._Chunks(data)
+    with utils.Stubber(client_utils_common, "_semantic", None):
+      python_chunks = self._Chunks(data)
+
+    self.assertEqual(accelerated_chunks, python_chunks)
+
+  def testInvalidChunkSizes(self):
+    with self.assertRaises(ValueError):
+      client_utils_common.ContentDefinedChunker(1024, 3000, 16384)
+
+    with self.assertRaises(ValueError):
+      client_utils_common.ContentDefinedChunker(16384, 4096, 1024)
+
+
 def main(argv):
   test_lib.main(argv)
 
@@ -105,6 +105,7 @@ from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import rekall_types as rdf_rekall_types
+from grr.lib.rdfvalues import structs as rdf_structs
 
 
 class HTTPObject(object):
@@ -579,6 +580,21 @@ class GRRClientWorker(threading.Thread):
 
     return messages
 
+  def DrainSerialized(self, max_size=1024):
+    """Like Drain() but returns the messages without parsing them.
+
+    Args:
+       max_size: The size (in bytes) of the returned messages will be at most
+       one message length over this size.
+
+    Returns:
+       A SerializedMessageList.
+    """
+    messages = self._out_queue.GetSerializedMessages(soft_size_limit=max_size)
+    stats.STATS.IncrementCounter("grr_client_sent_messages", delta=len(messages))
+
+    return messages
+
   def QueueMessages(self, messages):
     """Push messages to the input queue."""
     # Push all the messages to our input queue
@@ -852,6 +868,91 @@ class GRRClientWorker(threading.Thread):
       os.kill(os.getpid(), signal.SIGKILL)
 
 
+class SerializedMessageList(object):
+  """A MessageList whose GrrMessages are kept serialized.
+
+  A serialized MessageList is just the concatenation of its length prefixed
+  messages, so messages taken off the outbound queue can be sent to the server
+  without being parsed and serialized again.
+  """
+
+  _JOB_TAG = rdf_flows.MessageList.type_infos["job"].encoded_tag
+
+  def __init__(self, serialized_messages=None, require_fastpoll=False):
+    self.serialized_messages = serialized_messages or []
+    # Set if any of the messages requires the client to fastpoll.
+    self.require_fastpoll = require_fastpoll
+
+  def __len__(self):
+    return len(self.serialized_messages)
+
+  def SerializeToString(self):
+    return "".join(
+        self._JOB_TAG + rdf_structs.VarintEncode(len(message)) + message
+        for message in self.serialized_messages)
+
+  def ToMessageList(self):
+    return rdf_flows.MessageList(job=[
+        rdf_flows.GrrMessage.FromSerializedString(message)
+        for message in self.serialized_messages
+    ])
+
+  def Split(self, max_size):
+    """Splits the messages into lists of about max_size bytes.
+
+    Args:
+      max_size: int The lists will be at most one message over this size.
+
+    Yields:
+      SerializedMessageList objects, at least one even if there are no
+      messages.
+    """
+    bundle = []
+    bundle_size = 0
+    for message in self.serialized_messages:
+      bundle.append(message)
+      bundle_size += len(message)
+      if bundle_size >= max_size:
+        yield SerializedMessageList(bundle)
+        bundle = []
+        bundle_size = 0
+
+    if bundle or not self.serialized_messages:
+      yield SerializedMessageList(bundle)
+
+
+class MessageBundleStream(object):
+  """The body of a streaming upload to the control endpoint.
+
+  The messages are compressed and encrypted in bundles of about bundle_size
+  bytes while the request is sent, so only a single encoded bundle is held in
+  memory at a time. Iterating again, e.g. when the request is retried, encodes
+  the bundles again.
+  """
+
+  def __init__(self, client_communicator, message_list, queue_size,
+               bundle_size):
+    self.client_communicator = client_communicator
+    self.message_list = message_list
+    self.queue_size = queue_size
+    self.bundle_size = bundle_size
+    # All bundles carry the same timestamp. The server returns it as the nonce,
+    # which the communicator verifies when decrypting the response.
+    self.nonce = client_communicator.timestamp = long(time.time() * 1000000)
+    # The number of bytes sent by the last iteration.
+    self.sent_bytes = 0
+
+  def __iter__(self):
+    self.sent_bytes = 0
+    for bundle in self.message_list.Split(self.bundle_size):
+      payload = rdf_flows.ClientCommunication(queue_size=self.queue_size)
+      self.client_communicator.EncodeMessages(
+          bundle, payload, timestamp=self.nonce)
+      data = communicator.PackMessageBundle(payload.SerializeToString())
+      self.sent_bytes += len(data)
+      yield data
+
+
 class SizeLimitedQueue(object):
   """A Queue which limits the total size of its elements.
 
@@ -900,6 +1001,7 @@ class SizeLimitedQueue(object):
         timeout is exceeded.
     """
     # We only queue already serialized objects so we know how large they are.
+    require_fastpoll = bool(message.require_fastpoll)
     message = message.SerializeToString()
 
     if priority >= rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
@@ -919,7 +1021,7 @@ class SizeLimitedQueue(object):
           raise Queue.Full
 
     with self._lock:
-      self._queues[priority].appendleft(message)
+      self._queues[priority].appendleft((message, require_fastpoll))
       self._total_size += len(message)
 
   def _GeneratePriority(self, priority):
@@ -954,15 +1056,32 @@ class SizeLimitedQueue(object):
       earlier in priority order; messages with equivalent priority are returned
       FIFO.
     """
+    return self.GetSerializedMessages(
+        soft_size_limit=soft_size_limit).ToMessageList()
+
+  def GetSerializedMessages(self, soft_size_limit=None):
+    """Like GetMessages() but returns the messages without parsing them.
+
+    Args:
+      soft_size_limit: int If there is more data in the queue than
+        soft_size_limit bytes, the returned list of messages will be
+        approximately this large. If None (default), returns all messages
+        currently on the queue.
+
+    Returns:
+      SerializedMessageList The messages in priority order.
+    """
     with self._lock:
-      ret = rdf_flows.MessageList()
+      ret = SerializedMessageList()
       ret_size = 0
-      for message in self._Generate():
-        ret.job.append(rdf_flows.GrrMessage.FromSerializedString(message))
+      for message, require_fastpoll in self._Generate():
+        ret.serialized_messages.append(message)
+        ret.require_fastpoll |= require_fastpoll
         ret_size += len(message)
         if soft_size_limit is not None and ret_size > soft_size_limit:
           break
 
+      self._total_size -= ret_size
       return ret
 
   def Size(self):
@@ -1122,16 +1241,33 @@ class GRRHTTPClient(object):
       return False
 
   def MakeRequest(self, data):
-    """Make a HTTP Post request to the server 'control' endpoint."""
-    stats.STATS.IncrementCounter("grr_client_sent_bytes", len(data))
+    """Make a HTTP Post request to the server 'control' endpoint.
+
+    Args:
+      data: A serialized ClientCommunication or, for a streaming upload, a
+        MessageBundleStream.
+
+    Returns:
+      An HTTPObject() instance.
+    """
+    path = "control?api=%s" % config.CONFIG["Network.api"]
+    streaming = isinstance(data, MessageBundleStream)
+    if streaming:
+      path += "&stream=1"
+    else:
+      stats.STATS.IncrementCounter("grr_client_sent_bytes", len(data))
 
     # Verify the response is as it should be from the control endpoint.
     response = self.http_manager.OpenServerEndpoint(
-        path="control?api=%s" % config.CONFIG["Network.api"],
+        path=path,
         verify_cb=self.VerifyServerControlResponse,
         data=data,
         headers={"Content-Type": "binary/octet-stream"})
 
+    # The size of a stream is only known once it was sent.
+    if streaming:
+      stats.STATS.IncrementCounter("grr_client_sent_bytes", data.sent_bytes)
+
     if response.code == 406:
       self.InitiateEnrolment()
       return response
@@ -1160,16 +1296,14 @@ class GRRHTTPClient(object):
     # back so we don't expire our messages too fast.
     if self.http_manager.consecutive_connection_errors == 0:
       # Grab some messages to send
-      message_list = self.client_worker.Drain(
+      message_list = self.client_worker.DrainSerialized(
           max_size=config.CONFIG["Client.max_post_size"])
     else:
-      message_list = rdf_flows.MessageList()
+      message_list = SerializedMessageList()
 
     # If any outbound messages require fast poll we switch to fast poll mode.
-    for message in message_list.job:
-      if message.require_fastpoll:
-        self.timer.FastPoll()
-        break
+    if message_list.require_fastpoll:
+      self.timer.FastPoll()
 
     # Make new encrypted ClientCommunication rdfvalue.
     payload = rdf_flows.ClientCommunication()
@@ -1186,9 +1320,16 @@ class GRRHTTPClient(object):
       # the input queue.
       payload.queue_size = self.client_worker.InQueueSize()
 
-    nonce = self.communicator.EncodeMessages(message_list, payload)
-    payload_data = payload.SerializeToString()
-    response = self.MakeRequest(payload_data)
+    bundle_size = config.CONFIG["Client.upload_bundle_size"]
+    if bundle_size:
+      request_data = MessageBundleStream(self.communicator, message_list,
+                                         payload.queue_size, bundle_size)
+      nonce = request_data.nonce
+    else:
+      nonce = self.communicator.EncodeMessages(message_list, payload)
+      request_data = payload.SerializeToString()
+
+    response = self.MakeRequest(request_data)
 
     # Unable to decode response or response not valid.
     if response.code != 200 or response.messages is None:
@@ -1202,7 +1343,7 @@ class GRRHTTPClient(object):
       self.server_certificate = None
 
       # Reschedule the tasks back on the queue so they get retried next time.
-      messages = list(message_list.job)
+      messages = list(message_list.ToMessageList().job)
       for message in messages:
         message.priority = rdf_flows.GrrMessage.Priority.HIGH_PRIORITY
         message.require_fastpoll = False
@@ -1241,10 +1382,15 @@ class GRRHTTPClient(object):
     # any order since clients do not have state.
     self.client_worker.QueueMessages(response.messages)
 
+    if bundle_size:
+      sent_bytes = request_data.sent_bytes
+    else:
+      sent_bytes = len(request_data)
+
     cn = self.communicator.common_name
     logging.info(
         "%s: Sending %s(%s), Received %s messages in %s sec. "
-        "Sleeping for %s sec.", cn, len(message_list), len(payload_data),
+        "Sleeping for %s sec.", cn, len(message_list), sent_bytes,
         len(response.messages), response.duration, self.timer.sleep_time)
 
     return response
@@ -276,6 +276,30 @@ class SizeLimitedQueueTest(test_lib.GRRBaseTest):
     result.job.Extend(queue.GetMessages().job)
     self.assertEqual(list(result.job), [msg_c] * 10 + [msg_a, msg_b] * 10)
 
+  def testGetSerializedMessages(self):
+    queue = comms.SizeLimitedQueue(maxsize=10000000, heart_beat_cb=lambda: None)
+
+    msg_a = rdf_flows.GrrMessage(name="A", require_fastpoll=False)
+    msg_b = rdf_flows.GrrMessage(name="B")
+    msg_c = rdf_flows.GrrMessage(name="C", require_fastpoll=False)
+
+    queue.Put(msg_a, rdf_flows.GrrMessage.Priority.MEDIUM_PRIORITY)
+    queue.Put(msg_b, rdf_flows.GrrMessage.Priority.LOW_PRIORITY)
+    queue.Put(msg_c, rdf_flows.GrrMessage.Priority.HIGH_PRIORITY)
+
+    result = queue.GetSerializedMessages(
+        soft_size_limit=len(msg_a.SerializeToString()))
+    self.assertEqual(len(result), 2)
+    self.assertFalse(result.require_fastpoll)
+    self.assertEqual(result.SerializeToString(),
+                     rdf_flows.MessageList(job=[msg_c, msg_a]).SerializeToString())
+    self.assertEqual(queue.Size(), len(msg_b.SerializeToString()))
+
+    result = queue.GetSerializedMessages()
+    self.assertTrue(result.require_fastpoll)
+    self.assertEqual(list(result.ToMessageList().job), [msg_b])
+    self.assertEqual(queue.Size(), 0)
+
   def testSizeLimitedQueueOverflow(self):
 
     msg_a = rdf_flows.GrrMessage(name="A")
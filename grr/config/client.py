@@ -96,6 +96,13 @@ config_lib.DEFINE_list(
 config_lib.DEFINE_integer("Client.max_post_size", 40000000,
                           "Maximum size of the post.")
 
+config_lib.DEFINE_integer(
+    "Client.upload_bundle_size", 0,
+    "If set, the messages of a post are streamed to the server in a chunked "
+    "request, compressed and encrypted in bundles of about this many bytes. "
+    "This keeps the client from holding the whole encoded post in memory. "
+    "The frontend needs to support streaming uploads.")
+
 config_lib.DEFINE_integer("Client.max_out_queue", 51200000,
                           "Maximum size of the output queue.")
 
@@ -10,6 +10,16 @@ config_lib.DEFINE_integer("Datastore.maximum_blob_size", 512 * 1024,
 config_lib.DEFINE_string("Datastore.implementation", "FakeDataStore",
                          "Storage subsystem to use.")
 
+config_lib.DEFINE_integer(
+    "Datastore.cache_size", 0,
+    "Number of subjects whose attributes are cached in each process. 0 "
+    "disables the cache.")
+
+config_lib.DEFINE_integer(
+    "Datastore.cache_max_age", 10,
+    "Seconds a subject's attributes are cached for. This bounds how long "
+    "changes made by other processes can go unnoticed.")
+
 config_lib.DEFINE_string("Blobstore.implementation", "MemoryStreamBlobstore",
                          "Blob storage subsystem to use.")
 
@@ -37,6 +37,20 @@ config_lib.DEFINE_integer(
     "Worker.queue_shards", 5, "Queue notifications will be sharded across "
     "this number of datastore subjects.")
 
+config_lib.DEFINE_integer(
+    "Worker.notification_shard_lease_time", 60,
+    "Workers lease notification shards for this many seconds. Shards of a "
+    "worker which stops renewing its leases are picked up by other workers "
+    "after this time.")
+
+config_lib.DEFINE_list(
+    "Worker.priority_class_weights",
+    ["high_priority:16", "flow:8", "hunt:2", "low_priority:1"],
+    "Weights of the priority classes the worker schedules flow processing "
+    "in, as class:weight pairs. Classes get a share of the worker threads "
+    "proportional to their weight and within a class, clients and hunts are "
+    "served round robin. If empty, flows are processed in FIFO order.")
+
 config_lib.DEFINE_list(
     "Frontend.well_known_flows", ["TransferStore", "Stats"],
     "Allow these well known flows to run directly on the "
@@ -99,6 +113,24 @@ config_lib.DEFINE_integer(
     "use ports between Frontend.bind_port and "
     "Frontend.port_max.")
 
+config_lib.DEFINE_integer(
+    "Frontend.max_upload_bundle_size", 40000000,
+    "The largest message bundle in bytes accepted in streaming uploads. "
+    "Requests announcing a larger bundle are rejected.")
+
+config_lib.DEFINE_integer(
+    "Frontend.processes", 1,
+    "If larger than 1, the HTTP frontend forks this many processes which "
+    "share the listening socket so all cores of the host can be used. Each "
+    "process runs its own monitoring server, process i uses the ports "
+    "starting at Monitoring.http_port + i * (AdminUI.port_max - "
+    "AdminUI.port + 1).")
+
+config_lib.DEFINE_integer(
+    "Frontend.request_threads", 50,
+    "The maximum number of requests each preforked frontend process handles "
+    "concurrently. Connections beyond that are left to other processes.")
+
 config_lib.DEFINE_integer(
     "Frontend.max_queue_size", 500,
     "Maximum number of messages to queue for the client.")
@@ -113,6 +145,17 @@ config_lib.DEFINE_integer(
     "Maximum time messages remain valid within the "
     "system.")
 
+config_lib.DEFINE_integer(
+    "Frontend.message_batch_size", 0,
+    "If set, messages received from concurrent client requests are stored "
+    "in shared batches of up to this many messages. Requests only return "
+    "once their batch is stored.")
+
+config_lib.DEFINE_float(
+    "Frontend.message_batch_max_delay", 0.05,
+    "The maximum time in seconds a request waits for others to join its "
+    "message batch before the batch is stored.")
+
 config_lib.DEFINE_string("Frontend.upload_store", "FileUploadFileStore",
                          "The implementation of the upload file store.")
 
@@ -52,6 +52,61 @@ class UnknownClientCert(DecodingError):
   counter = "grr_client_unknown"
 
 
+# Streaming uploads send a sequence of ClientCommunications, each prefixed by
+# its length.
+_BUNDLE_HEADER = struct.Struct("<I")
+
+
+def PackMessageBundle(serialized_bundle):
+  """Frames a serialized ClientCommunication for a streaming upload."""
+  return _BUNDLE_HEADER.pack(len(serialized_bundle)) + serialized_bundle
+
+
+def UnpackMessageBundles(chunks, max_bundle_size=None):
+  """Extracts the bundles from the body of a streaming upload.
+
+  Args:
+    chunks: An iterable of strings making up the body, split at arbitrary
+      positions.
+    max_bundle_size: If set, bundles larger than this many bytes are rejected
+      before they are read.
+
+  Yields:
+    The serialized ClientCommunications, as soon as they are complete.
+
+  Raises:
+    DecodingError: If the body ends in the middle of a bundle or a bundle is
+      too large.
+  """
+  pending = []
+  pending_size = 0
+  needed = _BUNDLE_HEADER.size
+  in_header = True
+  for chunk in chunks:
+    pending.append(chunk)
+    pending_size += len(chunk)
+
+    while pending_size >= needed:
+      data = "".join(pending)
+      item, rest = data[:needed], data[needed:]
+      pending = [rest]
+      pending_size = len(rest)
+
+      if in_header:
+        needed = _BUNDLE_HEADER.unpack(item)[0]
+        if max_bundle_size is not None and needed > max_bundle_size:
+          raise DecodingError("Streaming upload bundle of %d bytes is larger "
+                              "than %d bytes." % (needed, max_bundle_size))
+        in_header = False
+      else:
+        yield item
+        needed = _BUNDLE_HEADER.size
+        in_header = True
+
+  if pending_size or not in_header:
+    raise DecodingError("Streaming upload ended in the middle of a bundle.")
+
+
 class Cipher(object):
   """Holds keying information."""
   cipher_name = "aes_128_cbc"
@@ -120,7 +175,6 @@ class ReceivedCipher(Cipher):
   # pylint: disable=super-init-not-called
   def __init__(self, response_comms, private_key):
     self.private_key = private_key
-    self.response_comms = response_comms
 
     if response_comms.api_version not in [3]:
       raise DecryptionError("Unsupported api version: %s, expected 3." %
@@ -146,7 +200,9 @@ class ReceivedCipher(Cipher):
           len(self.cipher.hmac_key) != self.key_size / 8):
         raise DecryptionError("Invalid cipher.")
 
-      self.VerifyHMAC()
+      # We do not keep a reference to response_comms since received ciphers
+      # are cached and would otherwise pin the whole first request.
+      self._VerifyHMAC(response_comms)
 
       # Cipher_metadata contains information about the cipher - It is encrypted
       # using the symmetric session key. It contains the RSA signature of the
@@ -180,21 +236,6 @@ class ReceivedCipher(Cipher):
     """
     return self._VerifyHMAC(comms)
 
-  def VerifyHMAC(self):
-    """Verifies the HMAC of self.response.comms.
-
-    This method raises a DecryptionError if the received HMAC does not
-    verify. If the HMAC verifies correctly, True is returned.
-
-    Raises:
-      DecryptionError: The HMAC did not verify.
-
-    Returns:
-      True
-
-    """
-    return self._VerifyHMAC(self.response_comms)
-
   def _VerifyHMAC(self, comms=None):
     """Verifies the HMAC.
 
@@ -271,12 +312,20 @@ class Communicator(object):
     self.certificate = certificate
     self._ClearServerCipherCache()
 
-    # A cache for encrypted ciphers
+    # A cache of verified ciphers keyed by the encrypted cipher. Values are
+    # tuples of (cipher, remote_public_key) so that requests which reuse a
+    # cipher do not need any RSA operations or public key lookups.
     self.encrypted_cipher_cache = utils.FastStore(max_size=50000)
 
   @classmethod
   def EncodeMessageList(cls, message_list, packed_message_list):
-    """Encode the MessageList into the packed_message_list rdfvalue."""
+    """Encode the MessageList into the packed_message_list rdfvalue.
+
+    Args:
+      message_list: The messages to pack, anything serializing to a MessageList
+        (e.g. the client's list of already serialized messages) can be used.
+      packed_message_list: A PackedMessageList rdfvalue which will be filled in.
+    """
     # By default uncompress
     uncompressed_data = message_list.SerializeToString()
     packed_message_list.message_list = uncompressed_data
@@ -456,7 +505,8 @@ class Communicator(object):
     # Have we seen this cipher before?
     cipher_verified = False
     try:
-      cipher = self.encrypted_cipher_cache.Get(response_comms.encrypted_cipher)
+      cipher, remote_public_key = self.encrypted_cipher_cache.Get(
+          response_comms.encrypted_cipher)
       stats.STATS.IncrementCounter(
           "grr_encrypted_cipher_cache", fields=["hits"])
 
@@ -464,11 +514,6 @@ class Communicator(object):
       # make sure that all the other fields are sane and verify the HMAC.
       cipher.VerifyReceivedHMAC(response_comms)
       cipher_verified = True
-
-      # If we have the cipher in the cache, we know the source and
-      # should have a corresponding public key.
-      source = cipher.GetSource()
-      remote_public_key = self._GetRemotePublicKey(source)
     except KeyError:
       stats.STATS.IncrementCounter(
           "grr_encrypted_cipher_cache", fields=["misses"])
@@ -480,7 +525,7 @@ class Communicator(object):
         if cipher.VerifyCipherSignature(remote_public_key):
           # At this point we know this cipher is legit, we can cache it.
           self.encrypted_cipher_cache.Put(response_comms.encrypted_cipher,
-                                          cipher)
+                                          (cipher, remote_public_key))
           cipher_verified = True
 
       except UnknownClientCert:
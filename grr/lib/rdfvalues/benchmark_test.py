@@ -4,7 +4,10 @@
 
 from grr.lib import flags
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr_response_proto import jobs_pb2
 from grr_response_proto import knowledge_base_pb2
@@ -339,6 +342,103 @@ class RDFValueBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
     self.TimeIt(RDFStructDecodeEncode)
     self.TimeIt(ProtoDecodeEncode)
 
+  def testMessageListDecodeEncode(self):
+    """Compares the python and C struct codecs on MessageList payloads."""
+    repeats = self.REPEATS / 50
+
+    message_list = rdf_flows.MessageList()
+    for i in range(self.REPEATS):
+      message_list.job.Append(
+          session_id="aff4:/W:session",
+          name="foobar",
+          request_id=i,
+          response_id=1,
+          payload=rdf_client.StatEntry(
+              pathspec=rdf_paths.PathSpec(
+                  path="/etc/passwd%d" % i, pathtype="OS"),
+              st_size=i,
+              st_mode=33188),
+          source="C.1000000000000000")
+
+    data = message_list.SerializeToString()
+
+    def DecodeEncode():
+      decoded = rdf_flows.MessageList.FromSerializedString(data)
+      for message in decoded.job:
+        _ = message.request_id
+
+      return len(decoded.SerializeToString())
+
+    with utils.MultiStubber(
+        (rdf_structs, "ReadIntoObject", rdf_structs.PythonReadIntoObject),
+        (rdf_structs, "SerializeEntries", rdf_structs.PythonSerializeEntries)):
+      self.TimeIt(
+          DecodeEncode,
+          "Python MessageList Decode/Encode",
+          repetitions=repeats)
+
+    if rdf_structs._semantic:
+      with utils.MultiStubber(
+          (rdf_structs, "ReadIntoObject",
+           rdf_structs.AcceleratedReadIntoObject),
+          (rdf_structs, "SerializeEntries",
+           rdf_structs._semantic.serialize_entries)):
+        self.TimeIt(
+            DecodeEncode, "C MessageList Decode/Encode", repetitions=repeats)
+
+
+class StructCodecBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
+  """Per type encode and decode costs of the struct codec."""
+
+  REPEATS = 10000
+  units = "ns"
+
+  def _MakeSamples(self):
+    pathspec = rdf_paths.PathSpec(
+        path="/etc/passwd",
+        pathtype="OS",
+        nested_path=rdf_paths.PathSpec(path="/shadow", pathtype="TSK"))
+    stat_entry = rdf_client.StatEntry(
+        pathspec=pathspec,
+        st_size=1234,
+        st_mode=33188,
+        st_mtime=1369308998,
+        st_uid=1000)
+    message = rdf_flows.GrrMessage(
+        session_id="aff4:/W:session",
+        name="foobar",
+        request_id=1,
+        response_id=2,
+        payload=stat_entry,
+        source="C.1000000000000000")
+    message_list = rdf_flows.MessageList()
+    for _ in range(100):
+      message_list.job.Append(message)
+
+    return [
+        ("PathSpec", pathspec),
+        ("User", rdf_client.User(**RDFValueBenchmark.USER_ACCOUNT)),
+        ("StatEntry", stat_entry),
+        ("GrrMessage", message),
+        ("MessageList", message_list),
+    ]
+
+  def testEncode(self):
+    """Serialization of structs built from python values (ns/op)."""
+    for name, sample in self._MakeSamples():
+      self.TimeIt(sample.SerializeToString, "Encode %s" % name)
+
+  def testDecode(self):
+    """Parsing and accessing all top level fields (ns/op)."""
+    for name, sample in self._MakeSamples():
+      cls = sample.__class__
+      data = sample.SerializeToString()
+
+      def Decode():
+        return len(list(cls.FromSerializedString(data).ListSetFields()))
+
+      self.TimeIt(Decode, "Decode %s" % name)
+
 
 def main(argv):
   # Run the full test suite
@@ -645,6 +645,44 @@ class BufferReference(structs.RDFProtoStruct):
     return self.data == other
 
 
+class HashBufferChunksRequest(structs.RDFProtoStruct):
+  """A request to hash a buffer in content defined chunks."""
+  protobuf = jobs_pb2.HashBufferChunksRequest
+  rdf_deps = [
+      paths.PathSpec,
+  ]
+
+
+class BlobManifestRequest(structs.RDFProtoStruct):
+  """A request to hash a buffer in fixed size chunks."""
+  protobuf = jobs_pb2.BlobManifestRequest
+  rdf_deps = [
+      paths.PathSpec,
+  ]
+
+
+class BlobManifest(structs.RDFProtoStruct):
+  """The digests of consecutive chunks of a file."""
+  protobuf = jobs_pb2.BlobManifest
+
+  DIGEST_SIZE = 32
+
+  def GetBufferReferences(self):
+    """Returns a BufferReference for each chunk in the manifest."""
+    end = self.offset + self.length
+    digests = self.digests or ""
+
+    result = []
+    for i in xrange(0, len(digests), self.DIGEST_SIZE):
+      offset = self.offset + i / self.DIGEST_SIZE * self.chunk_size
+      result.append(
+          BufferReference(
+              offset=offset,
+              length=min(self.chunk_size, end - offset),
+              data=digests[i:i + self.DIGEST_SIZE]))
+    return result
+
+
 class Process(structs.RDFProtoStruct):
   """Represent a process on the client."""
   protobuf = sysinfo_pb2.Process
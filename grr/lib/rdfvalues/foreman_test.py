@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 """Test for the foreman client rule classes."""
 
+import mock
+
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib.rdfvalues import test_base
@@ -141,6 +143,58 @@ class ForemanClientRuleSetTest(test_base.RDFValueTestMixin,
         rs.Evaluate(aff4.FACTORY.Open(client_id_lin, token=self.token)))
 
 
+class CompiledForemanClientRuleSetTest(test_lib.GRRBaseTest):
+
+  def _RegexRuleSet(self, *regexes):
+    return rdf_foreman.ForemanClientRuleSet(
+        match_mode=rdf_foreman.ForemanClientRuleSet.MatchMode.MATCH_ALL,
+        rules=[
+            rdf_foreman.ForemanClientRule(
+                rule_type=rdf_foreman.ForemanClientRule.Type.REGEX,
+                regex=rdf_foreman.ForemanRegexClientRule(
+                    field="SYSTEM", attribute_regex=regex)) for regex in regexes
+        ])
+
+  def testFieldsAreResolvedOncePerClient(self):
+    client_id = self.SetupClient(0, system="Linux")
+    client_fields = rdf_foreman.ForemanClientFields(
+        aff4.FACTORY.Open(client_id, token=self.token))
+
+    rule_sets = [
+        self._RegexRuleSet("^Lin", "ux$").Compile(),
+        self._RegexRuleSet("Linux").Compile(),
+        self._RegexRuleSet("Windows").Compile(),
+    ]
+
+    with mock.patch.object(
+        rdf_foreman.ForemanRegexClientRule,
+        "_ResolveFieldAFF4",
+        autospec=True,
+        side_effect=rdf_foreman.ForemanRegexClientRule._ResolveFieldAFF4
+    ) as resolve:
+      results = [rule_set(client_fields) for rule_set in rule_sets]
+
+    self.assertEqual(results, [True, True, False])
+    self.assertEqual(resolve.call_count, 1)
+
+  def testCompiledRuleSetsAreCachedUntilRulesChange(self):
+    rules = rdf_foreman.ForemanRules(
+        [rdf_foreman.ForemanRule(client_rule_set=self._RegexRuleSet("Linux"))])
+
+    compiled = rdf_foreman.CompileClientRuleSets(rules)
+    self.assertEqual(len(compiled), 1)
+    self.assertIs(
+        rdf_foreman.CompileClientRuleSets(
+            rdf_foreman.ForemanRules.FromSerializedString(
+                rules.SerializeToString())), compiled)
+
+    rules.Append(
+        rdf_foreman.ForemanRule(client_rule_set=self._RegexRuleSet("Darwin")))
+    new_compiled = rdf_foreman.CompileClientRuleSets(rules)
+    self.assertIsNot(new_compiled, compiled)
+    self.assertEqual(len(new_compiled), 2)
+
+
 class ForemanClientRuleTest(test_base.RDFValueTestMixin, test_lib.GRRBaseTest):
   rdfvalue_class = rdf_foreman.ForemanClientRule
 
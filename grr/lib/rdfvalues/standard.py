@@ -27,18 +27,18 @@ class RegularExpression(rdfvalue.RDFString):
     except re.error:
       raise type_info.TypeValueError("Not a valid regular expression.")
 
-  def Search(self, text):
-    """Search the text for our value."""
+  def Search(self, text, pos=0):
+    """Search the text for our value, starting at the given position."""
     if isinstance(text, rdfvalue.RDFString):
       text = str(text)
 
-    return self._regex.search(text)
+    return self._regex.search(text, pos)
 
-  def Match(self, text):
+  def Match(self, text, pos=0):
     if isinstance(text, rdfvalue.RDFString):
       text = str(text)
 
-    return self._regex.match(text)
+    return self._regex.match(text, pos)
 
   def FindIter(self, text):
     if isinstance(text, rdfvalue.RDFString):
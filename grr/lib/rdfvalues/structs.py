@@ -8,7 +8,7 @@ import struct
 
 # pylint: disable=g-import-not-at-top
 try:
-  from grr.accelerated import _semantic
+  from grr import _semantic
 except ImportError:
   _semantic = None
 
@@ -192,12 +192,33 @@ def SplitBuffer(buff, index=0, length=None):
       raise rdfvalue.DecodeError("Unexpected Tag.")
 
 
-def SerializeEntries(entries):
-  """Serializes given triplets of python and wire values and a descriptor."""
+# Encodings assigned to type descriptors by a serialization plan. These must
+# match the ENCODING_* constants in the C accelerator.
+ENCODING_GENERIC = 0
+ENCODING_BINARY = 1
+ENCODING_STRING = 2
+ENCODING_VARINT = 3
+
+
+def SerializeEntries(entries, plan=None):
+  """Serializes given triplets of python and wire values and a descriptor.
+
+  Args:
+    entries: An iterable of (python_format, wire_format, type_descriptor).
+    plan: An optional serialization plan as returned by
+      RDFStruct.GetSerializationPlan(). Descriptors in the plan hold immutable
+      python values so their dirty check can be skipped. The C accelerator
+      also uses the plan to encode primitive values without calling back into
+      the descriptor.
+
+  Returns:
+    The serialized string.
+  """
   output = []
   for python_format, wire_format, type_descriptor in entries:
 
     if wire_format is None or (python_format and
+                               (plan is None or type_descriptor not in plan) and
                                type_descriptor.IsDirty(python_format)):
       wire_format = type_descriptor.ConvertToWireFormat(python_format)
 
@@ -251,11 +272,47 @@ def ReadIntoObject(buff, index, value_obj, length=0):
   value_obj.SetRawData(raw_data)
 
 
+def AcceleratedReadIntoObject(buff, index, value_obj, length=0):
+  """Same as ReadIntoObject() but decodes the whole buffer in C.
+
+  The C extension uses the tag table precomputed for the value's class so the
+  entire buffer is split and stored into the raw data dict in one call. Only
+  repeated fields are handed back to python since they are wrapped in a
+  RepeatedFieldHelper.
+
+  Args:
+    buff: The buffer to parse.
+    index: The position to start parsing.
+    value_obj: The RDFStruct to store the parsed fields in.
+    length: Optional length to parse until.
+  """
+  raw_data = value_obj.GetRawData()
+
+  repeated_fields = _semantic.decode_struct(
+      buff,
+      value_obj.encoded_tag_table,
+      raw_data,
+      index=index,
+      length=length)
+
+  for name, wire_formats in repeated_fields.iteritems():
+    value_obj.Get(name).wrapped_list.extend(wire_formats)
+
+  value_obj.SetRawData(raw_data)
+
+
+# Keep references to the python implementations so they can be benchmarked
+# against the accelerated versions.
+PythonReadIntoObject = ReadIntoObject
+PythonSerializeEntries = SerializeEntries
+
 # pylint: disable=invalid-name
 if _semantic:
   VarintEncode = _semantic.varint_encode
   VarintReader = _semantic.varint_decode
   SplitBuffer = _semantic.split_buffer
+  ReadIntoObject = AcceleratedReadIntoObject
+  SerializeEntries = _semantic.serialize_entries
 # pylint: enable=invalid-name
 
 
@@ -859,11 +916,17 @@ class ProtoEmbedded(ProtoType):
     result = self.type()
     ReadIntoObject(value[2], 0, result)
 
+    # A freshly decoded message is identical to its wire format. Clearing the
+    # dirty flag lets the container re-serialize it by reusing the original
+    # bytes, unless it is modified after this point.
+    result.dirty = False
+
     return result
 
   def ConvertToWireFormat(self, value):
     """Encode the nested protobuf into wire format."""
-    output = SerializeEntries(value.GetRawData().itervalues())
+    output = SerializeEntries(value.GetRawData().itervalues(),
+                              value.GetSerializationPlan())
     return (self.encoded_tag, VarintEncode(len(output)), output)
 
   def LateBind(self, target=None):
@@ -1100,9 +1163,11 @@ class RepeatedFieldHelper(object):
     if self.dirty:
       return True
 
-    # If any of the items is dirty we are also dirty.
-    for item in self.wrapped_list:
-      if self.type_descriptor.IsDirty(item[0]):
+    # If any of the items is dirty we are also dirty. Items which were never
+    # decoded can not have been modified.
+    for python_format, _ in self.wrapped_list:
+      if (python_format is not None and
+          self.type_descriptor.IsDirty(python_format)):
         self.dirty = True
         return True
 
@@ -1117,7 +1182,6 @@ class RepeatedFieldHelper(object):
     if rdf_value is utils.NotAValue:
       if wire_format is None:
         rdf_value = self.type_descriptor.type(**kwargs)
-        self.dirty = True
       else:
         rdf_value = None
     else:
@@ -1131,12 +1195,14 @@ class RepeatedFieldHelper(object):
                                        type(rdf_value), e))
 
     self.wrapped_list.append((rdf_value, wire_format))
+    self.dirty = True
 
     return rdf_value
 
   def Pop(self, item):
     result = self[item]
     self.wrapped_list.pop(item)
+    self.dirty = True
     return result
 
   def Extend(self, iterable):
@@ -1472,6 +1538,15 @@ class ProtoRDFValue(ProtoType):
         self.name, self.proto_type_name, self.owner.__name__, self.field_number)
 
 
+# Descriptor classes whose values the C accelerator can encode inline. Only
+# exact classes are listed since subclasses may override ConvertToWireFormat().
+_PRIMITIVE_ENCODINGS = {
+    ProtoBinary: ENCODING_BINARY,
+    ProtoString: ENCODING_STRING,
+    ProtoUnsignedInteger: ENCODING_VARINT,
+}
+
+
 class RDFStructMetaclass(rdfvalue.RDFValueMetaclass):
   """A metaclass which registers new RDFProtoStruct instances."""
 
@@ -1486,6 +1561,14 @@ class RDFStructMetaclass(rdfvalue.RDFValueMetaclass):
     cls.type_infos_by_field_number = {}
     cls.type_infos_by_encoded_tag = {}
 
+    # Maps encoded tags to (name, type_descriptor, is_repeated) for the C
+    # decoder. This is kept in sync with type_infos_by_encoded_tag.
+    cls.encoded_tag_table = {}
+
+    # Built lazily by GetSerializationPlan() and reset whenever a descriptor
+    # is added.
+    cls._serialization_plan = None
+
     # Build the class by parsing an existing protobuf class.
     if cls.protobuf is not None:
       proto2.DefineFromProtobuf(cls, cls.protobuf)
@@ -1681,7 +1764,43 @@ class RDFStruct(rdfvalue.RDFValue):
     self.dirty = True
 
   def SerializeToString(self):
-    return SerializeEntries(self._data.itervalues())
+    return SerializeEntries(self._data.itervalues(),
+                            self.GetSerializationPlan())
+
+  @classmethod
+  def GetSerializationPlan(cls):
+    """Returns the serialization plan for this class.
+
+    The plan maps the type descriptors whose python values are immutable to a
+    tuple of (encoding, encoded_tag). Primitive strings, bytes and unsigned
+    integers get a dedicated encoding the C accelerator writes directly, the
+    rest use ENCODING_GENERIC and are converted by their descriptor as usual.
+
+    The plan is computed once per class and cached until the next call to
+    AddDescriptor().
+
+    Returns:
+      A dict of type descriptors to (encoding, encoded_tag) tuples.
+    """
+    plan = cls._serialization_plan
+    if plan is None:
+      plan = {}
+      for type_descriptor in cls.type_infos:
+        encoding = _PRIMITIVE_ENCODINGS.get(type_descriptor.__class__)
+        if encoding is None:
+          # Only descriptors which never report their values as dirty are safe
+          # to include.
+          if (type_descriptor.__class__.IsDirty.im_func is not
+              ProtoType.IsDirty.im_func):
+            continue
+
+          encoding = ENCODING_GENERIC
+
+        plan[type_descriptor] = (encoding, type_descriptor.encoded_tag)
+
+      cls._serialization_plan = plan
+
+    return plan
 
   def ParseFromString(self, string):
     ReadIntoObject(string, 0, self)
@@ -1860,6 +1979,7 @@ class RDFStruct(rdfvalue.RDFValue):
 
     cls.type_infos_by_field_number[field_desc.field_number] = field_desc
     cls.type_infos.Append(field_desc)
+    cls._serialization_plan = None
 
 
 class EnumContainer(object):
@@ -2207,9 +2327,12 @@ class RDFProtoStruct(RDFStruct):
     # We store an index of the type info by tag values to speed up parsing.
     cls.type_infos_by_field_number[field_desc.field_number] = field_desc
     cls.type_infos_by_encoded_tag[field_desc.encoded_tag] = field_desc
+    cls.encoded_tag_table[field_desc.encoded_tag] = (
+        field_desc.name, field_desc, field_desc.__class__ is ProtoList)
 
     cls.type_infos.Append(field_desc)
     cls.late_bound_type_infos.pop(field_desc.name, None)
+    cls._serialization_plan = None
 
     # Add direct accessors only if the class does not already have them.
     if not hasattr(cls, field_desc.name):
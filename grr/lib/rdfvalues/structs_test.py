@@ -2,12 +2,15 @@
 # -*- mode: python; encoding: utf-8 -*-
 """Test RDFStruct implementations."""
 
+import unittest
+
 from google.protobuf import descriptor_pool
 from google.protobuf import message_factory
 
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
@@ -460,6 +463,72 @@ class RDFStructsTest(test_base.RDFValueTestMixin, test_lib.GRRBaseTest):
     # old result instead.
     self.assertTrue("booo" in path.SerializeToString())
 
+  def testUntouchedNestedStructsReuseWireFormat(self):
+    sample = TestStruct(foobar="hello")
+    sample.nested.foobar = "nested"
+    sample.repeat_nested.Append(foobar="Nest1")
+    sample.repeat_nested.Append(foobar="Nest2")
+
+    decoded = TestStruct.FromSerializedString(sample.SerializeToString())
+
+    # Reading nested fields decodes them but does not modify them.
+    self.assertEqual(decoded.nested.foobar, "nested")
+    self.assertEqual(decoded.repeat_nested[0].foobar, "Nest1")
+
+    def Fail(*_):
+      raise AssertionError("Untouched nested struct was re-serialized.")
+
+    with utils.Stubber(structs.ProtoEmbedded, "ConvertToWireFormat", Fail):
+      serialized = decoded.SerializeToString()
+
+    self.assertEqual(TestStruct.FromSerializedString(serialized), sample)
+
+  def testModifiedNestedStructsAreReserialized(self):
+    sample = TestStruct(foobar="hello")
+    sample.repeat_nested.Append(foobar="Nest1")
+    sample.repeat_nested.Append(foobar="Nest2")
+
+    decoded = TestStruct.FromSerializedString(sample.SerializeToString())
+    decoded.repeat_nested[1].nested.int = 7
+    decoded.repeat_nested.Append(TestStruct())
+
+    reparsed = TestStruct.FromSerializedString(decoded.SerializeToString())
+    self.assertEqual(reparsed.repeat_nested[1].nested.int, 7)
+    self.assertEqual(len(reparsed.repeat_nested), 3)
+
+  def testSerializationPlan(self):
+    plan = TestStruct.GetSerializationPlan()
+
+    # Plans are cached on the class.
+    self.assertIs(TestStruct.GetSerializationPlan(), plan)
+
+    foobar = TestStruct.type_infos["foobar"]
+    self.assertEqual(plan[foobar],
+                     (structs.ENCODING_STRING, foobar.encoded_tag))
+    self.assertEqual(plan[TestStruct.type_infos["type"]][0],
+                     structs.ENCODING_GENERIC)
+
+    # Descriptors with mutable python values must always be checked.
+    self.assertNotIn(TestStruct.type_infos["nested"], plan)
+    self.assertNotIn(TestStruct.type_infos["repeated"], plan)
+    self.assertNotIn(TestStruct.type_infos["urn"], plan)
+
+  def testSerializationPlanIsResetByAddDescriptor(self):
+
+    class PlanTest(structs.RDFProtoStruct):
+      type_description = type_info.TypeDescriptorSet(
+          structs.ProtoString(name="foobar", field_number=1),)
+
+    self.assertEqual(len(PlanTest.GetSerializationPlan()), 1)
+
+    PlanTest.AddDescriptor(structs.ProtoBinary(name="data", field_number=2))
+
+    self.assertEqual(len(PlanTest.GetSerializationPlan()), 2)
+
+    tested = PlanTest(foobar=u"\u00e9", data="\x00\xff")
+    self.assertEqual(PlanTest.FromSerializedString(tested.SerializeToString()),
+                     tested)
+
   def testWireFormatAccess(self):
 
     m = rdf_flows.PackedMessageList()
@@ -691,6 +760,82 @@ class RDFStructsTest(test_base.RDFValueTestMixin, test_lib.GRRBaseTest):
         test_struct.ToPrimitiveDict(serialize_leaf_fields=True), expected_dict)
 
 
+@unittest.skipUnless(structs._semantic, "The C accelerator is not built.")
+class AcceleratedStructsTest(test_lib.GRRBaseTest):
+  """Checks the C decoder and encoder against the python implementation."""
+
+  def _MakeSample(self):
+    sample = TestStruct(foobar="hello", int=5, urn="www.example.com")
+    sample.repeated.Append("value0")
+    sample.repeated.Append("value1")
+    sample.nested.foobar = "nested"
+    sample.repeat_nested.Append(foobar="Nest1")
+    sample.repeat_nested.Append(int=2)
+    return sample
+
+  def _Decode(self, read_into_object, data):
+    result = TestStruct()
+    read_into_object(data, 0, result)
+    return result
+
+  def testDecodeMatchesPythonImplementation(self):
+    data = self._MakeSample().SerializeToString()
+
+    python_result = self._Decode(structs.PythonReadIntoObject, data)
+    accelerated_result = self._Decode(structs.AcceleratedReadIntoObject, data)
+
+    self.assertEqual(accelerated_result, python_result)
+    self.assertEqual(accelerated_result.repeat_nested[0].foobar, "Nest1")
+    self.assertEqual(accelerated_result.repeated, ["value0", "value1"])
+    self.assertEqual(accelerated_result.SerializeToString(), data)
+
+  def testDecodePreservesUnknownFields(self):
+    data = self._MakeSample().SerializeToString()
+
+    reduced = PartialTest1()
+    structs.AcceleratedReadIntoObject(data, 0, reduced)
+
+    self.assertEqual(reduced.int, 5)
+
+    decoded = TestStruct.FromSerializedString(reduced.SerializeToString())
+    self.assertEqual(decoded, self._MakeSample())
+
+  def testDecodeRejectsTruncatedData(self):
+    data = self._MakeSample().SerializeToString()
+
+    self.assertRaises(ValueError, self._Decode,
+                      structs.AcceleratedReadIntoObject, data[:-3])
+
+  def testSerializeMatchesPythonImplementation(self):
+    sample = self._MakeSample()
+    entries = sample.GetRawData().values()
+
+    self.assertEqual(
+        structs._semantic.serialize_entries(entries),
+        structs.PythonSerializeEntries(entries))
+
+  def testSerializeWithPlanMatchesPythonImplementation(self):
+    sample = self._MakeSample()
+    sample.foobar = u"\u00e9\u00e8"
+    sample.int = 2**63 + 1
+    entries = sample.GetRawData().values()
+    plan = TestStruct.GetSerializationPlan()
+
+    self.assertEqual(
+        structs._semantic.serialize_entries(entries, plan),
+        structs.PythonSerializeEntries(entries))
+
+  def testSerializeWithPlanFallsBackToDescriptor(self):
+    int_field = TestStruct.type_infos["int"]
+    plan = TestStruct.GetSerializationPlan()
+
+    # Values which can not be encoded inline are converted by their descriptor.
+    for value in [-1, True]:
+      self.assertEqual(
+          structs._semantic.serialize_entries([(value, None, int_field)], plan),
+          "".join(int_field.ConvertToWireFormat(value)))
+
+
 def main(argv):
   test_lib.main(argv)
 
@@ -2927,12 +2927,15 @@ class AFF4ImageBase(AFF4Stream):
     except KeyError:
       raise ChunkNotFoundError("Cannot open chunk %s" % chunk)
 
+  def _GetChunkPosition(self, offset):
+    """Returns the chunk holding offset, the offset into it and its size."""
+    return offset / self.chunksize, offset % self.chunksize, self.chunksize
+
   def _ReadPartial(self, length):
     """Read as much as possible, but not more than length."""
-    chunk = self.offset / self.chunksize
-    chunk_offset = self.offset % self.chunksize
+    chunk, chunk_offset, chunk_size = self._GetChunkPosition(self.offset)
 
-    available_to_read = min(length, self.chunksize - chunk_offset)
+    available_to_read = min(length, chunk_size - chunk_offset)
 
     retries = 0
     while retries < self.NUM_RETRIES:
@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 """GRR specific AFF4 objects."""
 
+import bisect
 import logging
 import re
 import StringIO
+import struct
 import time
 
 
@@ -448,9 +450,16 @@ class GRRForeman(aff4.AFF4Object):
 
     return False
 
-  def _EvaluateRules(self, rule, client):
-    """Evaluates the rules."""
-    return rule.client_rule_set.Evaluate(client)
+  # The rules the compiled rule sets were last looked up for.
+  _compiled_rules = None
+  _compiled_rule_sets = None
+
+  def _CompileRules(self, rules):
+    """Returns the compiled client rule sets of rules."""
+    if rules is not self._compiled_rules:
+      self._compiled_rule_sets = rdf_foreman.CompileClientRuleSets(rules)
+      self._compiled_rules = rules
+    return self._compiled_rule_sets
 
   def _RunActions(self, rule, client_id):
     """Run all the actions specified in the rule.
@@ -560,14 +569,14 @@ class GRRForeman(aff4.AFF4Object):
 
     now = time.time() * 1e6
 
-    for rule in rules:
+    for rule, client_rule_set in zip(rules, self._CompileRules(rules)):
       if rule.expires < now:
         expired_rules = True
         continue
       if rule.created <= int(last_foreman_run):
         continue
 
-      relevant_rules.append(rule)
+      relevant_rules.append((rule, client_rule_set))
 
     if data_store.RelationalDBReadEnabled():
       client_data = data_store.REL_DB.ReadClientFullInfo(client_id)
@@ -576,9 +585,11 @@ class GRRForeman(aff4.AFF4Object):
     else:
       client_data = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
 
+    # Client fields are only resolved once for all rules.
+    client_fields = rdf_foreman.ForemanClientFields(client_data)
     actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(rule, client_data):
+    for rule, client_rule_set in relevant_rules:
+      if client_rule_set(client_fields):
         actions_count += self._RunActions(rule, client_id)
 
     if expired_rules:
@@ -718,6 +729,8 @@ class VFSBlobImage(VFSFile):
   def Initialize(self):
     super(VFSBlobImage, self).Initialize()
     self.content_dirty = False
+    # End offsets of all chunks if they vary in size, None otherwise.
+    self.chunk_ends = None
     if self.mode == "w":
       self.index = StringIO.StringIO("")
       self.finalized = False
@@ -725,12 +738,40 @@ class VFSBlobImage(VFSFile):
       self.index = StringIO.StringIO(self.Get(self.Schema.HASHES, ""))
       self.finalized = self.Get(self.Schema.FINALIZED, False)
 
+      chunk_ends = self.Get(self.Schema.CHUNK_ENDS)
+      if chunk_ends:
+        chunk_ends = chunk_ends.SerializeToString()
+        self.chunk_ends = list(
+            struct.unpack("<%dQ" % (len(chunk_ends) / 8), chunk_ends))
+
   def Truncate(self, offset=0):
     if offset != 0:
       raise IOError("Non-zero truncation not supported for BlobImage")
     super(VFSBlobImage, self).Truncate(0)
     self.index = StringIO.StringIO("")
     self.finalized = False
+    if self.chunk_ends is not None:
+      self.chunk_ends = []
+
+  def EnableVariableSizeChunks(self):
+    """Allows blobs of any size to be added to this image.
+
+    This is needed for content defined chunking where chunk boundaries do not
+    fall on fixed offsets. Like SetChunksize(), this truncates the image.
+    """
+    self.chunk_ends = []
+    self.Truncate(0)
+
+  def _GetChunkPosition(self, offset):
+    if self.chunk_ends is None:
+      return super(VFSBlobImage, self)._GetChunkPosition(offset)
+
+    chunk = bisect.bisect_right(self.chunk_ends, offset)
+    if chunk >= len(self.chunk_ends):
+      raise IOError("Offset %d beyond the last chunk." % offset)
+
+    chunk_start = self.chunk_ends[chunk - 1] if chunk else 0
+    return chunk, offset - chunk_start, self.chunk_ends[chunk] - chunk_start
 
   def _GetChunkForWriting(self, chunk):
     """Chunks must be added using the AddBlob() method."""
@@ -782,6 +823,10 @@ class VFSBlobImage(VFSFile):
       self.Set(self.Schema.SIZE(self.size))
       self.Set(self.Schema.HASHES(self.index.getvalue()))
       self.Set(self.Schema.FINALIZED(self.finalized))
+      if self.chunk_ends is not None:
+        self.Set(
+            self.Schema.CHUNK_ENDS(
+                struct.pack("<%dQ" % len(self.chunk_ends), *self.chunk_ends)))
     super(VFSBlobImage, self).Flush()
 
   def AppendContent(self, src_fd):
@@ -811,6 +856,7 @@ class VFSBlobImage(VFSFile):
 
     Once a blob is added that is smaller than the chunksize we finalize the
     file, since handling adding more blobs makes the code much more complex.
+    Images with variable size chunks are never finalized.
 
     Args:
       blob_hash: sha256 binary digest
@@ -826,7 +872,9 @@ class VFSBlobImage(VFSFile):
     self.index.write(blob_hash)
     self.size += length
 
-    if length < self.chunksize:
+    if self.chunk_ends is not None:
+      self.chunk_ends.append(self.size)
+    elif length < self.chunksize:
       self.finalized = True
 
   def GetContentAge(self):
@@ -855,6 +903,10 @@ class VFSBlobImage(VFSFile):
                                "Once a blobimage is finalized, further writes"
                                " will raise exceptions.")
 
+    CHUNK_ENDS = aff4.Attribute("aff4:chunk_ends", rdfvalue.RDFBytes,
+                                "Packed end offsets of each chunk, only set "
+                                "if chunks vary in size.")
+
 
 class AFF4RekallProfile(aff4.AFF4Object):
   """A Rekall profile in the AFF4 namespace."""
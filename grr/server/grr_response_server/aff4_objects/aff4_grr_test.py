@@ -340,6 +340,27 @@ class BlobImageTest(aff4_test_lib.AFF4ObjectTest):
     dest_fd.Seek(0)
     self.assertEqual(dest_fd.Read(5000), src_content + src_content)
 
+  def testVariableSizeChunks(self):
+    blobs = ["A" * 3, "B" * 10, "C", "D" * 7, "E" * 2]
+    with aff4.FACTORY.Create(
+        "aff4:/foo", aff4_type=aff4_grr.VFSBlobImage, token=self.token) as fd:
+      fd.SetChunksize(10)
+      fd.EnableVariableSizeChunks()
+      for blob in blobs:
+        fd.AddBlob(data_store.DB.StoreBlob(blob, token=self.token).decode(
+            "hex"), len(blob))
+
+      self.assertFalse(fd.finalized)
+
+    content = "".join(blobs)
+    fd = aff4.FACTORY.Open("aff4:/foo", token=self.token)
+    self.assertEqual(fd.size, len(content))
+    self.assertEqual(fd.Read(100), content)
+
+    for offset in range(len(content)):
+      fd.Seek(offset)
+      self.assertEqual(fd.Read(5), content[offset:offset + 5])
+
   def testMultiStreamStreamsSingleFileWithSingleChunk(self):
     with aff4.FACTORY.Create(
         "aff4:/foo", aff4_type=aff4_grr.VFSBlobImage, token=self.token) as fd:
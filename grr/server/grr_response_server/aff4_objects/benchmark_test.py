@@ -2,6 +2,9 @@
 """This tests the performance of the AFF4 subsystem."""
 
 
+import os
+import StringIO
+
 import pytest
 
 from grr.lib import flags
@@ -9,6 +12,7 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server.aff4_objects import aff4_grr
+from grr.server.grr_response_server.aff4_objects import filestore
 from grr.test_lib import benchmark_test_lib
 from grr.test_lib import test_lib
 
@@ -101,6 +105,27 @@ class AFF4Benchmark(benchmark_test_lib.AverageMicroBenchmarks):
     self.TimeIt(
         ReadAVersionedAFF4Attribute, name="Read one versioned Attributes")
 
+  def testHashFileStoreAddFile(self):
+    """How long it takes to add a downloaded file to the hash file store."""
+    data = os.urandom(8 * 1024 * 1024)
+    urn = aff4.ROOT_URN.Add("C.1234567812345678/fs/os/blob_image")
+    with aff4.FACTORY.Create(
+        urn, aff4_grr.VFSBlobImage, token=self.token) as fd:
+      fd.SetChunksize(512 * 1024)
+      fd.AppendContent(StringIO.StringIO(data))
+
+    hash_file_store = aff4.FACTORY.Open(
+        filestore.HashFileStore.PATH,
+        filestore.HashFileStore,
+        mode="rw",
+        token=self.token)
+
+    def AddFile():
+      fd = aff4.FACTORY.Open(urn, mode="rw", token=self.token)
+      hash_file_store.AddFile(fd)
+
+    self.TimeIt(AddFile, name="AddFile 8MiB", repetitions=10)
+
 
 def main(argv):
   # Run the full test suite
@@ -274,21 +274,20 @@ class HashFileStore(FileStore):
     ]
 
   def _HashFile(self, fd):
-    """Look for the required hashes in the file."""
+    """Computes the hashes of the file content.
+
+    The file store is indexed by these hashes, so they are always computed on
+    the server. Hashes which were reported by the client and stored in the
+    HASH attribute are replaced, otherwise a client could make any content
+    show up under the hash of a different file.
+
+    Args:
+      fd: File open for reading.
+
+    Returns:
+      A Hash object with all hashes of the file.
+    """
     hashes = fd.Get(fd.Schema.HASH)
-    if hashes:
-      found_all = True
-      for fingerprint_type, hash_types in self.HASH_TYPES.iteritems():
-        for hash_type in hash_types:
-          if fingerprint_type == "pecoff":
-            hash_type = "pecoff_%s" % hash_type
-          if not hashes.HasField(hash_type):
-            found_all = False
-            break
-        if not found_all:
-          break
-      if found_all:
-        return hashes
 
     fingerprinter = fingerprint.Fingerprinter(fd)
     if "generic" in self.HASH_TYPES:
@@ -9,6 +9,7 @@ import time
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import utils
+from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
 from grr.lib.rdfvalues import paths as rdf_paths
 from grr.server.grr_response_server import aff4
@@ -398,6 +399,73 @@ class HashFileStoreTest(aff4_test_lib.AFF4ObjectTest):
         pathspec, client_id=self.client_id, token=self.token)
     self.assertEqual(len(self._GetBackRefs(filename)), 0)
 
+  def _AddBlobImage(self, data, hash_obj=None):
+    """Adds a downloaded file with the given hashes to the store."""
+    urn = self.client_id.Add("fs/os/blob_image")
+    with aff4.FACTORY.Create(
+        urn, aff4_grr.VFSBlobImage, token=self.token) as fd:
+      fd.SetChunksize(1024)
+      fd.AppendContent(StringIO.StringIO(data))
+      if hash_obj:
+        fd.Set(fd.Schema.HASH, hash_obj)
+
+    hash_file_store = aff4.FACTORY.Open(
+        filestore.HashFileStore.PATH,
+        filestore.HashFileStore,
+        mode="rw",
+        token=self.token)
+    with aff4.FACTORY.Open(urn, mode="rw", token=self.token) as fd:
+      hash_file_store.AddFile(fd)
+
+    fd = aff4.FACTORY.Open(urn, token=self.token)
+    return fd.Get(fd.Schema.HASH)
+
+  def testClientReportedHashesAreNotTrusted(self):
+    data = "Hello world" * 1000
+    other_data = "Some other file"
+    hash_obj = rdf_crypto.Hash(
+        md5=hashlib.md5(other_data).digest(),
+        sha1=hashlib.sha1(other_data).digest(),
+        sha256=hashlib.sha256(other_data).digest(),
+        num_bytes=len(data))
+
+    hashes = self._AddBlobImage(data, hash_obj=hash_obj)
+
+    # The hashes of the actual content replace the ones the client claimed.
+    self.assertEqual(hashes.md5, hashlib.md5(data).digest())
+    self.assertEqual(hashes.sha1, hashlib.sha1(data).digest())
+    self.assertEqual(hashes.sha256, hashlib.sha256(data).digest())
+
+    # The content is not indexed under the hash of the other file.
+    claimed_urn = filestore.HashFileStore.PATH.Add("generic/sha256").Add(
+        str(hash_obj.sha256))
+    self.assertFalse(list(aff4.FACTORY.Stat(claimed_urn)))
+    canonical_urn = filestore.HashFileStore.PATH.Add("generic/sha256").Add(
+        str(hashes.sha256))
+    self.assertTrue(list(aff4.FACTORY.Stat(canonical_urn)))
+
+  def testMissingHashesAreComputed(self):
+    data = "Hello world" * 1000
+    hashes = self._AddBlobImage(
+        data, hash_obj=rdf_crypto.Hash(sha256=hashlib.sha256(data).digest()))
+
+    self.assertEqual(hashes.md5, hashlib.md5(data).digest())
+    self.assertEqual(hashes.sha1, hashlib.sha1(data).digest())
+
+  def testPecoffHashesAreComputedForClientHashedFiles(self):
+    with open(os.path.join(self.base_path, "hello.exe"), "rb") as fd:
+      data = fd.read()
+
+    hash_obj = rdf_crypto.Hash(
+        md5=hashlib.md5(data).digest(),
+        sha1=hashlib.sha1(data).digest(),
+        sha256=hashlib.sha256(data).digest())
+    hashes = self._AddBlobImage(data, hash_obj=hash_obj)
+
+    self.assertEqual(hashes.sha256, hash_obj.sha256)
+    self.assertTrue(hashes.pecoff_md5)
+    self.assertTrue(hashes.pecoff_sha1)
+
   def _GetBackRefs(self, filename):
     res = []
     data = open(filename, "rb").read()
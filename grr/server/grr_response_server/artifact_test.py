@@ -158,6 +158,7 @@ class ArtifactTest(flow_test_lib.FlowTestsBaseclass):
         searching.Grep,
         server_stubs.WmiQuery,
         standard.HashBuffer,
+        standard.HashBufferManifest,
         standard.HashFile,
         standard.ListDirectory,
         standard.GetFileStat,
@@ -10,6 +10,7 @@ from grr.lib import utils
 from grr.lib.rdfvalues import client as rdf_client
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import data_store
+from grr.server.grr_response_server import foreman
 from grr.server.grr_response_server import keyword_index
 from grr.server.grr_response_server.aff4_objects import aff4_grr
 
@@ -305,6 +306,105 @@ def GetClientURNsForHostnames(hostnames, token=None):
   return result
 
 
+def LookupClientsForRuleSet(client_rule_set, token=None):
+  """Looks up the clients matching a foreman client rule set in the index.
+
+  Only OS and label rules can be answered using the index. The index
+  normalizes labels to lower case, so the result may contain some clients
+  that don't match the rule set exactly.
+
+  Args:
+    client_rule_set: A foreman.ForemanClientRuleSet.
+    token: An ACL token.
+
+  Returns:
+    A sorted list of client ids, or None if the rule set contains rules the
+    index can't answer.
+  """
+  set_modes = foreman.ForemanClientRuleSet.MatchMode
+  label_modes = foreman.ForemanLabelClientRule.MatchMode
+  rules = [rule.UnionCast() for rule in client_rule_set.rules]
+
+  # The universal keyword lists all clients, it is only read if needed.
+  needs_all_clients = not rules and client_rule_set.match_mode == (
+      set_modes.MATCH_ALL)
+  keywords = set()
+  for rule in rules:
+    if isinstance(rule, foreman.ForemanOsClientRule):
+      keywords.update(_OsKeywords(rule))
+    elif isinstance(rule, foreman.ForemanLabelClientRule):
+      keywords.update(_LabelKeyword(label) for label in rule.label_names)
+      if (rule.match_mode != label_modes.MATCH_ANY and
+          (rule.match_mode != label_modes.MATCH_ALL or not rule.label_names)):
+        needs_all_clients = True
+    else:
+      return None
+
+  if needs_all_clients:
+    keywords.add(".")
+
+  if data_store.RelationalDBReadEnabled():
+    index = ClientIndex()
+  else:
+    index = CreateClientIndex(token=token)
+  posting_lists = index.ReadClientPostingLists(sorted(keywords))
+
+  def Clients(keyword):
+    return set(posting_lists.get(keyword, []))
+
+  def Intersection(client_sets):
+    result = None
+    for client_set in client_sets:
+      result = client_set if result is None else result & client_set
+    return Clients(".") if result is None else result
+
+  def Union(client_sets):
+    return set().union(*client_sets)
+
+  rule_results = []
+  for rule in rules:
+    if isinstance(rule, foreman.ForemanOsClientRule):
+      rule_results.append(Union(Clients(k) for k in _OsKeywords(rule)))
+      continue
+
+    label_sets = [Clients(_LabelKeyword(label)) for label in rule.label_names]
+    if rule.match_mode == label_modes.MATCH_ALL:
+      rule_results.append(Intersection(label_sets))
+    elif rule.match_mode == label_modes.MATCH_ANY:
+      rule_results.append(Union(label_sets))
+    elif rule.match_mode == label_modes.DOES_NOT_MATCH_ALL:
+      rule_results.append(Clients(".") - Intersection(label_sets))
+    elif rule.match_mode == label_modes.DOES_NOT_MATCH_ANY:
+      rule_results.append(Clients(".") - Union(label_sets))
+    else:
+      raise ValueError("Unexpected match mode value: %s" % rule.match_mode)
+
+  if client_rule_set.match_mode == set_modes.MATCH_ALL:
+    result = Intersection(rule_results)
+  elif client_rule_set.match_mode == set_modes.MATCH_ANY:
+    result = Union(rule_results)
+  else:
+    raise ValueError(
+        "Unexpected match mode value: %s" % client_rule_set.match_mode)
+
+  return sorted(result)
+
+
+def _OsKeywords(os_rule):
+  keywords = []
+  if os_rule.os_windows:
+    keywords.append("windows")
+  if os_rule.os_linux:
+    keywords.append("linux")
+  if os_rule.os_darwin:
+    keywords.append("darwin")
+  return keywords
+
+
+def _LabelKeyword(label):
+  return "label:%s" % utils.SmartStr(label).lower()
+
+
 def GetMostRecentClient(client_list, token=None):
   """Return most recent client from list of clients."""
   last = rdfvalue.RDFDatetime(0)
@@ -11,6 +11,7 @@ from grr.lib.rdfvalues import objects
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import client_index
 from grr.server.grr_response_server import data_store
+from grr.server.grr_response_server import foreman
 from grr.server.grr_response_server.aff4_objects import aff4_grr
 from grr.test_lib import aff4_test_lib
 from grr.test_lib import test_lib
@@ -274,6 +275,62 @@ class AFF4ClientIndexTest(aff4_test_lib.AFF4ObjectTest):
         index.LookupClients(["label-1"]), [m[host] for host in hosts])
 
 
+  def testLookupClientsForRuleSet(self):
+    index = client_index.CreateClientIndex(token=self.token)
+
+    client_urns = self.SetupClients(3)
+    for urn, labels in zip(client_urns, [["foo"], ["foo", "bar"], []]):
+      client = aff4.FACTORY.Create(
+          urn, aff4_type=aff4_grr.VFSGRRClient, mode="rw", token=self.token)
+      for label in labels:
+        client.AddLabel(label)
+      client.Flush()
+      index.AddClient(client)
+    c0, c1, c2 = [urn.Basename() for urn in client_urns]
+
+    def Lookup(*rules, **kwargs):
+      rule_set = foreman.ForemanClientRuleSet(rules=rules, **kwargs)
+      return client_index.LookupClientsForRuleSet(rule_set, token=self.token)
+
+    def LabelRule(label_names, match_mode):
+      return foreman.ForemanClientRule(
+          rule_type=foreman.ForemanClientRule.Type.LABEL,
+          label=foreman.ForemanLabelClientRule(
+              label_names=label_names, match_mode=match_mode))
+
+    def OsRule(**kwargs):
+      return foreman.ForemanClientRule(
+          rule_type=foreman.ForemanClientRule.Type.OS,
+          os=foreman.ForemanOsClientRule(**kwargs))
+
+    label_modes = foreman.ForemanLabelClientRule.MatchMode
+    self.assertEqual(Lookup(), [c0, c1, c2])
+    self.assertEqual(
+        Lookup(LabelRule(["foo"], label_modes.MATCH_ANY)), [c0, c1])
+    self.assertEqual(
+        Lookup(LabelRule(["foo", "bar"], label_modes.MATCH_ALL)), [c1])
+    self.assertEqual(
+        Lookup(LabelRule(["bar"], label_modes.DOES_NOT_MATCH_ANY)), [c0, c2])
+    self.assertEqual(
+        Lookup(OsRule(os_linux=True), LabelRule(["foo"],
+                                                label_modes.MATCH_ANY)),
+        [c0, c1])
+    self.assertEqual(Lookup(OsRule(os_windows=True)), [])
+    self.assertEqual(
+        Lookup(
+            OsRule(os_windows=True),
+            LabelRule(["bar"], label_modes.MATCH_ANY),
+            match_mode=foreman.ForemanClientRuleSet.MatchMode.MATCH_ANY),
+        [c1])
+
+    # Regex rules can't be answered from the index.
+    self.assertIsNone(
+        Lookup(
+            foreman.ForemanClientRule(
+                rule_type=foreman.ForemanClientRule.Type.REGEX,
+                regex=foreman.ForemanRegexClientRule(
+                    field="CLIENT_NAME", attribute_regex="GRR"))))
+
 class ClientIndexTest(aff4_test_lib.AFF4ObjectTest):
 
   def testAnalyzeClient(self):
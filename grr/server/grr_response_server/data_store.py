@@ -40,7 +40,9 @@ import collections
 import logging
 import random
 import sys
+import threading
 import time
+import zlib
 
 from grr import config
 from grr.lib import flags
@@ -49,6 +51,7 @@ from grr.lib import registry
 from grr.lib import stats
 from grr.lib import utils
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import structs as rdf_structs
 from grr.server.grr_response_server import access_control
 from grr.server.grr_response_server import blob_store
 from grr.server.grr_response_server import db
@@ -146,6 +149,18 @@ def GetDefaultToken(token):
 Record = collections.namedtuple(
     "Record", ["queue_id", "timestamp", "suffix", "subpath", "value"])
 
+# A block of collection items which is written as a single row. The records of
+# a block are stored at timestamp and have consecutive suffixes starting with
+# first_suffix.
+_CollectionBlock = collections.namedtuple(
+    "_CollectionBlock",
+    ["collection_id", "timestamp", "first_suffix", "items", "common_fields"])
+
+# The number of records added to a collection through one mutation pool flush.
+# The delta is named after the first of these records.
+_CollectionCountDelta = collections.namedtuple(
+    "_CollectionCountDelta", ["collection_id", "timestamp", "suffix", "count"])
+
 
 class MutationPool(object):
   """A mutation pool.
@@ -165,6 +180,12 @@ class MutationPool(object):
 
     self.new_notifications = []
 
+    # Maps collection ids to the block of items currently being filled.
+    self.collection_blocks = {}
+
+    # Maps collection ids to the number of records added to them.
+    self.collection_count_deltas = {}
+
   def DeleteSubjects(self, subjects):
     self.delete_subject_requests.extend(subjects)
 
@@ -188,25 +209,23 @@ class MutationPool(object):
 
   def Flush(self):
     """Flushing actually applies all the operations in the pool."""
-    DB.DeleteSubjects(self.delete_subject_requests, sync=False)
-
-    for req in self.delete_attributes_requests:
-      subject, attributes, start, end = req
-      DB.DeleteAttributes(subject, attributes, start=start, end=end, sync=False)
-
-    for req in self.set_requests:
-      subject, values, timestamp, replace, to_delete = req
-      DB.MultiSet(
-          subject,
-          values,
-          timestamp=timestamp,
-          replace=replace,
-          to_delete=to_delete,
-          sync=False)
+    for block in self.collection_blocks.itervalues():
+      self._WriteCollectionBlock(block)
+    self.collection_blocks = {}
+
+    for delta in self.collection_count_deltas.itervalues():
+      self.Set(
+          delta.collection_id,
+          DataStore.CollectionCountDeltaAttribute(delta.timestamp,
+                                                  delta.suffix),
+          delta.count,
+          timestamp=0)
+    self.collection_count_deltas = {}
 
     if (self.delete_subject_requests or self.delete_attributes_requests or
         self.set_requests):
-      DB.Flush()
+      DB.ApplyMutations(self.delete_subject_requests,
+                        self.delete_attributes_requests, self.set_requests)
 
     for queue, notifications in self.new_notifications:
       DB.CreateNotifications(queue, notifications)
@@ -223,8 +242,9 @@ class MutationPool(object):
     self.Flush()
 
   def Size(self):
-    return (len(self.delete_subject_requests) + len(self.set_requests) + len(
-        self.delete_attributes_requests))
+    return (len(self.delete_subject_requests) + len(self.set_requests) +
+            len(self.delete_attributes_requests) + len(self.collection_blocks) +
+            len(self.collection_count_deltas))
 
   # Notification handling
   def CreateNotifications(self, queue, notifications):
@@ -247,6 +267,55 @@ class MutationPool(object):
         replace=replace)
     return result_subject, timestamp, suffix
 
+  def CollectionAddBlockItem(self, collection_id, item, common_fields=False):
+    """Adds an item to the compressed block written for the collection.
+
+    Items added to the same collection are stored together in blocks of up to
+    COLLECTION_BLOCK_SIZE items which are written when the pool is flushed. All
+    items of a block share the block's timestamp and get consecutive suffixes
+    so they can still be addressed individually.
+
+    Args:
+      collection_id: The collection to add the item to.
+      item: The rdf value to add.
+      common_fields: If True, the items are protobufs and fields which are the
+        same in all items of a block are only stored once.
+
+    Returns:
+      A tuple (block_subject, timestamp, suffix).
+    """
+    key = utils.SmartStr(collection_id)
+    block = self.collection_blocks.get(key)
+    if block is None:
+      first_suffix = random.randint(
+          1, DataStore.COLLECTION_MAX_SUFFIX //
+          DataStore.COLLECTION_BLOCK_SIZE) * DataStore.COLLECTION_BLOCK_SIZE
+      block = _CollectionBlock(
+          collection_id=collection_id,
+          timestamp=rdfvalue.RDFDatetime.Now().AsMicrosecondsSinceEpoch(),
+          first_suffix=first_suffix,
+          items=[],
+          common_fields=common_fields)
+      self.collection_blocks[key] = block
+
+    suffix = block.first_suffix + len(block.items)
+    block.items.append(item.SerializeToString())
+    if len(block.items) >= DataStore.COLLECTION_BLOCK_SIZE:
+      self._WriteCollectionBlock(self.collection_blocks.pop(key))
+
+    block_subject = DataStore.CollectionBlockURN(collection_id, block.timestamp,
+                                                 suffix)
+    return block_subject, block.timestamp, suffix
+
+  def _WriteCollectionBlock(self, block):
+    self.Set(
+        DataStore.CollectionBlockURN(block.collection_id, block.timestamp,
+                                     block.first_suffix),
+        DataStore.COLLECTION_BLOCK_ATTRIBUTE,
+        DataStore.CollectionPackBlock(
+            block.items, common_fields=block.common_fields),
+        timestamp=block.timestamp)
+
   def CollectionAddIndex(self, collection_id, index, timestamp, suffix):
     self.Set(
         collection_id,
@@ -262,13 +331,53 @@ class MutationPool(object):
         1,
         timestamp=0)
 
+  def CollectionAddCountDelta(self, collection_id, timestamp, suffix):
+    """Counts a record added to the collection.
+
+    All records counted for a collection until the pool is flushed are stored
+    as a single delta which is named after the first of them.
+
+    Args:
+      collection_id: The collection the record was added to.
+      timestamp: The timestamp of the record.
+      suffix: The suffix of the record.
+    """
+    key = utils.SmartStr(collection_id)
+    delta = self.collection_count_deltas.get(key)
+    if delta is None:
+      delta = _CollectionCountDelta(
+          collection_id=collection_id,
+          timestamp=timestamp,
+          suffix=suffix,
+          count=0)
+    self.collection_count_deltas[key] = delta._replace(count=delta.count + 1)
+
+  def CollectionMergeCount(self, collection_id, count, deltas):
+    """Stores a merged counter and removes the deltas it includes."""
+    self.MultiSet(
+        collection_id, {DataStore.COLLECTION_COUNT_ATTRIBUTE: [count]},
+        timestamp=0,
+        to_delete=[
+            DataStore.CollectionCountDeltaAttribute(timestamp, suffix)
+            for timestamp, suffix, _ in deltas
+        ])
+
   def CollectionDelete(self, collection_id):
-    for subject, _, _ in DB.ScanAttribute(
-        collection_id.Add("Results"), DataStore.COLLECTION_ATTRIBUTE):
+    for subject, _ in DB.ScanAttributes(
+        collection_id.Add("Results"),
+        [DataStore.COLLECTION_ATTRIBUTE, DataStore.COLLECTION_BLOCK_ATTRIBUTE]):
       self.DeleteSubject(subject)
       if self.Size() > 50000:
         self.Flush()
 
+    _, deltas = DB.CollectionReadCount(collection_id)
+    self.DeleteAttributes(collection_id, [
+        DataStore.COLLECTION_COUNT_ATTRIBUTE
+    ] + [
+        DataStore.CollectionCountDeltaAttribute(timestamp, suffix)
+        for timestamp, suffix, _ in deltas
+    ])
+
   def QueueAddItem(self, queue_id, item, timestamp):
     result_subject, timestamp, _ = DataStore.CollectionMakeURN(
         queue_id, timestamp, suffix=None, subpath="Records")
@@ -747,6 +856,36 @@ class DataStore(object):
       self.DeleteAttributes(
           subject, attributes, start=start, end=end, sync=sync)
 
+  def ApplyMutations(self, delete_subjects, delete_attributes, set_requests):
+    """Applies the operations collected by a MutationPool.
+
+    Data stores which can combine writes across subjects should override this
+    to apply all the operations with as few round trips as possible.
+
+    Args:
+      delete_subjects: A list of subjects to delete.
+      delete_attributes: A list of (subject, attributes, start, end) tuples, as
+        passed to DeleteAttributes().
+      set_requests: A list of (subject, values, timestamp, replace, to_delete)
+        tuples, as passed to MultiSet().
+    """
+    self.DeleteSubjects(delete_subjects, sync=False)
+
+    for subject, attributes, start, end in delete_attributes:
+      self.DeleteAttributes(
+          subject, attributes, start=start, end=end, sync=False)
+
+    for subject, values, timestamp, replace, to_delete in set_requests:
+      self.MultiSet(
+          subject,
+          values,
+          timestamp=timestamp,
+          replace=replace,
+          to_delete=to_delete,
+          sync=False)
+
+    self.Flush()
+
   @abc.abstractmethod
   def DeleteAttributes(self,
                        subject,
@@ -1351,6 +1490,14 @@ class DataStore(object):
   # The attribute (column) where we store value.
   COLLECTION_ATTRIBUTE = "aff4:sequential_value"
 
+  # The attribute (column) where we store compressed blocks of values. A block
+  # is stored at the urn of the largest suffix it could hold so that scanning
+  # after any of its records finds it.
+  COLLECTION_BLOCK_ATTRIBUTE = "aff4:sequential_block"
+
+  # The maximum number of values in a block, must be a power of 2.
+  COLLECTION_BLOCK_SIZE = 0x100
+
   # An attribute name of the form "index:sc_<i>" at timestamp <t> indicates that
   # the item with record number i was stored at timestamp t. The timestamp
   # suffix is stored as the value.
@@ -1360,6 +1507,17 @@ class DataStore(object):
   # for multi type collections.
   COLLECTION_VALUE_TYPE_PREFIX = "aff4:value_type_"
 
+  # The attribute holding the number of records in a collection at the time
+  # the counter was last merged.
+  COLLECTION_COUNT_ATTRIBUTE = "index:count"
+
+  # An attribute of the form "index:count_delta_<timestamp>.<suffix>" holds
+  # the number of records which one mutation pool flush added after the
+  # counter was last merged, starting with the record with this timestamp and
+  # suffix. Every flush gets its own attribute so that concurrent writers never
+  # update the same value.
+  COLLECTION_COUNT_DELTA_PREFIX = COLLECTION_COUNT_ATTRIBUTE + "_delta_"
+
   # The attribute where we store locks. A lock is a timestamp indicating when
   # the lock becomes stale at the record may be claimed again.
   QUEUE_LOCK_ATTRIBUTE = "aff4:lease"
@@ -1378,6 +1536,92 @@ class DataStore(object):
     result_urn = urn.Add(subpath).Add("%016x.%06x" % (timestamp, suffix))
     return (result_urn, timestamp, suffix)
 
+  @classmethod
+  def CollectionBlockURN(cls, urn, timestamp, suffix):
+    """Returns the urn of the block holding the record (timestamp, suffix)."""
+    return cls.CollectionMakeURN(
+        urn, timestamp, suffix=suffix | (cls.COLLECTION_BLOCK_SIZE - 1))[0]
+
+  @classmethod
+  def CollectionPackBlock(cls, serialized_items, common_fields=False):
+    """Packs serialized collection items into a compressed block.
+
+    Args:
+      serialized_items: A list of serialized items.
+      common_fields: If True, the items are serialized protobufs. Top level
+        fields which have the same value in all items are moved into a header
+        which is stored only once.
+
+    Returns:
+      The packed block.
+    """
+    header = ""
+    if common_fields and len(serialized_items) > 1:
+      header, serialized_items = cls._CollectionSplitCommonFields(
+          serialized_items)
+
+    parts = [rdf_structs.VarintEncode(len(header)), header]
+    for serialized in serialized_items:
+      parts.append(rdf_structs.VarintEncode(len(serialized)))
+      parts.append(serialized)
+    return zlib.compress("".join(parts))
+
+  @classmethod
+  def _CollectionSplitCommonFields(cls, serialized_items):
+    """Splits the fields all serialized protobufs share into a header."""
+    items_fields = []
+    common = None
+    for serialized in serialized_items:
+      fields = [(tag, tag + length + data)
+                for tag, length, data in rdf_structs.SplitBuffer(serialized)]
+      items_fields.append(fields)
+
+      # Only fields occurring once per item can be merged back unchanged.
+      tag_counts = collections.Counter(tag for tag, _ in fields)
+      single_fields = set(
+          field for field in fields if tag_counts[field[0]] == 1)
+      if common is None:
+        common = single_fields
+      else:
+        common &= single_fields
+
+    common_tags = set(tag for tag, _ in common)
+    header = "".join(raw for tag, raw in items_fields[0] if tag in common_tags)
+    stripped_items = [
+        "".join(raw for tag, raw in item_fields if tag not in common_tags)
+        for item_fields in items_fields
+    ]
+    return header, stripped_items
+
+  @classmethod
+  def CollectionUnpackBlock(cls, block_suffix, block):
+    """Unpacks a block created by CollectionPackBlock.
+
+    Args:
+      block_suffix: The suffix of the urn the block is stored at.
+      block: The packed block.
+
+    Yields:
+      Pairs (suffix, serialized_item).
+    """
+    data = zlib.decompress(block)
+    length, pos = rdf_structs.VarintReader(data, 0)
+    header = data[pos:pos + length]
+    pos += length
+
+    suffix = block_suffix & ~(cls.COLLECTION_BLOCK_SIZE - 1)
+    while pos < len(data):
+      length, pos = rdf_structs.VarintReader(data, pos)
+      # Parsing the concatenation of two protobufs merges them.
+      yield suffix, header + data[pos:pos + length]
+      pos += length
+      suffix += 1
+
+  @classmethod
+  def CollectionCountDeltaAttribute(cls, timestamp, suffix):
+    return cls.COLLECTION_COUNT_DELTA_PREFIX + "%016x.%06x" % (timestamp,
+                                                               suffix)
+
   @classmethod
   def QueueTaskIdToColumn(cls, task_id):
     """Return a predicate representing the given task."""
@@ -1390,23 +1634,44 @@ class DataStore(object):
                           after_suffix=None,
                           limit=None):
     after_urn = None
+    after_record = None
+    max_records = limit
     if after_timestamp:
+      after_record = (after_timestamp, after_suffix or
+                      self.COLLECTION_MAX_SUFFIX)
       after_urn = utils.SmartStr(
           self.CollectionMakeURN(
-              collection_id,
-              after_timestamp,
-              suffix=after_suffix or self.COLLECTION_MAX_SUFFIX)[0])
+              collection_id, after_timestamp, suffix=after_record[1])[0])
+      if limit:
+        # The first block might only hold records up to after_record.
+        max_records = limit + 1
 
-    for subject, timestamp, serialized_rdf_value in self.ScanAttribute(
+    count = 0
+    for subject, values in self.ScanAttributes(
         collection_id.Add("Results"),
-        self.COLLECTION_ATTRIBUTE,
+        [self.COLLECTION_ATTRIBUTE, self.COLLECTION_BLOCK_ATTRIBUTE],
         after_urn=after_urn,
-        max_records=limit):
-      item = rdf_type.FromSerializedString(serialized_rdf_value)
-      item.age = timestamp
+        max_records=max_records):
       # The urn is timestamp.suffix where suffix is 6 hex digits.
       suffix = int(str(subject)[-6:], 16)
-      yield (item, timestamp, suffix)
+      if self.COLLECTION_ATTRIBUTE in values:
+        timestamp, serialized_rdf_value = values[self.COLLECTION_ATTRIBUTE]
+        records = [(suffix, serialized_rdf_value)]
+      else:
+        timestamp, block = values[self.COLLECTION_BLOCK_ATTRIBUTE]
+        records = self.CollectionUnpackBlock(suffix, block)
+
+      for suffix, serialized_rdf_value in records:
+        if after_record is not None and (timestamp, suffix) <= after_record:
+          continue
+
+        item = rdf_type.FromSerializedString(serialized_rdf_value)
+        item.age = timestamp
+        yield (item, timestamp, suffix)
+
+        count += 1
+        if limit and count >= limit:
+          return
 
   def CollectionReadIndex(self, collection_id):
     """Reads all index entries for the given collection.
@@ -1423,19 +1688,77 @@ class DataStore(object):
       i = int(attr[len(self.COLLECTION_INDEX_ATTRIBUTE_PREFIX):], 16)
       yield (i, ts, int(value, 16))
 
+  def CollectionReadCount(self, collection_id):
+    """Reads the record counter of the given collection.
+
+    Args:
+      collection_id: ID of the collection for which the counter should be
+                     retrieved.
+
+    Returns:
+      A tuple (count, deltas) where count is the number of records at the time
+      the counter was last merged (None if the counter was never merged) and
+      deltas is a list of (timestamp, suffix, count) tuples. Each of them
+      stands for count records added since, the first of which has the given
+      timestamp and suffix.
+    """
+    count = None
+    deltas = []
+    for (attr, value, _) in self.ResolvePrefix(
+        collection_id, self.COLLECTION_COUNT_ATTRIBUTE):
+      if attr == self.COLLECTION_COUNT_ATTRIBUTE:
+        count = int(value)
+      else:
+        timestamp, suffix = attr[len(self.COLLECTION_COUNT_DELTA_PREFIX):].split(
+            ".")
+        deltas.append((int(timestamp, 16), int(suffix, 16), int(value)))
+
+    return count, deltas
+
   def CollectionReadStoredTypes(self, collection_id):
     for attribute, _, _ in self.ResolveRow(collection_id):
       if attribute.startswith(self.COLLECTION_VALUE_TYPE_PREFIX):
         yield attribute[len(self.COLLECTION_VALUE_TYPE_PREFIX):]
 
   def CollectionReadItems(self, records):
-    for _, v in self.MultiResolvePrefix([
-        DataStore.CollectionMakeURN(record.queue_id, record.timestamp,
-                                    record.suffix, record.subpath)[0]
-        for record in records
-    ], DataStore.COLLECTION_ATTRIBUTE):
-      _, value, timestamp = v[0]
-      yield (value, timestamp)
+    """Reads the serialized values of the given records.
+
+    Args:
+      records: A list of Record objects.
+
+    Yields:
+      Pairs (serialized_value, timestamp).
+    """
+    # Each record is either stored in its own row or as part of a block.
+    record_subjects = set()
+    block_suffixes = {}
+    for record in records:
+      record_subjects.add(
+          utils.SmartStr(
+              DataStore.CollectionMakeURN(record.queue_id, record.timestamp,
+                                          record.suffix, record.subpath)[0]))
+      block_subject = DataStore.CollectionMakeURN(
+          record.queue_id,
+          record.timestamp,
+          record.suffix | (self.COLLECTION_BLOCK_SIZE - 1),
+          subpath=record.subpath)[0]
+      block_suffixes.setdefault(utils.SmartStr(block_subject),
+                                set()).add(record.suffix)
+
+    for subject, v in self.MultiResolvePrefix(
+        list(record_subjects | set(block_suffixes)),
+        [DataStore.COLLECTION_ATTRIBUTE, DataStore.COLLECTION_BLOCK_ATTRIBUTE]):
+      subject = utils.SmartStr(subject)
+      for attribute, value, timestamp in v:
+        if attribute == DataStore.COLLECTION_ATTRIBUTE:
+          if subject in record_subjects:
+            yield (value, timestamp)
+        elif subject in block_suffixes:
+          suffixes = block_suffixes[subject]
+          for suffix, serialized in self.CollectionUnpackBlock(
+              int(subject[-6:], 16), value):
+            if suffix in suffixes:
+              yield (serialized, timestamp)
 
   def QueueQueryTasks(self, queue, limit=1):
     """Retrieves tasks from a queue without leasing them.
@@ -1582,6 +1905,236 @@ class DataStore(object):
       yield (subject, children)
 
 
+class CachingDataStore(object):
+  """A read-through cache for the attributes of a data store.
+
+  Results of ResolvePrefix() and MultiResolvePrefix() are cached per subject
+  and attribute prefix. Writes through this object invalidate the subjects
+  they touch. Writes made by other processes (and writes a data store makes
+  internally, e.g. in StoreRequestsAndResponses()) are not seen, so entries
+  expire after max_age seconds.
+
+  Only reads of the newest or all versions of attributes are cached. Reads of
+  a timestamp range usually end at the current time so they never repeat, and
+  queue, lease and flow state attributes change too often to be worth caching.
+  These reads go to the wrapped data store directly.
+
+  All other methods are passed through to the wrapped data store.
+  """
+
+  CACHED_TIMESTAMPS = frozenset(
+      [None, DataStore.NEWEST_TIMESTAMP, DataStore.ALL_TIMESTAMPS])
+
+  UNCACHED_ATTRIBUTE_PREFIXES = (
+      DataStore.QUEUE_TASK_PREDICATE_PREFIX,
+      DataStore.QUEUE_LOCK_ATTRIBUTE,
+      DataStore.LEASE_ATTRIBUTE,
+      DataStore.NOTIFY_PREDICATE_PREFIX,
+      "flow:",
+      DataStore.COLLECTION_COUNT_ATTRIBUTE,
+  )
+
+  def __init__(self, delegate, max_size=10000, max_age=10):
+    self.delegate = delegate
+    self.lock = threading.RLock()
+    # Maps subjects to a dict of (attribute_prefix, timestamp, limit) to
+    # resolved values. Entries expire max_age seconds after the subject was
+    # first cached.
+    self.cache = utils.AgeBasedCache(max_size=max_size, max_age=max_age)
+    # Incremented on every invalidation so results read concurrently with a
+    # write are not cached.
+    self.generation = 0
+
+  def __getattr__(self, name):
+    return getattr(self.delegate, name)
+
+  def _IsCached(self, attribute_prefix, timestamp):
+    if isinstance(timestamp, list) or timestamp not in self.CACHED_TIMESTAMPS:
+      return False
+
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+    for prefix in attribute_prefix:
+      # An empty prefix reads the whole row, including volatile attributes.
+      if not prefix or prefix.startswith(self.UNCACHED_ATTRIBUTE_PREFIXES):
+        return False
+
+    return True
+
+  def _CacheKey(self, attribute_prefix, timestamp, limit):
+    if isinstance(attribute_prefix, basestring):
+      attribute_prefix = [attribute_prefix]
+    if isinstance(timestamp, list):
+      timestamp = tuple(timestamp)
+
+    return (tuple(attribute_prefix), timestamp, limit)
+
+  def _Lookup(self, subject, key):
+    try:
+      values = self.cache.Get(subject)[key]
+    except KeyError:
+      stats.STATS.IncrementCounter("datastore_cache_misses")
+      return None
+
+    stats.STATS.IncrementCounter("datastore_cache_hits")
+    return list(values)
+
+  @utils.Synchronized
+  def _Store(self, subject, key, values, generation):
+    if generation != self.generation:
+      return
+
+    try:
+      entries = self.cache.Get(subject)
+    except KeyError:
+      entries = {}
+      self.cache.Put(subject, entries)
+
+    entries[key] = list(values)
+
+  @utils.Synchronized
+  def _Invalidate(self, subjects):
+    self.generation += 1
+    for subject in subjects:
+      self.cache.ExpireObject(utils.SmartUnicode(subject))
+
+  def ClearTestDB(self):
+    self.cache.Flush()
+    self.delegate.ClearTestDB()
+
+  def ResolvePrefix(self, subject, attribute_prefix, timestamp=None,
+                    limit=None):
+    if not self._IsCached(attribute_prefix, timestamp):
+      return self.delegate.ResolvePrefix(
+          subject, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    unicode_subject = utils.SmartUnicode(subject)
+    key = self._CacheKey(attribute_prefix, timestamp, limit)
+    values = self._Lookup(unicode_subject, key)
+    if values is None:
+      generation = self.generation
+      values = self.delegate.ResolvePrefix(
+          subject, attribute_prefix, timestamp=timestamp, limit=limit)
+      self._Store(unicode_subject, key, values, generation)
+
+    return values
+
+  def MultiResolvePrefix(self,
+                         subjects,
+                         attribute_prefix,
+                         timestamp=None,
+                         limit=None):
+    # The limit applies to all subjects together, so these results can not be
+    # cached per subject.
+    if limit or not self._IsCached(attribute_prefix, timestamp):
+      return self.delegate.MultiResolvePrefix(
+          subjects, attribute_prefix, timestamp=timestamp, limit=limit)
+
+    key = self._CacheKey(attribute_prefix, timestamp, limit)
+    results = {}
+    missing = {}
+    for subject in subjects:
+      unicode_subject = utils.SmartUnicode(subject)
+      values = self._Lookup(unicode_subject, key)
+      if values is None:
+        missing[unicode_subject] = subject
+      elif values:
+        results[subject] = values
+
+    if missing:
+      generation = self.generation
+      fetched = dict((utils.SmartUnicode(subject), values)
+                     for subject, values in self.delegate.MultiResolvePrefix(
+                         missing.values(), attribute_prefix,
+                         timestamp=timestamp))
+
+      for unicode_subject, subject in missing.iteritems():
+        values = fetched.get(unicode_subject, [])
+        self._Store(unicode_subject, key, values, generation)
+        if values:
+          results[subject] = values
+
+    return results.iteritems()
+
+  def Set(self,
+          subject,
+          attribute,
+          value,
+          timestamp=None,
+          replace=True,
+          sync=True):
+    self._Invalidate([subject])
+    self.delegate.Set(
+        subject,
+        attribute,
+        value,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync)
+    self._Invalidate([subject])
+
+  def MultiSet(self,
+               subject,
+               values,
+               timestamp=None,
+               replace=True,
+               sync=True,
+               to_delete=None):
+    self._Invalidate([subject])
+    self.delegate.MultiSet(
+        subject,
+        values,
+        timestamp=timestamp,
+        replace=replace,
+        sync=sync,
+        to_delete=to_delete)
+    self._Invalidate([subject])
+
+  def DeleteAttributes(self,
+                       subject,
+                       attributes,
+                       start=None,
+                       end=None,
+                       sync=True):
+    self._Invalidate([subject])
+    self.delegate.DeleteAttributes(
+        subject, attributes, start=start, end=end, sync=sync)
+    self._Invalidate([subject])
+
+  def MultiDeleteAttributes(self,
+                            subjects,
+                            attributes,
+                            start=None,
+                            end=None,
+                            sync=True):
+    subjects = list(subjects)
+    self._Invalidate(subjects)
+    self.delegate.MultiDeleteAttributes(
+        subjects, attributes, start=start, end=end, sync=sync)
+    self._Invalidate(subjects)
+
+  def DeleteSubject(self, subject, sync=False):
+    self._Invalidate([subject])
+    self.delegate.DeleteSubject(subject, sync=sync)
+    self._Invalidate([subject])
+
+  def DeleteSubjects(self, subjects, sync=False):
+    subjects = list(subjects)
+    self._Invalidate(subjects)
+    self.delegate.DeleteSubjects(subjects, sync=sync)
+    self._Invalidate(subjects)
+
+  def ApplyMutations(self, delete_subjects, delete_attributes, set_requests):
+    subjects = list(delete_subjects)
+    subjects.extend(request[0] for request in delete_attributes)
+    subjects.extend(request[0] for request in set_requests)
+
+    self._Invalidate(subjects)
+    self.delegate.ApplyMutations(delete_subjects, delete_attributes,
+                                 set_requests)
+    self._Invalidate(subjects)
+
+
 class DBSubjectLock(object):
   """Provide a simple subject lock using the database.
 
@@ -1683,6 +2236,11 @@ class DataStoreInit(registry.InitHook):
 
     DB = cls()  # pylint: disable=g-bad-name
     DB.Initialize()
+    if config.CONFIG["Datastore.cache_size"]:
+      DB = CachingDataStore(  # pylint: disable=g-bad-name
+          DB,
+          max_size=config.CONFIG["Datastore.cache_size"],
+          max_age=config.CONFIG["Datastore.cache_max_age"])
     atexit.register(DB.Flush)
     monitor_port = config.CONFIG["Monitoring.http_port"]
     if monitor_port != 0:
@@ -1709,3 +2267,5 @@ class DataStoreInit(registry.InitHook):
     """Initialize some Varz."""
     stats.STATS.RegisterCounterMetric("grr_commit_failure")
     stats.STATS.RegisterCounterMetric("datastore_retries")
+    stats.STATS.RegisterCounterMetric("datastore_cache_hits")
+    stats.STATS.RegisterCounterMetric("datastore_cache_misses")
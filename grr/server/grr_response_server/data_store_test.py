@@ -1331,9 +1331,11 @@ class DataStoreTestMixin(object):
   def testApi(self):
     # pyformat: disable
     api = [
+        "ApplyMutations",
         "BlobExists",
         "BlobsExist",
         "CheckRequestsForCompletion",
+        "CollectionReadCount",
         "CollectionReadIndex",
         "CollectionReadStoredTypes",
         "CollectionScanItems",
@@ -1377,9 +1379,12 @@ class DataStoreTestMixin(object):
     ]
 
     pool_api = [
+        "CollectionAddBlockItem",
+        "CollectionAddCountDelta",
         "CollectionAddIndex",
         "CollectionAddItem",
         "CollectionAddStoredTypeIndex",
+        "CollectionMergeCount",
         "CreateNotifications",
         "DeleteAttributes",
         "DeleteSubject",
@@ -1470,6 +1475,37 @@ class DataStoreTestMixin(object):
     self.assertEqual(stored, "hello")
     self.assertEqual(type(stored), str)
 
+  @DeletionTest
+  def testPoolMutationsAcrossSubjects(self):
+    rows = ["aff4:/row:%d" % i for i in range(5)]
+    for row in rows:
+      data_store.DB.Set(row, "metadata:predicate", "old")
+      data_store.DB.Set(row, "metadata:other", "other")
+
+    pool = data_store.DB.GetMutationPool()
+    pool.DeleteSubject(rows[0])
+    pool.DeleteAttributes(rows[1], ["metadata:other"])
+    for row in rows[1:]:
+      pool.Set(row, "metadata:predicate", "new")
+      pool.Set(row, "metadata:appended", "a", timestamp=1, replace=False)
+      pool.Set(row, "metadata:appended", "b", timestamp=2, replace=False)
+    pool.MultiSet(rows[2], {}, to_delete=["metadata:other"])
+    pool.Flush()
+
+    self.assertEqual(data_store.DB.ResolvePrefix(rows[0], "metadata:"), [])
+    for row in rows[1:]:
+      values = data_store.DB.ResolveMulti(
+          row, ["metadata:predicate"], timestamp=data_store.DB.ALL_TIMESTAMPS)
+      self.assertEqual([v for _, v, _ in values], ["new"])
+
+      values = data_store.DB.ResolveMulti(
+          row, ["metadata:appended"], timestamp=data_store.DB.ALL_TIMESTAMPS)
+      self.assertEqual(sorted(v for _, v, _ in values), ["a", "b"])
+
+    for row, expected in [(rows[1], None), (rows[2], None), (rows[3], "other")]:
+      stored, _ = data_store.DB.Resolve(row, "metadata:other")
+      self.assertEqual(stored, expected)
+
   @DeletionTest
   def testPoolDeleteAttributes(self):
     predicate = "metadata:predicate"
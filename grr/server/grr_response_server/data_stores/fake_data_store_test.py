@@ -1,8 +1,13 @@
 #!/usr/bin/env python
 """Tests the fake data store - in memory implementation."""
 
+import time
 
 from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import stats
+from grr.lib import utils
+from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import data_store_test
 from grr.test_lib import test_lib
 
@@ -15,6 +20,106 @@ class FakeDataStoreTest(data_store_test.DataStoreTestMixin,
     """The fake datastore doesn't strictly conform to the api but this is ok."""
 
 
+class CachingFakeDataStoreTest(data_store_test.DataStoreTestMixin,
+                               test_lib.GRRBaseTest):
+  """Test the attribute cache wrapped around the fake data store."""
+
+  def setUp(self):
+    db_stubber = utils.Stubber(data_store, "DB",
+                               data_store.CachingDataStore(data_store.DB))
+    db_stubber.Start()
+    self.addCleanup(db_stubber.Stop)
+
+    super(CachingFakeDataStoreTest, self).setUp()
+
+  def testApi(self):
+    """The fake datastore doesn't strictly conform to the api but this is ok."""
+
+  def testLockRetryWrapperTemporaryFailure(self):
+    """Mocking DBSubjectLock on the cache does not affect the delegate."""
+
+  def _CacheCounters(self):
+    return (stats.STATS.GetMetricValue("datastore_cache_hits"),
+            stats.STATS.GetMetricValue("datastore_cache_misses"))
+
+  def testRepeatedReadsAreCached(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello")
+
+    hits, misses = self._CacheCounters()
+    for _ in range(3):
+      values = data_store.DB.ResolvePrefix(self.test_row, "metadata:")
+      self.assertEqual([v for _, v, _ in values], ["hello"])
+
+    self.assertEqual(self._CacheCounters(), (hits + 2, misses + 1))
+
+  def testMultiResolvePrefixOnlyFetchesMissingSubjects(self):
+    rows = ["aff4:/row:%d" % i for i in range(3)]
+    for row in rows:
+      data_store.DB.Set(row, "metadata:predicate", row)
+
+    data_store.DB.ResolvePrefix(rows[0], ["metadata:"])
+
+    hits, misses = self._CacheCounters()
+    results = dict(data_store.DB.MultiResolvePrefix(rows, "metadata:"))
+    self.assertEqual(sorted(results), rows)
+    self.assertEqual(self._CacheCounters(), (hits + 1, misses + 2))
+
+  def testWritesInvalidateTheCache(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello")
+    data_store.DB.ResolvePrefix(self.test_row, "metadata:")
+
+    with data_store.DB.GetMutationPool() as pool:
+      pool.Set(self.test_row, "metadata:predicate", "world")
+
+    values = data_store.DB.ResolvePrefix(self.test_row, "metadata:")
+    self.assertEqual([v for _, v, _ in values], ["world"])
+
+    data_store.DB.DeleteAttributes(self.test_row, ["metadata:predicate"])
+    self.assertEqual(data_store.DB.ResolvePrefix(self.test_row, "metadata:"),
+                     [])
+
+  def testTimestampRangeReadsAreNotCached(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello")
+
+    hits, misses = self._CacheCounters()
+    for _ in range(3):
+      values = data_store.DB.ResolvePrefix(
+          self.test_row,
+          "metadata:",
+          timestamp=(0, rdfvalue.RDFDatetime.Now()))
+      self.assertEqual([v for _, v, _ in values], ["hello"])
+      dict(
+          data_store.DB.MultiResolvePrefix(
+              [self.test_row], "metadata:", timestamp=(0, 10**16)))
+
+    self.assertEqual(self._CacheCounters(), (hits, misses))
+    self.assertEqual(len(data_store.DB.cache), 0)
+
+  def testQueueReadsAreNotCached(self):
+    data_store.DB.Set(self.test_row, "task:00000001", "task")
+
+    hits, misses = self._CacheCounters()
+    for _ in range(3):
+      data_store.DB.ResolvePrefix(self.test_row, "task:")
+      data_store.DB.ResolvePrefix(self.test_row, "")
+
+    self.assertEqual(self._CacheCounters(), (hits, misses))
+    self.assertEqual(len(data_store.DB.cache), 0)
+
+  def testEntriesExpire(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello")
+    data_store.DB.ResolvePrefix(self.test_row, "metadata:")
+
+    # Writes bypassing the cache are only seen once the entry expires.
+    data_store.DB.delegate.Set(self.test_row, "metadata:predicate", "world")
+    values = data_store.DB.ResolvePrefix(self.test_row, "metadata:")
+    self.assertEqual([v for _, v, _ in values], ["hello"])
+
+    with test_lib.FakeTime(time.time() + 60):
+      values = data_store.DB.ResolvePrefix(self.test_row, "metadata:")
+      self.assertEqual([v for _, v, _ in values], ["world"])
+
+
 def main(args):
   test_lib.main(args)
 
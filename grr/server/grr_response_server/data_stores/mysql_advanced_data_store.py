@@ -2,6 +2,7 @@
 # -*- mode: python; encoding: utf-8 -*-
 """An implementation of a data store based on mysql."""
 
+import collections
 import logging
 import os
 import Queue
@@ -256,6 +257,12 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     queries = self._BuildDelete(subject)
     self._ExecuteQueries(queries)
 
+  def DeleteSubjects(self, subjects, sync=False):
+    _ = sync
+    subjects = [utils.SmartUnicode(subject) for subject in subjects]
+    if subjects:
+      self._ExecuteTransaction(self._BuildSubjectDeletes(subjects))
+
   def ResolveMulti(self, subject, attributes, timestamp=None, limit=None):
     """Resolves multiple attributes at once for one subject."""
     for attribute in attributes:
@@ -401,8 +408,44 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     to_replace = []
     transaction = []
 
+    for attribute, data, entry_timestamp in self._EncodeValues(
+        values, timestamp):
+      # Replacing means to delete all versions of the attribute first.
+      if replace or attribute in to_delete:
+        existing = self._CountExistingRows(subject, attribute)
+        if existing:
+          to_replace.append([subject, attribute, data, entry_timestamp])
+        else:
+          to_insert.append([subject, attribute, data, entry_timestamp])
+        if attribute in to_delete:
+          to_delete.remove(attribute)
+
+      else:
+        to_insert.append([subject, attribute, data, entry_timestamp])
+
+    if to_delete:
+      self.DeleteAttributes(subject, to_delete)
+
+    if sync:
+      if to_replace:
+        transaction.extend(self._BuildReplaces(to_replace))
+      if to_insert:
+        transaction.extend(self._BuildInserts(to_insert))
+      if transaction:
+        self._ExecuteTransaction(transaction)
+    else:
+      if to_replace:
+        with self.buffer_lock:
+          self.to_replace.extend(to_replace)
+      if to_insert:
+        with self.buffer_lock:
+          self.to_insert.extend(to_insert)
+
+  def _EncodeValues(self, values, timestamp):
+    """Yields (attribute, data, timestamp) for each value passed to MultiSet."""
     # Build a document for each unique timestamp.
     for attribute, sequence in values.items():
+      attribute = utils.SmartUnicode(attribute)
       for value in sequence:
         if isinstance(value, tuple):
           value, entry_timestamp = value
@@ -417,39 +460,66 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         else:
           entry_timestamp = time.time() * 1e6
 
-        attribute = utils.SmartUnicode(attribute)
-        data = self._Encode(value)
+        yield attribute, self._Encode(value), entry_timestamp
 
-        # Replacing means to delete all versions of the attribute first.
-        if replace or attribute in to_delete:
-          existing = self._CountExistingRows(subject, attribute)
-          if existing:
-            to_replace.append([subject, attribute, data, entry_timestamp])
-          else:
-            to_insert.append([subject, attribute, data, entry_timestamp])
-          if attribute in to_delete:
-            to_delete.remove(attribute)
+  def ApplyMutations(self, delete_subjects, delete_attributes, set_requests):
+    """Applies the operations of a MutationPool in a single transaction.
+
+    Rows of all subjects are coalesced into multi row statements, so the
+    number of round trips depends on the amount of data written rather than
+    on the number of subjects. Writes buffered by MultiSet(sync=False) are
+    included in the same transaction.
+
+    Args:
+      delete_subjects: A list of subjects to delete.
+      delete_attributes: A list of (subject, attributes, start, end) tuples.
+      set_requests: A list of (subject, values, timestamp, replace, to_delete)
+        tuples.
+    """
+    transaction = self._TakeBufferedWrites()
 
+    if delete_subjects:
+      transaction.extend(
+          self._BuildSubjectDeletes(
+              [utils.SmartUnicode(subject) for subject in delete_subjects]))
+
+    for subject, attributes, start, end in delete_attributes:
+      if isinstance(attributes, basestring):
+        raise ValueError(
+            "String passed to DeleteAttributes (non string iterable expected).")
+
+      subject = utils.SmartUnicode(subject)
+      timestamp = self._MakeTimestamp(start, end)
+      for attribute in attributes:
+        transaction.extend(
+            self._BuildDelete(subject, utils.SmartUnicode(attribute),
+                              timestamp))
+
+    to_replace = []
+    to_insert = []
+    for subject, values, timestamp, replace, to_delete in set_requests:
+      subject = utils.SmartUnicode(subject)
+      to_delete = set(utils.SmartUnicode(a) for a in to_delete or [])
+
+      for attribute, data, entry_timestamp in self._EncodeValues(
+          values, timestamp):
+        # Replaced rows are deleted in bulk by _BuildReplaces() so there is no
+        # need to check whether they exist first.
+        if replace or attribute in to_delete:
+          to_replace.append([subject, attribute, data, entry_timestamp])
+          to_delete.discard(attribute)
         else:
           to_insert.append([subject, attribute, data, entry_timestamp])
 
-    if to_delete:
-      self.DeleteAttributes(subject, to_delete)
+      for attribute in to_delete:
+        transaction.extend(self._BuildDelete(subject, attribute))
 
-    if sync:
-      if to_replace:
-        transaction.extend(self._BuildReplaces(to_replace))
-      if to_insert:
-        transaction.extend(self._BuildInserts(to_insert))
-      if transaction:
-        self._ExecuteTransaction(transaction)
-    else:
-      if to_replace:
-        with self.buffer_lock:
-          self.to_replace.extend(to_replace)
-      if to_insert:
-        with self.buffer_lock:
-          self.to_insert.extend(to_insert)
+    if to_replace:
+      transaction.extend(self._BuildReplaces(to_replace))
+    if to_insert:
+      transaction.extend(self._BuildInserts(to_insert))
+    if transaction:
+      self._ExecuteTransaction(transaction)
 
   def _CountExistingRows(self, subject, attribute):
     query = ("SELECT count(*) AS total FROM aff4 "
@@ -475,6 +545,12 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     # locking the whole Flush() method. Long term, we should stop flushing the
     # data store and use MutationPools everywhere.
     super(MySQLAdvancedDataStore, self).Flush()
+    transaction = self._TakeBufferedWrites()
+    if transaction:
+      self._ExecuteTransaction(transaction)
+
+  def _TakeBufferedWrites(self):
+    """Empties the write buffers and returns the queries to write them."""
     with self.buffer_lock:
       to_insert = self.to_insert
       to_replace = self.to_replace
@@ -486,25 +562,53 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       transaction.extend(self._BuildReplaces(to_replace))
     if to_insert:
       transaction.extend(self._BuildInserts(to_insert))
-    if transaction:
-      self._ExecuteTransaction(transaction)
+    return transaction
+
+  def _Batches(self, sequence):
+    """Splits a sequence into chunks of at most max_values_per_query items."""
+    for i in xrange(0, len(sequence), self.max_values_per_query):
+      yield sequence[i:i + self.max_values_per_query]
 
   def _BuildReplaces(self, values):
-    transaction = []
-    updates = {}
-    to_insert = []
+    updates = collections.OrderedDict()
 
+    # Only the last value written for each attribute is kept.
     for (subject, attribute, data, timestamp) in values:
-      updates.setdefault(subject, {})[attribute] = [data, timestamp]
-
-    for subject in updates:
-      for attribute in updates[subject]:
-        data = updates[subject][attribute][0]
-        timestamp = updates[subject][attribute][1]
-        to_insert.append([subject, attribute, data, timestamp])
-        delete_q = self._BuildDelete(subject, attribute)[0]
-        transaction.append(delete_q)
-    transaction.extend(self._BuildInserts(to_insert))
+      updates[(subject, attribute)] = [subject, attribute, data, timestamp]
+
+    transaction = []
+    for batch in self._Batches(updates.keys()):
+      args = []
+      for subject, attribute in batch:
+        args.extend([subject, attribute])
+
+      transaction.append({
+          "query":
+              "DELETE aff4 FROM aff4 WHERE " + " OR ".join(
+                  ["(subject_hash=unhex(md5(%s)) AND "
+                   "attribute_hash=unhex(md5(%s)))"] * len(batch)),
+          "args":
+              args
+      })
+
+    transaction.extend(self._BuildInserts(updates.values()))
+    return transaction
+
+  def _BuildSubjectDeletes(self, subjects):
+    """Builds the queries deleting all information about the subjects."""
+    transaction = []
+    for batch in self._Batches(subjects):
+      placeholders = ", ".join(["unhex(md5(%s))"] * len(batch))
+      for table, column in [("aff4", "subject_hash"), ("locks", "subject_hash"),
+                            ("subjects", "hash")]:
+        transaction.append({
+            "query":
+                "DELETE %s FROM %s WHERE %s IN (%s)" % (table, table, column,
+                                                        placeholders),
+            "args":
+                list(batch)
+        })
+
     return transaction
 
   def _BuildAff4InsertQuery(self, args):
@@ -516,31 +620,17 @@ class MySQLAdvancedDataStore(data_store.DataStore):
             ] * (len(args) / 5))
 
   def _BuildInserts(self, values):
-    subjects_q = {}
-    attributes_q = {}
-
-    subjects_q["query"] = "INSERT IGNORE INTO subjects (hash, subject) VALUES"
-    attributes_q["query"] = (
-        "INSERT IGNORE INTO attributes (hash, attribute) VALUES")
-
-    subjects_q["args"] = []
-    attributes_q["args"] = []
-
-    seen = {}
-    seen["subjects"] = []
-    seen["attributes"] = []
+    """Builds multi row inserts, split by max_query_size/max_values_per_query."""
+    subjects = collections.OrderedDict()
+    attributes = collections.OrderedDict()
 
     result_queries = []
     current_args = []
     total_value_len = 0
     max_args = self.max_values_per_query * 5
     for (subject, attribute, value, timestamp) in values:
-      if subject not in seen["subjects"]:
-        subjects_q["args"].extend([subject, subject])
-        seen["subjects"].append(subject)
-      if attribute not in seen["attributes"]:
-        attributes_q["args"].extend([attribute, attribute])
-        seen["attributes"].append(attribute)
+      subjects[subject] = None
+      attributes[attribute] = None
 
       current_args.extend([subject, attribute, timestamp, timestamp, value])
       total_value_len += len(value)
@@ -559,11 +649,20 @@ class MySQLAdvancedDataStore(data_store.DataStore):
               query=self._BuildAff4InsertQuery(current_args),
               args=current_args))
 
-    subjects_q["query"] += ", ".join(["(unhex(md5(%s)), %s)"] *
-                                     (len(subjects_q["args"]) / 2))
-    attributes_q["query"] += ", ".join(["(unhex(md5(%s)), %s)"] *
-                                       (len(attributes_q["args"]) / 2))
-    result_queries.extend([attributes_q, subjects_q])
+    for table, column, names in [("attributes", "attribute", attributes),
+                                 ("subjects", "subject", subjects)]:
+      for batch in self._Batches(names.keys()):
+        args = []
+        for name in batch:
+          args.extend([name, name])
+
+        result_queries.append(
+            dict(
+                query="INSERT IGNORE INTO %s (hash, %s) VALUES" %
+                (table, column) + ", ".join(
+                    ["(unhex(md5(%s)), %s)"] * len(batch)),
+                args=args))
+
     return result_queries
 
   def _RetryWrapper(self, action_fn):
@@ -21,6 +21,7 @@ from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr_response_proto import export_pb2
 from grr.server.grr_response_server import aff4
+from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server.aff4_objects import filestore
 from grr.server.grr_response_server.flows.general import collectors as flow_collectors
 
@@ -300,6 +301,81 @@ class ExportConverter(object):
     return ExportConverter.GetConvertersByClass(value.__class__)
 
 
+class FieldCopier(object):
+  """Copies primitive fields from one RDFProtoStruct class to another.
+
+  Converters spend most of their time reading source fields one by one and
+  validating them again when setting them on the exported value. Fields that
+  have the same type in the source and target structs are copied here as raw
+  entries instead: the decoded python value is shared and the wire format is
+  re-tagged with the target's field number, so nothing is decoded, validated
+  or encoded again.
+  """
+
+  RAW_COPY_DESCRIPTORS = (rdf_structs.ProtoString, rdf_structs.ProtoBinary,
+                          rdf_structs.ProtoUnsignedInteger,
+                          rdf_structs.ProtoSignedInteger,
+                          rdf_structs.ProtoFixed32, rdf_structs.ProtoFixed64,
+                          rdf_structs.ProtoFloat, rdf_structs.ProtoDouble,
+                          rdf_structs.ProtoRDFValue)
+
+  def __init__(self, source_cls, target_cls, field_names):
+    """Constructor.
+
+    Args:
+      source_cls: RDFProtoStruct class values are copied from.
+      target_cls: RDFProtoStruct class values are copied to.
+      field_names: Names of the fields to copy. A (source_name, target_name)
+                   tuple copies a field that is named differently in the
+                   target.
+    """
+    self.raw_copy_fields = []
+    self.set_fields = []
+    for field_name in field_names:
+      if isinstance(field_name, tuple):
+        source_name, target_name = field_name
+      else:
+        source_name = target_name = field_name
+
+      source_desc = source_cls.type_infos[source_name]
+      target_desc = target_cls.type_infos[target_name]
+      if (source_desc.__class__ is target_desc.__class__ and
+          source_desc.__class__ in self.RAW_COPY_DESCRIPTORS and
+          getattr(source_desc, "type", None) is getattr(
+              target_desc, "type", None)):
+        # Unset fields are copied as the source's default value, exactly like
+        # target.Set(name, source.Get(name)) would do.
+        default = source_desc.GetDefault()
+        if default is not None:
+          default = (target_desc.Validate(default), None, target_desc)
+        self.raw_copy_fields.append((source_name, target_name, target_desc,
+                                     default))
+      else:
+        self.set_fields.append((source_name, target_name))
+
+  def Copy(self, source, target):
+    """Copies the fields from source into target."""
+    source_data = source.GetRawData()
+    target_data = target.GetRawData()
+    for source_name, target_name, target_desc, default in self.raw_copy_fields:
+      entry = source_data.get(source_name)
+      if entry is None:
+        if default is not None:
+          target_data[target_name] = default
+        continue
+
+      python_format, wire_format, _ = entry
+      if wire_format is not None:
+        wire_format = (target_desc.encoded_tag, wire_format[1], wire_format[2])
+      target_data[target_name] = (python_format, wire_format, target_desc)
+
+    for source_name, target_name in self.set_fields:
+      target.Set(target_name, source.Get(source_name))
+
+    target.dirty = True
+    return target
+
+
 class AutoExportedProtoStruct(rdf_structs.RDFProtoStruct):
   """Special base class for auto-exported values."""
 
@@ -398,12 +474,18 @@ class StatEntryToExportedFileConverter(ExportConverter):
 
   MAX_CONTENT_SIZE = 1024 * 64
 
+  STAT_FIELDS = ("st_mode", "st_ino", "st_dev", "st_nlink", "st_uid", "st_gid",
+                 "st_size", "st_atime", "st_mtime", "st_ctime", "st_blocks",
+                 "st_blksize", "st_rdev", "symlink")
+
   def __init__(self, *args, **kwargs):
     super(StatEntryToExportedFileConverter, self).__init__(*args, **kwargs)
     # If either of these are true we need to open the file to get more
     # information
     self.open_file_for_read = (
         self.options.export_files_hashes or self.options.export_files_contents)
+    self.stat_fields_copier = FieldCopier(rdf_client.StatEntry, ExportedFile,
+                                          self.STAT_FIELDS)
 
   @staticmethod
   def ParseSignedData(signed_data, result):
@@ -516,16 +598,19 @@ class StatEntryToExportedFileConverter(ExportConverter):
 
     return filtered_pairs
 
-  def _OpenFilesForRead(self, metadata_value_pairs, token):
-    """Open files all at once if necessary."""
-    if self.open_file_for_read:
-      aff4_paths = [
-          result.AFF4Path(metadata.client_urn)
-          for metadata, result in metadata_value_pairs
-      ]
+  def _GetAFF4Paths(self, metadata_value_pairs):
+    return [
+        stat_entry.AFF4Path(metadata.client_urn)
+        for metadata, stat_entry in metadata_value_pairs
+    ]
+
+  def _OpenFilesForRead(self, aff4_paths, token):
+    """Opens all the given files with a single MultiOpen if necessary."""
+    if self.open_file_for_read and aff4_paths:
       fds = aff4.FACTORY.MultiOpen(aff4_paths, mode="r", token=token)
-      fds_dict = dict([(fd.urn, fd) for fd in fds])
-      return fds_dict
+      return dict((fd.urn, fd) for fd in fds)
+
+    return {}
 
   def _ExportHash(self, aff4_object, result):
     """Add hashes from aff4_object to result."""
@@ -543,25 +628,13 @@ class StatEntryToExportedFileConverter(ExportConverter):
       except (IOError, AttributeError) as e:
         logging.warning("Can't read content of %s: %s", aff4_object.urn, e)
 
-  def _CreateExportedFile(self, metadata, stat_entry):
-    return ExportedFile(
-        metadata=metadata,
-        urn=stat_entry.AFF4Path(metadata.client_urn),
-        basename=stat_entry.pathspec.Basename(),
-        st_mode=stat_entry.st_mode,
-        st_ino=stat_entry.st_ino,
-        st_dev=stat_entry.st_dev,
-        st_nlink=stat_entry.st_nlink,
-        st_uid=stat_entry.st_uid,
-        st_gid=stat_entry.st_gid,
-        st_size=stat_entry.st_size,
-        st_atime=stat_entry.st_atime,
-        st_mtime=stat_entry.st_mtime,
-        st_ctime=stat_entry.st_ctime,
-        st_blocks=stat_entry.st_blocks,
-        st_blksize=stat_entry.st_blksize,
-        st_rdev=stat_entry.st_rdev,
-        symlink=stat_entry.symlink)
+  def _CreateExportedFile(self, metadata, stat_entry, urn=None):
+    if urn is None:
+      urn = stat_entry.AFF4Path(metadata.client_urn)
+
+    result = ExportedFile(
+        metadata=metadata, urn=urn, basename=stat_entry.pathspec.Basename())
+    return self.stat_fields_copier.Copy(stat_entry, result)
 
   def BatchConvert(self, metadata_value_pairs, token=None):
     """Converts a batch of StatEntry value to ExportedFile values at once.
@@ -577,13 +650,16 @@ class StatEntryToExportedFileConverter(ExportConverter):
       conversion wasn't possible.
     """
     filtered_pairs = self._RemoveRegistryKeys(metadata_value_pairs)
-    fds_dict = self._OpenFilesForRead(filtered_pairs, token=token)
-    for metadata, stat_entry in filtered_pairs:
-      result = self._CreateExportedFile(metadata, stat_entry)
+    # AFF4 paths are expensive to compute, so they are only computed once and
+    # used both to open the files and to fill in the results.
+    aff4_paths = self._GetAFF4Paths(filtered_pairs)
+    fds_dict = self._OpenFilesForRead(aff4_paths, token=token)
+    for (metadata, stat_entry), urn in zip(filtered_pairs, aff4_paths):
+      result = self._CreateExportedFile(metadata, stat_entry, urn=urn)
 
       if self.open_file_for_read:
         try:
-          aff4_object = fds_dict[stat_entry.AFF4Path(metadata.client_urn)]
+          aff4_object = fds_dict[urn]
           self._ExportHash(aff4_object, result)
           self._ExportFileContent(aff4_object, result)
         except KeyError:
@@ -661,36 +737,31 @@ class ProcessToExportedProcessConverter(ExportConverter):
 
   input_rdf_type = "Process"
 
+  PROCESS_FIELDS = ("pid", "ppid", "name", "exe", "ctime", "real_uid",
+                    "effective_uid", "saved_uid", "real_gid", "effective_gid",
+                    "saved_gid", "username", "terminal", "status", "nice",
+                    "cwd", "num_threads", "user_cpu_time", "system_cpu_time",
+                    "cpu_percent", ("RSS_size", "rss_size"),
+                    ("VMS_size", "vms_size"), "memory_percent")
+
+  def __init__(self, *args, **kwargs):
+    super(ProcessToExportedProcessConverter, self).__init__(*args, **kwargs)
+    self.process_fields_copier = FieldCopier(
+        rdf_client.Process, ExportedProcess, self.PROCESS_FIELDS)
+
   def Convert(self, metadata, process, token=None):
     """Converts Process to ExportedProcess."""
+    return self.BatchConvert([(metadata, process)], token=token)
 
-    result = ExportedProcess(
-        metadata=metadata,
-        pid=process.pid,
-        ppid=process.ppid,
-        name=process.name,
-        exe=process.exe,
-        cmdline=" ".join(process.cmdline),
-        ctime=process.ctime,
-        real_uid=process.real_uid,
-        effective_uid=process.effective_uid,
-        saved_uid=process.saved_uid,
-        real_gid=process.real_gid,
-        effective_gid=process.effective_gid,
-        saved_gid=process.saved_gid,
-        username=process.username,
-        terminal=process.terminal,
-        status=process.status,
-        nice=process.nice,
-        cwd=process.cwd,
-        num_threads=process.num_threads,
-        user_cpu_time=process.user_cpu_time,
-        system_cpu_time=process.system_cpu_time,
-        cpu_percent=process.cpu_percent,
-        rss_size=process.RSS_size,
-        vms_size=process.VMS_size,
-        memory_percent=process.memory_percent)
-    return [result]
+  def BatchConvert(self, metadata_value_pairs, token=None):
+    """Converts a batch of Process values to ExportedProcess values at once."""
+    results = []
+    for metadata, process in metadata_value_pairs:
+      result = ExportedProcess(
+          metadata=metadata, cmdline=" ".join(process.cmdline))
+      results.append(self.process_fields_copier.Copy(process, result))
+
+    return results
 
 
 class ProcessToExportedNetworkConnectionConverter(ExportConverter):
@@ -839,12 +910,13 @@ class FileFinderResultConverter(StatEntryToExportedFileConverter):
         metadata_value_pairs)
 
     # Export files first
-    fds_dict = self._OpenFilesForRead(
-        [(metadata, val.stat_entry) for metadata, val in file_pairs],
-        token=token)
+    aff4_paths = self._GetAFF4Paths(
+        [(metadata, val.stat_entry) for metadata, val in file_pairs])
+    fds_dict = self._OpenFilesForRead(aff4_paths, token=token)
 
-    for metadata, ff_result in file_pairs:
-      result = self._CreateExportedFile(metadata, ff_result.stat_entry)
+    for (metadata, ff_result), urn in zip(file_pairs, aff4_paths):
+      result = self._CreateExportedFile(
+          metadata, ff_result.stat_entry, urn=urn)
 
       # FileFinderResult has hashes in "hash_entry" attribute which is not
       # passed to ConvertValuesWithMetadata call. We have to process these
@@ -852,7 +924,6 @@ class FileFinderResultConverter(StatEntryToExportedFileConverter):
       self.ParseFileHash(ff_result.hash_entry, result)
 
       if self.options.export_files_contents:
-        urn = ff_result.stat_entry.AFF4Path(metadata.client_urn)
         try:
           aff4_object = fds_dict[urn]
           self._ExportFileContent(aff4_object, result)
@@ -1047,10 +1118,6 @@ class GrrMessageConverter(ExportConverter):
 
   input_rdf_type = "GrrMessage"
 
-  def __init__(self, *args, **kw):
-    super(GrrMessageConverter, self).__init__(*args, **kw)
-    self.cached_metadata = {}
-
   def Convert(self, metadata, grr_message, token=None):
     """Converts GrrMessage into a set of RDFValues.
 
@@ -1084,54 +1151,32 @@ class GrrMessageConverter(ExportConverter):
     for metadata, msg in metadata_value_pairs:
       msg_dict.setdefault(msg.source, []).append((metadata, msg))
 
-    metadata_objects = []
-    metadata_to_fetch = []
-
-    # Open the clients we don't have metadata for and fetch metadata.
-    for client_urn in msg_dict.iterkeys():
-      try:
-        metadata_objects.append(self.cached_metadata[client_urn])
-      except KeyError:
-        metadata_to_fetch.append(client_urn)
-
-    if metadata_to_fetch:
-      client_fds = aff4.FACTORY.MultiOpen(
-          metadata_to_fetch, mode="r", token=token)
-
-      fetched_metadata = [
-          GetMetadata(client_fd, token=token) for client_fd in client_fds
-      ]
-      for metadata in fetched_metadata:
-        self.cached_metadata[metadata.client_urn] = metadata
-      metadata_objects.extend(fetched_metadata)
+    metadata_by_client = CLIENT_METADATA_CACHE.GetMetadata(
+        msg_dict.iterkeys(), token=token)
 
     data_by_type = {}
-    for metadata in metadata_objects:
-      try:
-        for original_metadata, message in msg_dict[metadata.client_urn]:
-          # Get source_urn and annotations from the original metadata
-          # provided and original_timestamp from the payload age.
-          new_metadata = ExportedMetadata(metadata)
-          new_metadata.source_urn = original_metadata.source_urn
-          new_metadata.annotations = original_metadata.annotations
-          new_metadata.original_timestamp = message.payload.age
-          cls_name = message.payload.__class__.__name__
-
-          # Create a dict of values for conversion keyed by type, so we can
-          # apply the right converters to the right object types
-          if cls_name not in data_by_type:
-            converters_classes = ExportConverter.GetConvertersByValue(
-                message.payload)
-            data_by_type[cls_name] = {
-                "converters": [cls(self.options) for cls in converters_classes],
-                "batch_data": [(new_metadata, message.payload)]
-            }
-          else:
-            data_by_type[cls_name]["batch_data"].append((new_metadata,
-                                                         message.payload))
-
-      except KeyError:
-        pass
+    for client_urn, metadata in metadata_by_client.iteritems():
+      for original_metadata, message in msg_dict[client_urn]:
+        # Get source_urn and annotations from the original metadata
+        # provided and original_timestamp from the payload age.
+        new_metadata = ExportedMetadata(metadata)
+        new_metadata.source_urn = original_metadata.source_urn
+        new_metadata.annotations = original_metadata.annotations
+        new_metadata.original_timestamp = message.payload.age
+        cls_name = message.payload.__class__.__name__
+
+        # Create a dict of values for conversion keyed by type, so we can
+        # apply the right converters to the right object types
+        if cls_name not in data_by_type:
+          converters_classes = ExportConverter.GetConvertersByValue(
+              message.payload)
+          data_by_type[cls_name] = {
+              "converters": [cls(self.options) for cls in converters_classes],
+              "batch_data": [(new_metadata, message.payload)]
+          }
+        else:
+          data_by_type[cls_name]["batch_data"].append((new_metadata,
+                                                       message.payload))
 
     # Run all converters against all objects of the relevant type
     converted_batch = []
@@ -1989,6 +2034,135 @@ def GetMetadata(client, token=None):
   return metadata
 
 
+def GetMetadataFromClientInfo(client_info):
+  """Builds ExportedMetadata object from a relational ClientFullInfo.
+
+  Args:
+    client_info: ClientFullInfo object read from the relational database.
+
+  Returns:
+    ExportedMetadata object with metadata of the client.
+  """
+  snapshot = client_info.last_snapshot
+  kb = snapshot.knowledge_base
+
+  metadata = ExportedMetadata()
+
+  metadata.client_urn = rdf_client.ClientURN(snapshot.client_id)
+  if snapshot.timestamp:
+    metadata.client_age = snapshot.timestamp
+
+  metadata.hostname = utils.SmartUnicode(kb.fqdn)
+  metadata.os = utils.SmartUnicode(kb.os)
+  metadata.uname = utils.SmartUnicode(snapshot.Uname())
+  metadata.os_release = utils.SmartUnicode(snapshot.os_release)
+  metadata.os_version = utils.SmartUnicode(snapshot.os_version)
+  metadata.usernames = utils.SmartUnicode(
+      [user.username for user in kb.users] or u"")
+  metadata.mac_address = utils.SmartUnicode(
+      "\n".join(snapshot.GetMacAddresses()))
+
+  system_labels = client_info.GetLabelsNames(owner="GRR")
+  all_labels = client_info.GetLabelsNames()
+  metadata.labels = u",".join(sorted(all_labels))
+  metadata.system_labels = u",".join(sorted(system_labels))
+  metadata.user_labels = u",".join(sorted(all_labels - system_labels))
+
+  if snapshot.HasField("hardware_info"):
+    metadata.hardware_info = snapshot.hardware_info
+  if snapshot.kernel:
+    metadata.kernel_version = snapshot.kernel
+
+  return metadata
+
+
+class ClientMetadataCache(object):
+  """A size and age bounded cache of clients' ExportedMetadata.
+
+  Building ExportedMetadata requires reading the client object, which
+  dominates the cost of converting results coming from many clients. The
+  cache is filled in bulk and shared by all the converters and output plugins
+  running in the process, so that every client is read at most once per
+  max_age seconds, no matter how many batches and plugins see its results.
+  """
+
+  def __init__(self, max_size=10000, max_age=600):
+    self.max_age = max_age
+    self._cache = utils.TimeBasedCache(max_size=max_size, max_age=max_age)
+
+  def Flush(self):
+    self._cache.Flush()
+
+  def _FetchMetadata(self, client_urns, token=None):
+    """Reads metadata of given clients, returns a dict keyed by client id."""
+    result = {}
+
+    if data_store.RelationalDBReadEnabled():
+      client_infos = data_store.REL_DB.MultiReadClientFullInfo(
+          [urn.Basename() for urn in client_urns])
+      for client_id, client_info in client_infos.iteritems():
+        if client_info.HasField("last_snapshot"):
+          result[client_id] = GetMetadataFromClientInfo(client_info)
+    else:
+      for client_fd in aff4.FACTORY.MultiOpen(
+          client_urns, mode="r", token=token):
+        result[client_fd.urn.Basename()] = GetMetadata(client_fd, token=token)
+
+    return result
+
+  def GetMetadata(self, client_urns, token=None):
+    """Returns metadata for given clients.
+
+    Args:
+      client_urns: An iterable of client URNs.
+      token: Security token.
+
+    Returns:
+      A dict mapping each of the given client URNs to a copy of its
+      ExportedMetadata. Clients that don't exist are not included.
+    """
+    now = time.time()
+    cached = {}
+    to_fetch = []
+    for urn in set(client_urns):
+      client_id = urn.Basename()
+      try:
+        fetched_at, metadata = self._cache.Get(client_id)
+        # TimeBasedCache only expires entries which are not used, we want
+        # frequently exported clients to be refreshed as well.
+        if fetched_at + self.max_age > now:
+          cached[urn] = metadata
+          continue
+      except KeyError:
+        pass
+
+      to_fetch.append(urn)
+
+    if to_fetch:
+      fetched = self._FetchMetadata(to_fetch, token=token)
+      for urn in to_fetch:
+        metadata = fetched.get(urn.Basename())
+        # Missing clients are cached as well so that results of deleted
+        # clients don't trigger a lookup in every batch.
+        self._cache.Put(urn.Basename(), (now, metadata))
+        cached[urn] = metadata
+
+    export_time = rdfvalue.RDFDatetime.Now()
+    result = {}
+    for urn, metadata in cached.iteritems():
+      if metadata is not None:
+        # Callers modify metadata of the values they export.
+        metadata_copy = ExportedMetadata(metadata)
+        metadata_copy.timestamp = export_time
+        result[urn] = metadata_copy
+
+    return result
+
+
+# Metadata cache shared by everything that exports results in this process.
+CLIENT_METADATA_CACHE = ClientMetadataCache()
+
+
 def ConvertValuesWithMetadata(metadata_value_pairs, token=None, options=None):
   """Converts a set of RDFValues into a set of export-friendly RDFValues.
 
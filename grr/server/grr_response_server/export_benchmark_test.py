@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""Benchmarks for the export converters."""
+
+import time
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import paths as rdf_paths
+from grr.server.grr_response_server import export
+from grr.test_lib import benchmark_test_lib
+from grr.test_lib import test_lib
+
+
+class ExportConverterBenchmark(benchmark_test_lib.MicroBenchmarks):
+  """Throughput of BatchConvert for the most commonly exported values."""
+
+  units = "s"
+
+  NUM_VALUES = 1000000
+  BATCH_SIZE = 5000
+
+  def setUp(self):
+    super(ExportConverterBenchmark, self).setUp()
+    self.metadata = export.ExportedMetadata(
+        client_urn=rdf_client.ClientURN("C.0000000000000001"),
+        hostname="Host-0",
+        source_urn=rdfvalue.RDFURN("aff4:/hunts/H:123456/Results"))
+
+  def _SerializedStatEntries(self):
+    return [
+        rdf_client.StatEntry(
+            pathspec=rdf_paths.PathSpec(
+                path="/usr/lib/%d/lib%d.so" % (i % 100, i), pathtype="OS"),
+            st_mode=33184,
+            st_ino=1063090 + i,
+            st_dev=64512,
+            st_nlink=1,
+            st_uid=139592,
+            st_gid=5000,
+            st_size=i,
+            st_atime=1336469177,
+            st_mtime=1336129892,
+            st_ctime=1336129892).SerializeToString()
+        for i in range(self.BATCH_SIZE)
+    ]
+
+  def _TimeBatchConvert(self, converter, serialized_values):
+    """Converts NUM_VALUES values, returns the time spent in BatchConvert."""
+    total_time = 0
+    for _ in range(self.NUM_VALUES // self.BATCH_SIZE):
+      # Values read from a collection are only decoded lazily, so the batch is
+      # parsed again every time. Parsing is not part of the measurement.
+      batch = [(self.metadata,
+                rdf_client.StatEntry.FromSerializedString(serialized))
+               for serialized in serialized_values]
+
+      start = time.time()
+      for _ in converter.BatchConvert(batch, token=self.token):
+        pass
+      total_time += time.time() - start
+
+    return total_time
+
+  def testConvertStatEntries(self):
+    """Converting 1M StatEntry values to ExportedFile values."""
+    serialized_values = self._SerializedStatEntries()
+
+    converter = export.StatEntryToExportedFileConverter(
+        options=export.ExportOptions(export_files_hashes=False))
+    self.AddResult("StatEntry -> ExportedFile",
+                   self._TimeBatchConvert(converter, serialized_values),
+                   self.NUM_VALUES)
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -5,6 +5,8 @@ import json
 import os
 import socket
 
+import mock
+
 from grr_response_client.components.rekall_support import grr_rekall
 from grr.lib import flags
 from grr.lib import queues
@@ -14,6 +16,7 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import crypto as rdf_crypto
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
 from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import objects as rdf_objects
 from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import rdf_yara
@@ -409,6 +412,37 @@ class ExportTest(ExportTestBase):
     self.assertEqual(results[0].exe, "c:\\windows\\cmd.exe")
     self.assertEqual(results[0].ctime, long(1333718907.167083 * 1e6))
 
+  def testProcessToExportedProcessConverterWithSerializedProcesses(self):
+    processes = [
+        rdf_client.Process.FromSerializedString(
+            rdf_client.Process(
+                pid=i, name="proc%d" % i, RSS_size=1024 * i,
+                cpu_percent=0.5).SerializeToString()) for i in range(1, 4)
+    ]
+
+    converter = export.ProcessToExportedProcessConverter()
+    results = converter.BatchConvert(
+        [(self.metadata, process) for process in processes], token=self.token)
+
+    self.assertEqual(len(results), 3)
+    for i, result in enumerate(results, 1):
+      self.assertIs(result.metadata, self.metadata)
+      self.assertEqual(result.pid, i)
+      self.assertEqual(result.name, "proc%d" % i)
+      self.assertEqual(result.rss_size, 1024 * i)
+      self.assertEqual(result.cpu_percent, 0.5)
+      # Unset fields are exported with their default values.
+      self.assertTrue(result.HasField("ppid"))
+      self.assertEqual(result.ppid, 0)
+
+      # Copied fields are serialized with ExportedProcess field numbers.
+      reparsed = export.ExportedProcess.FromSerializedString(
+          result.SerializeToString())
+      self.assertEqual(reparsed.pid, i)
+      self.assertEqual(reparsed.name, "proc%d" % i)
+      self.assertEqual(reparsed.rss_size, 1024 * i)
+      self.assertEqual(reparsed.metadata.hostname, self.metadata.hostname)
+
   def testProcessToExportedOpenFileConverter(self):
     process = rdf_client.Process(
         pid=2,
@@ -647,6 +681,102 @@ class ExportTest(ExportTestBase):
     metadata = export.GetMetadata(self.client_id, token=self.token)
     self.assertFalse(metadata.usernames)
 
+  def testGetMetadataFromClientInfo(self):
+    client_id = self.client_id.Basename()
+    data_store.REL_DB.WriteClientMetadata(client_id, fleetspeak_enabled=False)
+
+    snapshot = rdf_objects.ClientSnapshot(client_id=client_id)
+    snapshot.knowledge_base.fqdn = "host.example.com"
+    snapshot.knowledge_base.os = "Linux"
+    snapshot.knowledge_base.users = [rdf_client.User(username="user1")]
+    snapshot.os_release = "Ubuntu"
+    snapshot.os_version = "16.04"
+    snapshot.kernel = "4.4.0"
+    snapshot.hardware_info.bios_version = "Version 1.23v"
+    data_store.REL_DB.WriteClientSnapshot(snapshot)
+    data_store.REL_DB.AddClientLabels(client_id, "GRR", ["c"])
+    data_store.REL_DB.AddClientLabels(client_id, "test", ["b", "a"])
+
+    metadata = export.GetMetadataFromClientInfo(
+        data_store.REL_DB.ReadClientFullInfo(client_id))
+    self.assertEqual(metadata.client_urn, self.client_id)
+    self.assertTrue(metadata.client_age)
+    self.assertEqual(metadata.hostname, u"host.example.com")
+    self.assertEqual(metadata.os, u"Linux")
+    self.assertEqual(metadata.uname, u"Linux-Ubuntu-16.04")
+    self.assertEqual(metadata.usernames, u"[u'user1']")
+    self.assertEqual(metadata.kernel_version, u"4.4.0")
+    self.assertEqual(metadata.labels, u"a,b,c")
+    self.assertEqual(metadata.user_labels, u"a,b")
+    self.assertEqual(metadata.system_labels, u"c")
+    self.assertEqual(metadata.hardware_info.bios_version, u"Version 1.23v")
+
+  def testClientMetadataCacheReadsEachClientOnce(self):
+    fixture_test_lib.ClientFixture(self.client_id, token=self.token)
+    missing_client_id = rdf_client.ClientURN("C.0000000000000001")
+    cache = export.ClientMetadataCache()
+
+    with mock.patch.object(
+        aff4.FACTORY, "MultiOpen",
+        wraps=aff4.FACTORY.MultiOpen) as multi_open:
+      for _ in range(3):
+        result = cache.GetMetadata(
+            [self.client_id, self.client_id, missing_client_id],
+            token=self.token)
+        self.assertEqual(result.keys(), [self.client_id])
+        self.assertEqual(result[self.client_id].os, u"Windows")
+
+        # Callers get copies they can modify.
+        result[self.client_id].source_urn = "aff4:/hunts/H:123456"
+
+    self.assertEqual(multi_open.call_count, 1)
+    self.assertFalse(
+        cache.GetMetadata([self.client_id],
+                          token=self.token)[self.client_id].source_urn)
+
+  def testClientMetadataCacheRefreshesExpiredEntries(self):
+    fixture_test_lib.ClientFixture(self.client_id, token=self.token)
+    cache = export.ClientMetadataCache(max_age=60)
+
+    with test_lib.FakeTime(100):
+      metadata = cache.GetMetadata([self.client_id], token=self.token)
+      self.assertFalse(metadata[self.client_id].labels)
+
+    with aff4.FACTORY.Open(
+        self.client_id, mode="rw", token=self.token) as client:
+      client.SetLabel("client-label-24")
+
+    # The entry is refreshed after max_age even if it's used in the meantime.
+    for now in [130, 159, 170]:
+      with test_lib.FakeTime(now):
+        metadata = cache.GetMetadata([self.client_id], token=self.token)
+        expected_labels = u"client-label-24" if now >= 160 else u""
+        self.assertEqual(metadata[self.client_id].labels, expected_labels)
+
+  def testClientMetadataCacheReadsRelationalDB(self):
+    data_store.REL_DB.WriteClientMetadata(
+        self.client_id.Basename(), fleetspeak_enabled=False)
+    snapshot = rdf_objects.ClientSnapshot(client_id=self.client_id.Basename())
+    snapshot.knowledge_base.fqdn = "host.example.com"
+    data_store.REL_DB.WriteClientSnapshot(snapshot)
+    cache = export.ClientMetadataCache()
+
+    with mock.patch.object(
+        data_store, "RelationalDBReadEnabled", return_value=True):
+      with mock.patch.object(
+          data_store.REL_DB,
+          "MultiReadClientFullInfo",
+          wraps=data_store.REL_DB.MultiReadClientFullInfo) as read_info:
+        for _ in range(2):
+          result = cache.GetMetadata(
+              [self.client_id, rdf_client.ClientURN("C.0000000000000001")],
+              token=self.token)
+          self.assertEqual(result.keys(), [self.client_id])
+          self.assertEqual(result[self.client_id].hostname,
+                           u"host.example.com")
+
+    self.assertEqual(read_info.call_count, 1)
+
   def testClientSummaryToExportedClientConverter(self):
     client_summary = rdf_client.ClientSummary()
     metadata = export.ExportedMetadata(hostname="ahostname")
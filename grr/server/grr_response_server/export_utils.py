@@ -266,7 +266,7 @@ def DownloadCollection(coll_path,
 
   # Collections can include anything they want, but we only handle RDFURN and
   # StatEntry entries in this function.
-  for grr_message in coll:
+  for _, grr_message in coll.ParallelScan():
     source = None
     # If a raw message, work out the type.
     if isinstance(grr_message, rdf_flows.GrrMessage):
@@ -19,8 +19,9 @@ class DumpFlashImageMock(action_mocks.ActionMock):
 
   def __init__(self, *args, **kwargs):
     super(DumpFlashImageMock, self).__init__(
-        standard.HashBuffer, standard.HashFile, standard.GetFileStat,
-        standard.TransferBuffer, tempfiles.DeleteGRRTempFiles)
+        standard.HashBuffer, standard.HashBufferManifest, standard.HashFile,
+        standard.GetFileStat, standard.TransferBuffer,
+        tempfiles.DeleteGRRTempFiles)
 
   def DumpFlashImage(self, args):
     flash_fd, flash_path = tempfiles.CreateGRRTempFileVFS()
@@ -225,6 +225,9 @@ class MultiGetFileMixin(object):
     stores for files before downloading them, and offer any new files to
     external stores. This should be true unless the external checks are
     misbehaving.
+  - content_defined_chunking: boolean. If true, files are split into chunks at
+    content defined boundaries so unchanged parts of a file map to blobs we
+    already have even if data was inserted or removed before them.
   """
 
   CHUNK_SIZE = 512 * 1024
@@ -236,12 +239,14 @@ class MultiGetFileMixin(object):
   def Start(self,
             file_size=0,
             maximum_pending_files=1000,
-            use_external_stores=False):
+            use_external_stores=False,
+            content_defined_chunking=False):
     """Initialize our state."""
     super(MultiGetFileMixin, self).Start()
 
     self.state.files_hashed = 0
     self.state.use_external_stores = use_external_stores
+    self.state.content_defined_chunking = content_defined_chunking
     self.state.file_size = file_size
     self.state.files_to_fetch = 0
     self.state.files_fetched = 0
@@ -564,32 +569,110 @@ class MultiGetFileMixin(object):
         file_tracker["size_to_download"] = file_tracker["stat_entry"].st_size
 
       # We do not have the file here yet - we need to retrieve it.
-      expected_number_of_hashes = (
-          file_tracker["size_to_download"] / self.CHUNK_SIZE + 1)
-
-      # We just hash ALL the chunks in the file now. NOTE: This maximizes client
-      # VFS cache hit rate and is far more efficient than launching multiple
-      # GetFile flows.
       self.state.files_to_fetch += 1
 
-      for i in range(expected_number_of_hashes):
-        if i == expected_number_of_hashes - 1:
-          # The last chunk is short.
-          length = file_tracker["size_to_download"] % self.CHUNK_SIZE
-        else:
-          length = self.CHUNK_SIZE
+      if self.state.content_defined_chunking:
+        self.CallClient(
+            server_stubs.HashBufferChunks,
+            pathspec=file_tracker["stat_entry"].pathspec,
+            offset=0,
+            length=file_tracker["size_to_download"],
+            max_chunk_size=self.CHUNK_SIZE,
+            next_state="CheckChunkHashes",
+            request_data=dict(index=index))
+      else:
+        # A single manifest of all chunk hashes saves a client round trip per
+        # chunk.
         self.CallClient(
-            server_stubs.HashBuffer,
+            server_stubs.HashBufferManifest,
             pathspec=file_tracker["stat_entry"].pathspec,
-            offset=i * self.CHUNK_SIZE,
-            length=length,
-            next_state="CheckHash",
+            offset=0,
+            length=file_tracker["size_to_download"],
+            chunk_size=self.CHUNK_SIZE,
+            next_state="CheckHashManifest",
             request_data=dict(index=index))
 
     if self.state.files_hashed % 100 == 0:
       self.Log("Hashed %d files, skipped %s already stored.",
                self.state.files_hashed, self.state.files_skipped)
 
+  def _HashFixedSizeChunks(self, index, file_tracker):
+    """Asks the client to hash every CHUNK_SIZE block of the file."""
+    expected_number_of_hashes = (
+        file_tracker["size_to_download"] / self.CHUNK_SIZE + 1)
+
+    # We just hash ALL the chunks in the file now. NOTE: This maximizes client
+    # VFS cache hit rate and is far more efficient than launching multiple
+    # GetFile flows.
+    for i in range(expected_number_of_hashes):
+      if i == expected_number_of_hashes - 1:
+        # The last chunk is short.
+        length = file_tracker["size_to_download"] % self.CHUNK_SIZE
+      else:
+        length = self.CHUNK_SIZE
+      self.CallClient(
+          server_stubs.HashBuffer,
+          pathspec=file_tracker["stat_entry"].pathspec,
+          offset=i * self.CHUNK_SIZE,
+          length=length,
+          next_state="CheckHash",
+          request_data=dict(index=index))
+
+  @flow.StateHandler()
+  def CheckChunkHashes(self, responses):
+    """Adds all content defined chunk hashes to the file tracker."""
+    index = responses.request_data["index"]
+
+    if index not in self.state.pending_files:
+      return
+
+    file_tracker = self.state.pending_files[index]
+
+    # Support old clients which may not have the new client action in place yet.
+    if not responses.success:
+      logging.debug(
+          "HashBufferChunks action failed, falling back to HashBuffer.")
+      self._HashFixedSizeChunks(index, file_tracker)
+      return
+
+    file_tracker["variable_chunks"] = True
+    self._AddChunkHashes(file_tracker, list(responses))
+
+  @flow.StateHandler()
+  def CheckHashManifest(self, responses):
+    """Adds all chunk hashes in the manifest to the file tracker."""
+    index = responses.request_data["index"]
+
+    if index not in self.state.pending_files:
+      return
+
+    file_tracker = self.state.pending_files[index]
+
+    # Support old clients which may not have the new client action in place yet.
+    if not responses.success:
+      logging.debug(
+          "HashBufferManifest action failed, falling back to HashBuffer.")
+      self._HashFixedSizeChunks(index, file_tracker)
+      return
+
+    hash_list = []
+    for manifest in responses:
+      hash_list.extend(manifest.GetBufferReferences())
+
+    self._AddChunkHashes(file_tracker, hash_list)
+
+  def _AddChunkHashes(self, file_tracker, hash_list):
+    """Queues the hashes of all chunks of a file for download."""
+    # The file might have changed since we stat'ed it, the chunks cover what
+    # the client actually read.
+    file_tracker["size_to_download"] = sum(r.length for r in hash_list)
+    file_tracker.setdefault("hash_list", []).extend(hash_list)
+
+    self.state.blob_hashes_pending += len(hash_list)
+
+    if self.state.blob_hashes_pending > self.MIN_CALL_TO_FILE_STORE:
+      self.FetchFileContent()
+
   @flow.StateHandler()
   def CheckHash(self, responses):
     """Adds the block hash to the file tracker responsible for this vfs URN."""
@@ -681,7 +764,9 @@ class MultiGetFileMixin(object):
                                                    response.length))
 
       download_size = file_tracker["size_to_download"]
-      if (response.length < self.CHUNK_SIZE or
+      # Content defined chunks are short whenever the content says so.
+      variable_chunks = file_tracker.get("variable_chunks", False)
+      if ((response.length < self.CHUNK_SIZE and not variable_chunks) or
           response.offset + response.length >= download_size):
 
         # Write the file to the data store.
@@ -692,6 +777,8 @@ class MultiGetFileMixin(object):
             urn, aff4_grr.VFSBlobImage, mode="w", token=self.token) as fd:
 
           fd.SetChunksize(self.CHUNK_SIZE)
+          if variable_chunks:
+            fd.EnableVariableSizeChunks()
           fd.Set(fd.Schema.STAT(stat_entry))
           fd.Set(fd.Schema.PATHSPEC(stat_entry.pathspec))
           fd.Set(fd.Schema.CONTENT_LAST(rdfvalue.RDFDatetime().Now()))
@@ -745,7 +832,8 @@ class MultiGetFile(MultiGetFileMixin, flow.GRRFlow):
     super(MultiGetFile, self).Start(
         file_size=self.args.file_size,
         maximum_pending_files=self.args.maximum_pending_files,
-        use_external_stores=self.args.use_external_stores)
+        use_external_stores=self.args.use_external_stores,
+        content_defined_chunking=self.args.use_content_defined_chunking)
 
     unique_paths = set()
 
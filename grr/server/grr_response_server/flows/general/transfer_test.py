@@ -6,6 +6,7 @@ import os
 import platform
 import unittest
 
+from grr_response_client.client_actions import standard
 from grr.lib import constants
 from grr.lib import flags
 from grr.lib import utils
@@ -346,6 +347,99 @@ class TestTransfer(flow_test_lib.FlowTestsBaseclass):
 
     self.assertEqual(client_mock.action_counts["TransferBuffer"], 1)
 
+  def _MultiGetFileWithContentDefinedChunking(self, path):
+    return self._MultiGetGeneratedFile(path, use_content_defined_chunking=True)
+
+  def _MultiGetGeneratedFile(self, path, use_content_defined_chunking=False):
+    client_mock = action_mocks.MultiGetFileClientMock()
+    pathspec = rdf_paths.PathSpec(
+        pathtype=rdf_paths.PathSpec.PathType.OS, path=path)
+    args = transfer.MultiGetFileArgs(
+        pathspecs=[pathspec],
+        use_content_defined_chunking=use_content_defined_chunking)
+    flow_test_lib.TestFlowHelper(
+        transfer.MultiGetFile.__name__,
+        client_mock,
+        token=self.token,
+        client_id=self.client_id,
+        args=args)
+
+    fd = aff4.FACTORY.Open(pathspec.AFF4Path(self.client_id), token=self.token)
+    with open(path, "rb") as model_fd:
+      self.assertEqual(fd.Read(fd.size + 1), model_fd.read())
+
+    return client_mock
+
+  def _WriteGeneratedFile(self, size):
+    path = os.path.join(self.temp_dir, "generated_file")
+    with open(path, "wb") as fd:
+      fd.write("".join(
+          hashlib.sha256(str(i)).digest() for i in xrange(size / 32)))
+    return path
+
+  def testMultiGetFileUsesHashManifest(self):
+    path = self._WriteGeneratedFile(3 * transfer.MultiGetFile.CHUNK_SIZE + 64)
+
+    client_mock = self._MultiGetGeneratedFile(path)
+    self.assertEqual(client_mock.action_counts["HashBufferManifest"], 1)
+    self.assertEqual(client_mock.action_counts["HashBuffer"], 0)
+    self.assertEqual(client_mock.action_counts["TransferBuffer"], 4)
+
+  def testMultiGetFileSplitsLargeHashManifests(self):
+    path = self._WriteGeneratedFile(5 * transfer.MultiGetFile.CHUNK_SIZE)
+
+    with utils.Stubber(standard.HashBufferManifest,
+                       "MAX_DIGESTS_PER_MANIFEST", 2):
+      client_mock = self._MultiGetGeneratedFile(path)
+
+    self.assertEqual(client_mock.action_counts["TransferBuffer"], 5)
+
+  def testMultiGetFileHashManifestFallback(self):
+    path = self._WriteGeneratedFile(3 * transfer.MultiGetFile.CHUNK_SIZE + 64)
+
+    def Unsupported(unused_self, unused_args):
+      raise RuntimeError("HashBufferManifest is not supported.")
+
+    # Clients which can't send hash manifests hash every chunk separately.
+    with utils.Stubber(standard.HashBufferManifest, "Run", Unsupported):
+      client_mock = self._MultiGetGeneratedFile(path)
+
+    self.assertEqual(client_mock.action_counts["HashBuffer"], 4)
+
+  def testMultiGetFileContentDefinedChunking(self):
+    data = "".join(hashlib.sha256(str(i)).digest() for i in xrange(100000))
+    path = os.path.join(self.temp_dir, "growing_file")
+    with open(path, "wb") as fd:
+      fd.write(data)
+
+    client_mock = self._MultiGetFileWithContentDefinedChunking(path)
+    self.assertEqual(client_mock.action_counts["HashBufferChunks"], 1)
+    self.assertFalse(client_mock.action_counts.get("HashBuffer"))
+    chunk_count = client_mock.action_counts["TransferBuffer"]
+    self.assertGreater(chunk_count, 1)
+
+    # Inserting data shifts all fixed size chunks but only one content defined
+    # chunk has to be transferred again.
+    with open(path, "wb") as fd:
+      fd.write(data[:1000] + "inserted" + data[1000:])
+
+    client_mock = self._MultiGetFileWithContentDefinedChunking(path)
+    self.assertEqual(client_mock.action_counts["TransferBuffer"], 1)
+
+  def testMultiGetFileContentDefinedChunkingFallback(self):
+    path = os.path.join(self.temp_dir, "test_file")
+    with open(path, "wb") as fd:
+      fd.write("".join(hashlib.sha256(str(i)).digest() for i in xrange(50000)))
+
+    def Unsupported(unused_self, unused_args):
+      raise RuntimeError("HashBufferChunks is not supported.")
+
+    # Clients which can't hash content defined chunks use fixed size chunks.
+    with utils.Stubber(standard.HashBufferChunks, "Run", Unsupported):
+      client_mock = self._MultiGetFileWithContentDefinedChunking(path)
+
+    self.assertEqual(client_mock.action_counts["HashBuffer"], 4)
+
   def testMultiGetFileSetsFileHashAttributeWhenMultipleChunksDownloaded(self):
     client_mock = action_mocks.MultiGetFileClientMock()
     pathspec = rdf_paths.PathSpec(
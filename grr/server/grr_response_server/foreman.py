@@ -2,6 +2,7 @@
 """RDFValue instances related to the foreman implementation."""
 
 import itertools
+import operator
 
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -13,6 +14,43 @@ from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import data_store
 
 
+class ForemanClientFields(object):
+  """The client fields foreman rules are evaluated on.
+
+  Every field is only resolved once per client, no matter how many rules use
+  it.
+  """
+
+  def __init__(self, client_obj):
+    """Constructor.
+
+    Args:
+      client_obj: Either an aff4 client object or a `db.ClientFullInfo` instance
+                  if the relational db is used for reading.
+    """
+    self.client_obj = client_obj
+    self.relational = data_store.RelationalDBReadEnabled()
+    self._values = {}
+
+  def Get(self, rule, field=None):
+    """Returns the value of a field as resolved by rules of the given type."""
+    key = (rule.__class__, field)
+    try:
+      return self._values[key]
+    except KeyError:
+      pass
+
+    # pylint: disable=protected-access
+    if self.relational:
+      value = rule._ResolveField(field, self.client_obj)
+    else:
+      value = rule._ResolveFieldAFF4(field, self.client_obj)
+    # pylint: enable=protected-access
+
+    self._values[key] = value
+    return value
+
+
 # TODO(amoser): Rename client_obj once relational db becomes standard.
 class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
   """Abstract base class of foreman client rules."""
@@ -27,6 +65,15 @@ class ForemanClientRuleBase(rdf_structs.RDFProtoStruct):
     Returns:
       A bool value of the evaluation.
     """
+    return self.Compile()(ForemanClientFields(client_obj))
+
+  def Compile(self):
+    """Compiles the rule represented by this object.
+
+    Returns:
+      A function taking a ForemanClientFields instance which returns the bool
+      value of the evaluation.
+    """
     raise NotImplementedError
 
   def Validate(self):
@@ -37,20 +84,26 @@ class ForemanOsClientRule(ForemanClientRuleBase):
   """This rule will fire if the client OS is marked as true in the proto."""
   protobuf = jobs_pb2.ForemanOsClientRule
 
-  def Evaluate(self, client_obj):
-    if data_store.RelationalDBReadEnabled():
-      value = client_obj.last_snapshot.knowledge_base.os
-    else:
-      value = client_obj.Get(client_obj.Schema.SYSTEM)
+  def _ResolveFieldAFF4(self, unused_field, client_obj):
+    return utils.SmartStr(client_obj.Get(client_obj.Schema.SYSTEM) or "")
+
+  def _ResolveField(self, unused_field, client_info):
+    return utils.SmartStr(client_info.last_snapshot.knowledge_base.os or "")
 
-    if not value:
-      return False
+  def Compile(self):
+    prefixes = []
+    if self.os_windows:
+      prefixes.append("Windows")
+    if self.os_linux:
+      prefixes.append("Linux")
+    if self.os_darwin:
+      prefixes.append("Darwin")
+    prefixes = tuple(prefixes)
 
-    value = utils.SmartStr(value)
+    def Evaluate(client_fields):
+      return client_fields.Get(self).startswith(prefixes)
 
-    return ((self.os_windows and value.startswith("Windows")) or
-            (self.os_linux and value.startswith("Linux")) or
-            (self.os_darwin and value.startswith("Darwin")))
+    return Evaluate
 
   def Validate(self):
     pass
@@ -60,7 +113,13 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
   """This rule will fire if the client has the selected label."""
   protobuf = jobs_pb2.ForemanLabelClientRule
 
-  def Evaluate(self, client_obj):
+  def _ResolveFieldAFF4(self, unused_field, client_obj):
+    return set(client_obj.GetLabelsNames())
+
+  def _ResolveField(self, unused_field, client_info):
+    return set(label.name for label in client_info.labels)
+
+  def Compile(self):
     if self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ALL:
       quantifier = all
     elif self.match_mode == ForemanLabelClientRule.MatchMode.MATCH_ANY:
@@ -72,12 +131,13 @@ class ForemanLabelClientRule(ForemanClientRuleBase):
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
-    if data_store.RelationalDBReadEnabled():
-      client_label_names = [label.name for label in client_obj.labels]
-    else:
-      client_label_names = set(client_obj.GetLabelsNames())
+    label_names = list(self.label_names)
 
-    return quantifier((name in client_label_names) for name in self.label_names)
+    def Evaluate(client_fields):
+      client_label_names = client_fields.Get(self)
+      return quantifier((name in client_label_names) for name in label_names)
+
+    return Evaluate
 
   def Validate(self):
     pass
@@ -177,13 +237,14 @@ class ForemanRegexClientRule(ForemanClientRuleBase):
       return ""
     return utils.SmartStr(res)
 
-  def Evaluate(self, client_obj):
-    if data_store.RelationalDBReadEnabled():
-      value = self._ResolveField(self.field, client_obj)
-    else:
-      value = self._ResolveFieldAFF4(self.field, client_obj)
+  def Compile(self):
+    field = self.field
+    search = self.attribute_regex.Search
 
-    return self.attribute_regex.Search(value)
+    def Evaluate(client_fields):
+      return search(client_fields.Get(self, field))
+
+    return Evaluate
 
   def Validate(self):
     if self.field == ForemanRegexClientRule.ForemanStringField.UNSET:
@@ -241,25 +302,29 @@ class ForemanIntegerClientRule(ForemanClientRuleBase):
       return
     return res.AsSecondsSinceEpoch()
 
-  def Evaluate(self, client_obj):
-    if data_store.RelationalDBReadEnabled():
-      value = self._ResolveField(self.field, client_obj)
-    else:
-      value = self._ResolveFieldAFF4(self.field, client_obj)
+  def Compile(self):
+    field = self.field
+    op = self.operator
+    rule_value = self.value
 
-    if value is None:
-      return False
+    operators = ForemanIntegerClientRule.Operator
+    compare = {
+        int(operators.LESS_THAN): operator.lt,
+        int(operators.GREATER_THAN): operator.gt,
+        int(operators.EQUAL): operator.eq,
+    }.get(int(op))
 
-    op = self.operator
-    if op == ForemanIntegerClientRule.Operator.LESS_THAN:
-      return value < self.value
-    elif op == ForemanIntegerClientRule.Operator.GREATER_THAN:
-      return value > self.value
-    elif op == ForemanIntegerClientRule.Operator.EQUAL:
-      return value == self.value
-    else:
-      # Unknown operator.
-      raise ValueError("Unknown operator: %d" % op)
+    def Evaluate(client_fields):
+      value = client_fields.Get(self, field)
+      if value is None:
+        return False
+
+      if compare is None:
+        # Unknown operator.
+        raise ValueError("Unknown operator: %d" % op)
+      return compare(value, rule_value)
+
+    return Evaluate
 
   def Validate(self):
     if self.field == ForemanIntegerClientRule.ForemanIntegerField.UNSET:
@@ -284,8 +349,8 @@ class ForemanClientRule(ForemanClientRuleBase):
       ForemanRegexClientRule,
   ]
 
-  def Evaluate(self, client_obj):
-    return self.UnionCast().Evaluate(client_obj)
+  def Compile(self):
+    return self.UnionCast().Compile()
 
   def Validate(self):
     self.UnionCast().Validate()
@@ -309,6 +374,18 @@ class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
     Returns:
       A bool value of the evaluation.
 
+    Raises:
+      ValueError: The match mode is of unknown value.
+    """
+    return self.Compile()(ForemanClientFields(client_obj))
+
+  def Compile(self):
+    """Compiles the rules held in the rule set.
+
+    Returns:
+      A function taking a ForemanClientFields instance which returns the bool
+      value of the evaluation.
+
     Raises:
       ValueError: The match mode is of unknown value.
     """
@@ -319,7 +396,12 @@ class ForemanClientRuleSet(rdf_structs.RDFProtoStruct):
     else:
       raise ValueError("Unexpected match mode value: %s" % self.match_mode)
 
-    return quantifier(rule.Evaluate(client_obj) for rule in self.rules)
+    rules = [rule.Compile() for rule in self.rules]
+
+    def Evaluate(client_fields):
+      return quantifier(rule(client_fields) for rule in rules)
+
+    return Evaluate
 
   def Validate(self):
     for rule in self.rules:
@@ -349,3 +431,30 @@ class ForemanRule(rdf_structs.RDFProtoStruct):
 class ForemanRules(rdf_protodict.RDFValueArray):
   """A list of rules that the foreman will apply."""
   rdf_type = ForemanRule
+
+
+# Compiled client rule sets of recently used foreman rules, keyed by the
+# serialized rules.
+_COMPILED_RULE_SETS = utils.FastStore(max_size=10)
+
+
+def CompileClientRuleSets(rules):
+  """Compiles the client rule sets of the given foreman rules.
+
+  Compiled rule sets are shared within the process and only compiled again
+  when the rules change.
+
+  Args:
+    rules: A ForemanRules instance.
+
+  Returns:
+    A list holding the compiled client rule set of each rule, see
+    ForemanClientRuleSet.Compile().
+  """
+  key = rules.SerializeToString()
+  try:
+    return _COMPILED_RULE_SETS.Get(key)
+  except KeyError:
+    compiled = [rule.client_rule_set.Compile() for rule in rules]
+    _COMPILED_RULE_SETS.Put(key, compiled)
+    return compiled
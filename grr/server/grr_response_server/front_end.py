@@ -3,6 +3,7 @@
 
 import logging
 import operator
+import threading
 import time
 
 from grr import config
@@ -208,7 +209,7 @@ class RelationalServerCommunicator(communicator.Communicator):
       raise communicator.UnknownClientCert("Stored cert mismatch")
 
     pub_key = cert.GetPublicKey()
-    self.pub_key_cache.Put(common_name, pub_key)
+    self.pub_key_cache.Put(remote_client_id, pub_key)
     return pub_key
 
   def VerifyMessageSignature(self, response_comms, packed_message_list, cipher,
@@ -292,6 +293,117 @@ class RelationalServerCommunicator(communicator.Communicator):
     return rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED
 
 
+class MessageBatchTimeoutError(Exception):
+  """Raised when a message batch was not stored in time."""
+
+
+class _MessageBatch(object):
+  """Messages of several client requests which are flushed together."""
+
+  def __init__(self, token):
+    self.manager = queue_manager.QueueManager(token=token)
+    self.manager.FreezeTimestamp()
+    self.created = time.time()
+    self.message_count = 0
+    self.flushed = threading.Event()
+    self.error = None
+
+
+class MessageBatcher(object):
+  """Coalesces messages of concurrent client requests into shared flushes.
+
+  Every request adds its messages to the currently open batch and then blocks
+  until that batch has been written to the data store. The first request of a
+  batch waits up to max_delay seconds for others to join before flushing, a
+  request which makes the batch reach max_batch_size flushes it right away.
+
+  Since requests only return once their messages are stored and flush errors
+  are raised in all requests of a batch, clients only consider messages
+  delivered which were actually stored. If queueing the messages of a request
+  fails, the whole batch is dropped and the error is raised in all of its
+  requests as well.
+  """
+
+  def __init__(self,
+               token,
+               max_batch_size=1000,
+               max_delay=0.05,
+               flush_timeout=600):
+    self.token = token
+    self.max_batch_size = max_batch_size
+    self.max_delay = max_delay
+    self.flush_timeout = flush_timeout
+    self.lock = threading.Lock()
+    self.batch = None
+
+  def QueueMessages(self, callback):
+    """Queues messages in the open batch and waits until they are stored.
+
+    Args:
+      callback: A callable which receives the batch's QueueManager, queues the
+        messages on it and returns the number of queued messages. This is
+        called with the batcher's lock held so it should not block.
+
+    Raises:
+      MessageBatchTimeoutError: If the batch was not stored within
+        flush_timeout seconds.
+      Exception: Whatever exception queueing or flushing the batch raised.
+    """
+    start_time = time.time()
+    with self.lock:
+      batch = self.batch
+      leader = batch is None
+      if leader:
+        batch = self.batch = _MessageBatch(self.token)
+
+      try:
+        batch.message_count += callback(batch.manager)
+      except Exception as e:  # pylint: disable=broad-except
+        # The batch's manager might hold some of this request's messages now,
+        # so none of the batch is stored and all its requests fail.
+        logging.exception("Error queueing messages: %s", e)
+        self.batch = None
+        batch.error = e
+        batch.manager.UnfreezeTimestamp()
+        batch.flushed.set()
+        raise
+
+      flush = batch.message_count >= self.max_batch_size
+      if flush:
+        self.batch = None
+
+    if not flush and leader and not batch.flushed.wait(self.max_delay):
+      with self.lock:
+        # The batch might have been closed by a request which filled it.
+        flush = self.batch is batch
+        if flush:
+          self.batch = None
+
+    if flush:
+      self._Flush(batch)
+    elif not batch.flushed.wait(self.flush_timeout):
+      raise MessageBatchTimeoutError(
+          "Message batch was not stored within %d seconds." %
+          self.flush_timeout)
+
+    stats.STATS.RecordEvent("frontend_message_batch_latency",
+                            time.time() - start_time)
+    if batch.error is not None:
+      raise batch.error  # pylint: disable=raising-bad-type
+
+  def _Flush(self, batch):
+    try:
+      batch.manager.Flush()
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Error flushing message batch: %s", e)
+      batch.error = e
+    finally:
+      batch.manager.UnfreezeTimestamp()
+      batch.flushed.set()
+
+    stats.STATS.RecordEvent("frontend_message_batch_size", batch.message_count)
+
+
 class FrontEndServer(object):
   """This is the front end server.
 
@@ -312,7 +424,7 @@ class FrontEndServer(object):
                max_queue_size=50,
                message_expiry_time=120,
                max_retransmission_time=10,
-               threadpool_prefix="grr_threadpool"):
+               threadpool_prefix="grr_frontend_threadpool"):
     # Identify ourselves as the server.
     self.token = access_control.ACLToken(
         username="GRRFrontEnd", reason="Implied.")
@@ -354,6 +466,14 @@ class FrontEndServer(object):
         for flow_name in whitelist & available_wkf_set
     }
 
+    # Messages of concurrent requests are stored in shared batches if enabled.
+    self.message_batcher = None
+    if config.CONFIG["Frontend.message_batch_size"]:
+      self.message_batcher = MessageBatcher(
+          self.token,
+          max_batch_size=config.CONFIG["Frontend.message_batch_size"],
+          max_delay=config.CONFIG["Frontend.message_batch_max_delay"])
+
   @stats.Counted("grr_frontendserver_handle_num")
   @stats.Timed("grr_frontendserver_handle_time")
   def HandleMessageBundles(self, request_comms, response_comms):
@@ -365,7 +485,11 @@ class FrontEndServer(object):
 
     Args:
        request_comms: A ClientCommunication rdfvalue with messages sent by the
-       client. source should be set to the client CN.
+       client. source should be set to the client CN. For streaming uploads,
+       this is an iterable of ClientCommunication bundles which are decoded
+       as they arrive. Their messages are only received once all bundles
+       were decoded, so a request which fails part way through does not
+       leave messages behind which its retry would queue again.
 
        response_comms: A ClientCommunication rdfvalue of jobs destined to this
        client.
@@ -373,9 +497,29 @@ class FrontEndServer(object):
     Returns:
        tuple of (source, message_count) where message_count is the number of
        messages received from the client with common name source.
+
+    Raises:
+       communicator.DecodingError: If a streaming upload has no bundles or the
+       bundles don't belong to the same request.
     """
-    messages, source, timestamp = self._communicator.DecodeMessages(
-        request_comms)
+    if isinstance(request_comms, rdf_flows.ClientCommunication):
+      request_comms = [request_comms]
+
+    source = timestamp = last_bundle = None
+    messages = []
+    for bundle in request_comms:
+      bundle_messages, bundle_source, bundle_timestamp = (
+          self._communicator.DecodeMessages(bundle))
+      if last_bundle is None:
+        source, timestamp = bundle_source, bundle_timestamp
+      elif bundle_source != source or bundle_timestamp != timestamp:
+        raise communicator.DecodingError(
+            "Message bundles of a request from %s don't match." % source)
+      last_bundle = bundle
+      messages.extend(bundle_messages)
+
+    if last_bundle is None:
+      raise communicator.DecodingError("No message bundles received.")
 
     now = time.time()
     if messages:
@@ -383,7 +527,7 @@ class FrontEndServer(object):
       self.ReceiveMessages(source, messages)
 
     # We send the client a maximum of self.max_queue_size messages
-    required_count = max(0, self.max_queue_size - request_comms.queue_size)
+    required_count = max(0, self.max_queue_size - last_bundle.queue_size)
     tasks = []
 
     message_list = rdf_flows.MessageList()
@@ -401,7 +545,7 @@ class FrontEndServer(object):
           response_comms,
           destination=source,
           timestamp=timestamp,
-          api_version=request_comms.api_version)
+          api_version=last_bundle.api_version)
     except communicator.UnknownClientCert:
       # We can not encode messages to the client yet because we do not have the
       # client certificate - return them to the queue so we can try again later.
@@ -551,68 +695,102 @@ class FrontEndServer(object):
       messages: A list of GrrMessage RDFValues.
     """
     now = time.time()
-    with queue_manager.QueueManager(token=self.token) as manager:
-      for session_id, msgs in utils.GroupBy(
-          messages, operator.attrgetter("session_id")).iteritems():
-
-        # Remove and handle messages to WellKnownFlows
-        leftover_msgs = self.HandleWellKnownFlows(msgs)
-
-        unprocessed_msgs = []
-        for msg in leftover_msgs:
-          if (msg.auth_state == msg.AuthorizationState.AUTHENTICATED or
-              msg.session_id == self.unauth_allowed_session_id):
-            unprocessed_msgs.append(msg)
+    messages_by_session_id = {}
+    for session_id, msgs in utils.GroupBy(
+        messages, operator.attrgetter("session_id")).iteritems():
+
+      # Remove and handle messages to WellKnownFlows
+      leftover_msgs = self.HandleWellKnownFlows(msgs)
+
+      unprocessed_msgs = []
+      for msg in leftover_msgs:
+        if (msg.auth_state == msg.AuthorizationState.AUTHENTICATED or
+            msg.session_id == self.unauth_allowed_session_id):
+          unprocessed_msgs.append(msg)
+
+      if len(unprocessed_msgs) < len(leftover_msgs):
+        logging.info("Dropped %d unauthenticated messages for %s",
+                     len(leftover_msgs) - len(unprocessed_msgs), client_id)
+
+      if unprocessed_msgs:
+        messages_by_session_id[session_id] = unprocessed_msgs
+
+    if self.message_batcher is not None:
+      self.message_batcher.QueueMessages(
+          lambda manager: self._QueueMessages(client_id, messages_by_session_id,
+                                              manager))
+    else:
+      with queue_manager.QueueManager(token=self.token) as manager:
+        self._QueueMessages(client_id, messages_by_session_id, manager)
 
-        if len(unprocessed_msgs) < len(leftover_msgs):
-          logging.info("Dropped %d unauthenticated messages for %s",
-                       len(leftover_msgs) - len(unprocessed_msgs), client_id)
+    for session_id, msgs in messages_by_session_id.iteritems():
+      for msg in msgs:
+        # Messages for well known flows are never statuses.
+        if msg.request_id == 0:
+          break
 
-        if not unprocessed_msgs:
+        if msg.type != rdf_flows.GrrMessage.Type.STATUS:
           continue
 
-        for msg in unprocessed_msgs:
-          manager.QueueResponse(msg)
-
-        for msg in unprocessed_msgs:
-          # Messages for well known flows should notify even though they don't
-          # have a status.
-          if msg.request_id == 0:
-            manager.QueueNotification(
-                session_id=msg.session_id, priority=msg.priority)
-            # Those messages are all the same, one notification is enough.
-            break
-          elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
-            # If we receive a status message from the client it means the client
-            # has finished processing this request. We therefore can de-queue it
-            # from the client queue. msg.task_id will raise if the task id is
-            # not set (message originated at the client, there was no request on
-            # the server), so we have to check .HasTaskID() first.
-            if msg.HasTaskID():
-              manager.DeQueueClientRequest(client_id, msg.task_id)
-
-            manager.QueueNotification(
-                session_id=msg.session_id,
-                priority=msg.priority,
-                last_status=msg.request_id)
-
-            stat = rdf_flows.GrrStatus(msg.payload)
-            if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
-              # A client crashed while performing an action, fire an event.
-              crash_details = rdf_client.ClientCrash(
-                  client_id=client_id,
-                  session_id=session_id,
-                  backtrace=stat.backtrace,
-                  crash_message=stat.error_message,
-                  nanny_status=stat.nanny_status,
-                  timestamp=rdfvalue.RDFDatetime.Now())
-              events.Events.PublishEvent(
-                  "ClientCrash", crash_details, token=self.token)
+        stat = rdf_flows.GrrStatus(msg.payload)
+        if stat.status == rdf_flows.GrrStatus.ReturnedStatus.CLIENT_KILLED:
+          # A client crashed while performing an action, fire an event.
+          crash_details = rdf_client.ClientCrash(
+              client_id=client_id,
+              session_id=session_id,
+              backtrace=stat.backtrace,
+              crash_message=stat.error_message,
+              nanny_status=stat.nanny_status,
+              timestamp=rdfvalue.RDFDatetime.Now())
+          events.Events.PublishEvent(
+              "ClientCrash", crash_details, token=self.token)
 
     logging.debug("Received %s messages from %s in %s sec", len(messages),
                   client_id,
                   time.time() - now)
 
+  def _QueueMessages(self, client_id, messages_by_session_id, manager):
+    """Queues the responses and notifications for received messages.
+
+    Args:
+      client_id: The client which sent the messages.
+      messages_by_session_id: A dict of lists of GrrMessages keyed by session
+        id.
+      manager: The QueueManager to queue the messages on.
+
+    Returns:
+      The number of queued messages.
+    """
+    count = 0
+    for msgs in messages_by_session_id.itervalues():
+      for msg in msgs:
+        manager.QueueResponse(msg)
+      count += len(msgs)
+
+      for msg in msgs:
+        # Messages for well known flows should notify even though they don't
+        # have a status.
+        if msg.request_id == 0:
+          manager.QueueNotification(
+              session_id=msg.session_id, priority=msg.priority)
+          # Those messages are all the same, one notification is enough.
+          break
+        elif msg.type == rdf_flows.GrrMessage.Type.STATUS:
+          # If we receive a status message from the client it means the client
+          # has finished processing this request. We therefore can de-queue it
+          # from the client queue. msg.task_id will raise if the task id is
+          # not set (message originated at the client, there was no request on
+          # the server), so we have to check .HasTaskID() first.
+          if msg.HasTaskID():
+            manager.DeQueueClientRequest(client_id, msg.task_id)
+
+          manager.QueueNotification(
+              session_id=msg.session_id,
+              priority=msg.priority,
+              last_status=msg.request_id)
+
+    return count
+
   def HandleWellKnownFlows(self, messages):
     """Hands off messages to well known flows."""
     msgs_by_wkf = {}
@@ -707,6 +885,10 @@ class FrontendInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_frontendserver_handle_num")
     stats.STATS.RegisterGaugeMetric("grr_frontendserver_client_cache_size", int)
     stats.STATS.RegisterCounterMetric("grr_messages_sent")
+    stats.STATS.RegisterEventMetric(
+        "frontend_message_batch_size",
+        bins=[1, 10, 50, 100, 500, 1000, 5000, 10000])
+    stats.STATS.RegisterEventMetric("frontend_message_batch_latency")
 
     stats.STATS.RegisterCounterMetric(
         "grr_pub_key_cache", fields=[("type", str)])
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""Benchmarks for the client to frontend communication."""
+
+import os
+import time
+
+import requests
+
+from grr import config
+from grr_response_client import comms
+from grr.lib import flags
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import flows as rdf_flows
+from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.server.grr_response_server import aff4
+from grr.server.grr_response_server import front_end
+from grr.server.grr_response_server.aff4_objects import aff4_grr
+from grr.test_lib import benchmark_test_lib
+from grr.test_lib import test_lib
+from grr.test_lib import worker_mocks
+
+
+class ServerCommunicatorBenchmark(benchmark_test_lib.AverageMicroBenchmarks):
+  """Throughput of ServerCommunicator.DecodeMessages."""
+
+  REPEATS = 200
+  units = "us"
+
+  def setUp(self):
+    super(ServerCommunicatorBenchmark, self).setUp()
+
+    client_private_key = config.CONFIG["Client.private_key"]
+    client_cert = self.ClientCertFromPrivateKey(client_private_key)
+    with aff4.FACTORY.Create(
+        client_cert.GetCN(), aff4_grr.VFSGRRClient,
+        token=self.token) as client:
+      client.Set(client.Schema.CERT, client_cert)
+
+    client_communicator = comms.ClientCommunicator(
+        private_key=client_private_key)
+    # Loading the server certificate updates the config.
+    with test_lib.PreserveConfig():
+      client_communicator.LoadServerCertificate(
+          server_certificate=config.CONFIG["Frontend.certificate"],
+          ca_certificate=config.CONFIG["CA.certificate"])
+
+    message_list = rdf_flows.MessageList()
+    for i in range(1, 11):
+      message_list.job.Append(
+          session_id=rdfvalue.SessionID(
+              base="aff4:/flows", queue=queues.FLOWS, flow_name=i),
+          name="OMG it's a string")
+
+    result = rdf_flows.ClientCommunication()
+    client_communicator.EncodeMessages(message_list, result)
+    self.cipher_text = result.SerializeToString()
+
+    self.server_communicator = front_end.ServerCommunicator(
+        certificate=config.CONFIG["Frontend.certificate"],
+        private_key=config.CONFIG["PrivateKeys.server_key"],
+        token=self.token)
+
+  def _Decode(self):
+    messages, _, _ = self.server_communicator.DecryptMessage(self.cipher_text)
+    return len(messages)
+
+  def testDecodeMessages(self):
+    """Decoding repeat requests with and without the cipher cache."""
+    self.TimeIt(
+        self._Decode, name="DecodeMessages (cached cipher)", pre=self._Decode)
+
+    # A cache which can not hold any ciphers forces RSA work on every request.
+    with utils.Stubber(self.server_communicator, "encrypted_cipher_cache",
+                       utils.FastStore(max_size=0)):
+      self.TimeIt(self._Decode, name="DecodeMessages (no cipher cache)")
+
+
+class ClientRunOnceBenchmark(benchmark_test_lib.MicroBenchmarks):
+  """Throughput of outbound client messages through GRRHTTPClient.RunOnce."""
+
+  units = "s"
+
+  ROUNDS = 10
+  MESSAGES_PER_ROUND = 100
+  MESSAGE_SIZE = 64 * 1024
+
+  def setUp(self):
+    super(ClientRunOnceBenchmark, self).setUp(
+        extra_fields=["Bytes/sec"], extra_format=["<20"])
+
+    self.config_stubber = test_lib.PreserveConfig()
+    self.config_stubber.Start()
+
+    client_private_key = config.CONFIG["Client.private_key"]
+    client_cert = self.ClientCertFromPrivateKey(client_private_key)
+    with aff4.FACTORY.Create(
+        client_cert.GetCN(), aff4_grr.VFSGRRClient,
+        token=self.token) as client:
+      client.Set(client.Schema.CERT, client_cert)
+
+    self.server_communicator = front_end.ServerCommunicator(
+        certificate=config.CONFIG["Frontend.certificate"],
+        private_key=config.CONFIG["PrivateKeys.server_key"],
+        token=self.token)
+
+    self.client_communicator = comms.GRRHTTPClient(
+        ca_cert=config.CONFIG["CA.certificate"],
+        worker_cls=worker_mocks.DisabledNannyClientWorker)
+    # Disable stats collection.
+    self.client_communicator.client_worker.last_stats_sent_time = (
+        time.time() + 3600)
+    self.client_communicator.communicator.LoadServerCertificate(
+        config.CONFIG["Frontend.certificate"], config.CONFIG["CA.certificate"])
+
+    self.server_time = 0
+    self.requests_stubber = utils.Stubber(requests, "request", self._UrlMock)
+    self.requests_stubber.Start()
+
+  def tearDown(self):
+    self.requests_stubber.Stop()
+    self.config_stubber.Stop()
+    super(ClientRunOnceBenchmark, self).tearDown()
+
+  def _UrlMock(self, url=None, data=None, **_):
+    """Answers client requests, the time spent here is not client time."""
+    start = time.time()
+
+    response = requests.Response()
+    response.status_code = 200
+    if "server.pem" in url:
+      response._content = utils.SmartStr(  # pylint: disable=protected-access
+          config.CONFIG["Frontend.certificate"])
+    else:
+      client_communication = rdf_flows.ClientCommunication.FromSerializedString(
+          data)
+      _, source, timestamp = self.server_communicator.DecodeMessages(
+          client_communication)
+
+      response_communication = rdf_flows.ClientCommunication()
+      self.server_communicator.EncodeMessages(
+          rdf_flows.MessageList(),
+          response_communication,
+          destination=source,
+          timestamp=timestamp,
+          api_version=client_communication.api_version)
+      response._content = response_communication.SerializeToString()  # pylint: disable=protected-access
+
+    self.server_time += time.time() - start
+    return response
+
+  def testRunOnceThroughput(self):
+    """Sending large incompressible payloads to the server."""
+    client_worker = self.client_communicator.client_worker
+    # Random data does not compress, like most uploaded file contents.
+    payload = rdf_protodict.DataBlob(data=os.urandom(self.MESSAGE_SIZE))
+
+    total_time = 0
+    for _ in range(self.ROUNDS):
+      for i in range(self.MESSAGES_PER_ROUND):
+        client_worker.SendReply(
+            payload,
+            session_id=rdfvalue.SessionID("W:session"),
+            request_id=1,
+            response_id=i)
+
+      self.server_time = 0
+      start = time.time()
+      status = self.client_communicator.RunOnce()
+      total_time += time.time() - start - self.server_time
+      self.assertEqual(status.code, 200)
+
+    total_bytes = self.ROUNDS * self.MESSAGES_PER_ROUND * self.MESSAGE_SIZE
+    self.AddResult("RunOnce (%d KiB messages)" % (self.MESSAGE_SIZE // 1024),
+                   total_time, self.ROUNDS, int(total_bytes / total_time))
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -4,6 +4,7 @@
 import array
 import logging
 import pdb
+import threading
 import time
 
 import requests
@@ -165,6 +166,118 @@ class GRRFEServerTest(front_end_test_lib.FrontEndServerTest):
     completed = list(manager.FetchCompletedRequests(session_id))
     self.assertEqual(len(completed), 1)
 
+  def testReceiveMessagesBatched(self):
+    client_id = test_lib.TEST_CLIENT_ID
+    session_ids = []
+    messages = []
+    for _ in range(2):
+      flow_obj = self.FlowSetup(
+          flow_test_lib.FlowOrderTest.__name__, client_id=client_id)
+      session_ids.append(flow_obj.session_id)
+      messages.append([
+          rdf_flows.GrrMessage(
+              request_id=1,
+              response_id=i,
+              session_id=flow_obj.session_id,
+              auth_state="AUTHENTICATED",
+              payload=rdfvalue.RDFInteger(i)) for i in range(1, 11)
+      ])
+
+    batch_size = stats.STATS.GetMetricValue("frontend_message_batch_size")
+    batch_count, batch_sum = batch_size.count, batch_size.sum
+
+    with test_lib.ConfigOverrider({
+        "Frontend.message_batch_size": 15,
+        "Frontend.message_batch_max_delay": 60
+    }):
+      self.InitTestServer()
+
+    # The first request waits for others to join its batch, the second one
+    # fills the batch and therefore flushes both right away.
+    threads = [
+        threading.Thread(
+            target=self.server.ReceiveMessages, args=(client_id, msgs))
+        for msgs in messages
+    ]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(30)
+      self.assertFalse(thread.isAlive())
+
+    for session_id, msgs in zip(session_ids, messages):
+      stored_messages = data_store.DB.ReadResponsesForRequestId(session_id, 1)
+      self.assertEqual(len(stored_messages), len(msgs))
+
+    batch_size = stats.STATS.GetMetricValue("frontend_message_batch_size")
+    self.assertEqual(batch_size.count - batch_count, 1)
+    self.assertEqual(batch_size.sum - batch_sum, 20)
+
+  def testReceiveMessagesBatchedRaisesFlushErrors(self):
+    with test_lib.ConfigOverrider({"Frontend.message_batch_size": 1}):
+      self.InitTestServer()
+
+    flow_obj = self.FlowSetup(
+        flow_test_lib.FlowOrderTest.__name__,
+        client_id=test_lib.TEST_CLIENT_ID)
+    messages = [
+        rdf_flows.GrrMessage(
+            request_id=1,
+            response_id=1,
+            session_id=flow_obj.session_id,
+            auth_state="AUTHENTICATED",
+            payload=rdfvalue.RDFInteger(1))
+    ]
+
+    def RaisingFlush(_):
+      raise IOError("Data store unavailable.")
+
+    with utils.Stubber(queue_manager.QueueManager, "Flush", RaisingFlush):
+      self.assertRaises(IOError, self.server.ReceiveMessages,
+                        test_lib.TEST_CLIENT_ID, messages)
+
+  def testMessageBatcherDropsBatchOnQueueingErrors(self):
+    batcher = front_end.MessageBatcher(
+        self.token, max_batch_size=2, max_delay=60)
+
+    def RaisingCallback(_):
+      raise IOError("Bad message.")
+
+    # The first request opens a batch and waits for others to join.
+    errors = []
+
+    def QueueOne():
+      try:
+        batcher.QueueMessages(lambda _: 1)
+      except IOError as e:
+        errors.append(e)
+
+    thread = threading.Thread(target=QueueOne)
+    thread.start()
+    while batcher.batch is None:
+      time.sleep(0.01)
+
+    # Queueing the second request fails, which fails the whole batch.
+    self.assertRaises(IOError, batcher.QueueMessages, RaisingCallback)
+    thread.join(30)
+    self.assertFalse(thread.isAlive())
+    self.assertEqual(len(errors), 1)
+
+    # Later requests get a new batch instead of waiting for the dropped one.
+    self.assertIsNone(batcher.batch)
+    batcher.QueueMessages(lambda _: 2)
+
+  def testMessageBatcherRaisesIfBatchIsNotStoredInTime(self):
+    batcher = front_end.MessageBatcher(
+        self.token, max_batch_size=2, max_delay=60, flush_timeout=0.1)
+    # A batch whose leader never flushes it.
+    # pylint: disable=protected-access
+    batcher.batch = front_end._MessageBatch(self.token)
+    # pylint: enable=protected-access
+
+    self.assertRaises(front_end.MessageBatchTimeoutError,
+                      batcher.QueueMessages, lambda _: 0)
+
   def testWellKnownFlows(self):
     """Make sure that well known flows can run on the front end."""
     flow_test_lib.WellKnownSessionTest.messages = []
@@ -394,6 +507,77 @@ class GRRFEServerTest(front_end_test_lib.FrontEndServerTest):
     # Since the server tried to send it, the ttl must be decremented
     self.assertEqual(tasks[0].task_ttl - new_tasks[0].task_ttl, 1)
 
+  def testHandleMessageBundlesStream(self):
+    """Check that all bundles of a streaming upload are received."""
+    client_id = self.SetupClient(0)
+
+    class MockCommunicator(object):
+      """A fake that decodes a single message per bundle."""
+
+      def __init__(self):
+        self.sources = {}
+
+      def DecodeMessages(self, bundle):
+        message = rdf_flows.GrrMessage(response_id=bundle.queue_size)
+        source = self.sources.get(bundle.queue_size, client_id)
+        return ([message], source, 100)
+
+      def EncodeMessages(self, *unused_args, **unused_kw):
+        pass
+
+    mock_communicator = MockCommunicator()
+    self.server._communicator = mock_communicator
+
+    received = []
+    with utils.Stubber(self.server, "ReceiveMessages",
+                       lambda _, messages: received.extend(messages)):
+      bundles = [rdf_flows.ClientCommunication(queue_size=i) for i in range(3)]
+      source, message_count = self.server.HandleMessageBundles(
+          iter(bundles), rdf_flows.ClientCommunication())
+
+    self.assertEqual(source, client_id)
+    self.assertEqual(message_count, 3)
+    self.assertEqual([m.response_id for m in received], [0, 1, 2])
+
+    # All bundles have to come from the same client. Nothing is received if
+    # a later bundle is rejected.
+    mock_communicator.sources[1] = self.SetupClient(1)
+    received = []
+    with utils.Stubber(self.server, "ReceiveMessages",
+                       lambda _, messages: received.extend(messages)):
+      with self.assertRaises(communicator.DecodingError):
+        self.server.HandleMessageBundles(
+            iter(bundles), rdf_flows.ClientCommunication())
+      self.assertEqual(received, [])
+
+      with self.assertRaises(communicator.DecodingError):
+        self.server.HandleMessageBundles(
+            iter([]), rdf_flows.ClientCommunication())
+
+  def testUnpackMessageBundles(self):
+    bundles = ["", "a", "bc" * 1000]
+    data = "".join(communicator.PackMessageBundle(b) for b in bundles)
+
+    # The bundles are extracted no matter how the data is split.
+    for chunk_size in [1, 3, 4096, len(data)]:
+      chunks = [
+          data[i:i + chunk_size] for i in range(0, len(data), chunk_size)
+      ]
+      self.assertEqual(list(communicator.UnpackMessageBundles(chunks)), bundles)
+
+    with self.assertRaises(communicator.DecodingError):
+      list(communicator.UnpackMessageBundles([data[:-1]]))
+
+    # Bundles above the size limit are rejected before they are read.
+    self.assertEqual(
+        list(communicator.UnpackMessageBundles([data], max_bundle_size=2000)),
+        bundles)
+    with self.assertRaises(communicator.DecodingError):
+      list(
+          communicator.UnpackMessageBundles(
+              [communicator.PackMessageBundle("a" * 2001)[:10]],
+              max_bundle_size=2000))
+
   def _ScheduleResponseAndStatus(self, client_id, flow_id):
     with queue_manager.QueueManager(token=self.token) as flow_manager:
       # Schedule a response.
@@ -627,6 +811,32 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       self.assertEqual(decoded_messages[i].auth_state,
                        rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
 
+  def testCachedCipherSkipsRSAAndKeyLookups(self):
+    """Requests reusing a verified cipher do not need any RSA operations."""
+    self._MakeClientRecord()
+    self.ClientServerCommunicate()
+
+    hits = stats.STATS.GetMetricValue(
+        "grr_encrypted_cipher_cache", fields=["hits"])
+
+    def Raising(*_):
+      raise AssertionError("Unexpected call.")
+
+    # The client reuses its cipher so the server can use the cached one.
+    with utils.MultiStubber(
+        (rdf_crypto.RSAPrivateKey, "Decrypt", Raising),
+        (rdf_crypto.RSAPublicKey, "Verify", Raising),
+        (self.server_communicator, "_GetRemotePublicKey", Raising)):
+      decoded_messages = self.ClientServerCommunicate()
+
+    for message in decoded_messages:
+      self.assertEqual(message.auth_state,
+                       rdf_flows.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue(
+            "grr_encrypted_cipher_cache", fields=["hits"]), hits + 1)
+
   def testClientPingAndClockIsUpdated(self):
     """Check PING and CLOCK are updated, simulate bad client clock."""
     self._MakeClientRecord()
@@ -910,11 +1120,22 @@ class HTTPClientTests(test_lib.GRRBaseTest):
     _ = kwargs
     try:
       comms_cls = rdf_flows.ClientCommunication
-      self.client_communication = comms_cls.FromSerializedString(data)
+      if isinstance(data, basestring):
+        bundles = [comms_cls.FromSerializedString(data)]
+      else:
+        # A streaming upload.
+        bundles = [
+            comms_cls.FromSerializedString(bundle)
+            for bundle in communicator.UnpackMessageBundles(data)
+        ]
+      self.bundle_count = len(bundles)
+      self.client_communication = bundles[-1]
 
       # Decrypt incoming messages
-      self.messages, source, ts = self.server_communicator.DecodeMessages(
-          self.client_communication)
+      self.messages = []
+      for bundle in bundles:
+        messages, source, ts = self.server_communicator.DecodeMessages(bundle)
+        self.messages.extend(messages)
 
       # Make sure the messages are correct
       self.assertEqual(source, self.client_cn)
@@ -1007,6 +1228,17 @@ class HTTPClientTests(test_lib.GRRBaseTest):
       self.assertEqual(self.messages[0].session_id,
                        ca_enroller.Enroler.well_known_session_id)
 
+  def testStreamingUpload(self):
+    """Test sending the messages to the server in several bundles."""
+    with test_lib.ConfigOverrider({"Client.upload_bundle_size": 100}):
+      self.SendToServer()
+      status = self.client_communicator.RunOnce()
+
+    self.assertEqual(status.code, 200)
+    self.assertGreater(self.bundle_count, 1)
+    self.assertEqual(len(self.messages), 10)
+    self.CheckClientQueue()
+
   def testEnrollment(self):
     """Test the http response to unknown clients."""
 
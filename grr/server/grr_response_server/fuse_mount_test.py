@@ -228,6 +228,7 @@ class GRRFuseTest(GRRFuseTestBase):
         linux.GetInstallDate,
         searching.Find,
         standard.HashBuffer,
+        standard.HashBufferManifest,
         standard.ListDirectory,
         standard.GetFileStat,
         standard.TransferBuffer,
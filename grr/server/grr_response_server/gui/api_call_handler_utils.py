@@ -19,6 +19,7 @@ from grr.lib.rdfvalues import client as rdf_client
 from grr.lib.rdfvalues import structs as rdf_structs
 from grr_response_proto import api_utils_pb2
 from grr.server.grr_response_server import aff4
+from grr.server.grr_response_server import sequential_collection
 from grr.server.grr_response_server.aff4_objects import aff4_grr
 from grr.server.grr_response_server.flows.general import export as flow_export
 
@@ -259,6 +260,16 @@ class ApiDataObject(rdf_structs.RDFProtoStruct):
     return self
 
 
+def _GenerateItems(collection, offset=0, count=None):
+  """Iterates a collection, indexed collections are read in parallel."""
+  if isinstance(collection, sequential_collection.IndexedSequentialCollection):
+    for _, item in collection.ParallelScan(offset=offset, max_records=count):
+      yield item
+  else:
+    for item in itertools.islice(collection.GenerateItems(offset), count):
+      yield item
+
+
 def FilterCollection(collection, offset, count=0, filter_value=None):
   """Filters an aff4 collection, getting count elements, starting at offset."""
 
@@ -268,11 +279,11 @@ def FilterCollection(collection, offset, count=0, filter_value=None):
   if count < 0:
     raise ValueError("Count needs to be greater than or equal to zero")
 
-  count = count or sys.maxint
   if filter_value:
+    count = count or sys.maxint
     index = 0
     items = []
-    for item in collection.GenerateItems():
+    for item in _GenerateItems(collection):
       serialized_item = item.SerializeToString()
       if re.search(re.escape(filter_value), serialized_item, re.I):
         if index >= offset:
@@ -282,6 +293,7 @@ def FilterCollection(collection, offset, count=0, filter_value=None):
         if len(items) >= count:
           break
   else:
-    items = list(itertools.islice(collection.GenerateItems(offset), count))
+    items = list(
+        _GenerateItems(collection, offset=offset, count=count or None))
 
   return items
@@ -957,8 +957,9 @@ class ApiGetHuntFilesArchiveHandler(api_call_handler_base.ApiCallHandler):
         prefix=target_file_prefix,
         description=description,
         archive_format=archive_format)
+    items = (item for _, item in collection.ParallelScan())
     content_generator = self._WrapContentGenerator(
-        generator, collection, args, token=token)
+        generator, items, args, token=token)
     return api_call_handler_base.ApiBinaryStream(
         target_file_prefix + file_extension,
         content_generator=content_generator)
@@ -34,6 +34,7 @@ const DownloadCollectionAsController = function(
   this.pluginToDisplayName = {
     'csv-zip': 'CSV (Zipped)',
     'flattened-yaml-zip': 'Flattened YAML (Zipped)',
+    'parquet-zip': 'Parquet (Zipped)',
     'sqlite-zip': 'SQLite Scripts (Zipped)'
   };
 
@@ -23,6 +23,7 @@ from grr.lib.rdfvalues import protodict as rdf_protodict
 from grr.lib.rdfvalues import stats as rdf_stats
 from grr.server.grr_response_server import access_control
 from grr.server.grr_response_server import aff4
+from grr.server.grr_response_server import client_index
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import events as events_lib
 from grr.server.grr_response_server import flow
@@ -81,6 +82,9 @@ class HuntRunner(object):
   3) Resources are tallied for each client and as a hunt total.
   """
 
+  # How many clients looked up in the client index are scheduled per message.
+  CLIENT_BATCH_SIZE = 1000
+
   def __init__(self, hunt_obj, runner_args=None, token=None):
     """Constructor for the Hunt Runner.
 
@@ -535,6 +539,10 @@ class HuntRunner(object):
       self._AddClient(request.client_id)
       return
 
+    if request.next_state == "StartClientsBatch":
+      self._StartClientsBatch(request, responses)
+      return
+
     if request.next_state == "RegisterClient":
       state = self.hunt_obj.Get(self.hunt_obj.Schema.STATE)
       # This allows the client limit to operate with a client rate. We still
@@ -659,7 +667,98 @@ class HuntRunner(object):
     self.hunt_obj.Flush()
 
     if self.runner_args.add_foreman_rules:
-      self._AddForemanRule()
+      if not (self.runner_args.assign_clients_from_index and
+              self._AssignClientsFromIndex()):
+        self._AddForemanRule()
+
+  def _AssignClientsFromIndex(self):
+    """Schedules the clients matching the hunt's rules using the client index.
+
+    Instead of waiting for every client to check in with the foreman, the
+    matching clients are looked up once and sent to the hunt in batches. With a
+    client rate, the batches are spread out over time so that only a batch at a
+    time is queued.
+
+    Returns:
+      False if the client rule set can't be answered from the index and a
+      foreman rule has to be used instead.
+    """
+    client_ids = client_index.LookupClientsForRuleSet(
+        self.runner_args.client_rule_set, token=self.token)
+    if client_ids is None:
+      return False
+
+    now = rdfvalue.RDFDatetime.Now()
+    self.context.client_index_assignment_time = now
+
+    batch_time = now
+    for batch in utils.Grouper(client_ids, self.CLIENT_BATCH_SIZE):
+      self.CallState(
+          messages=[rdf_client.ClientURN(client_id) for client_id in batch],
+          next_state="StartClientsBatch",
+          request_data={
+              "assignment_time": now.AsMicrosecondsSinceEpoch()
+          },
+          start_time=batch_time)
+      if self.runner_args.client_rate > 0:
+        batch_time = (
+            batch_time + 60.0 * len(batch) / self.runner_args.client_rate)
+
+    # Persist the context before the batches can be processed.
+    self.hunt_obj.Flush()
+    return True
+
+  def _StartClientsBatch(self, request, responses):
+    """Adds a batch of clients looked up in the client index to the hunt."""
+    if not self.IsHuntStarted():
+      logging.debug("Not starting client batch on hunt %s which is in state %s",
+                    self.session_id,
+                    self.hunt_obj.Get(self.hunt_obj.Schema.STATE))
+      return
+
+    # The hunt was restarted since and has looked up its clients again.
+    assignment_time = self.context.client_index_assignment_time
+    if (assignment_time is None or request.data.GetItem("assignment_time") !=
+        assignment_time.AsMicrosecondsSinceEpoch()):
+      return
+
+    client_ids = [
+        msg.payload.Basename()
+        for msg in responses
+        if msg.type == rdf_flows.GrrMessage.Type.MESSAGE
+    ]
+    client_ids = self._FilterClientsToStart(client_ids)
+    if client_ids:
+      self.hunt_obj.StartClients(self.session_id, client_ids, token=self.token)
+
+  def _FilterClientsToStart(self, client_ids):
+    """Drops clients that don't match the rules or were already started."""
+    hunt_flow_urns = {}
+    for client_id in client_ids:
+      hunt_flow_urn = rdf_client.ClientURN(client_id).Add(
+          "flows/%s:hunt" % self.session_id.Basename())
+      hunt_flow_urns[hunt_flow_urn] = client_id
+
+    for stat in aff4.FACTORY.Stat(hunt_flow_urns.keys()):
+      hunt_flow_urns.pop(stat["urn"], None)
+    client_ids = set(hunt_flow_urns.values())
+    if not client_ids:
+      return []
+
+    # The index is lossy (e.g. labels are lower cased), so the rules are
+    # checked again against the current client data.
+    client_rule_set = self.runner_args.client_rule_set.Compile()
+    if data_store.RelationalDBReadEnabled():
+      clients = data_store.REL_DB.MultiReadClientFullInfo(client_ids).items()
+    else:
+      clients = [(client.urn.Basename(), client)
+                 for client in aff4.FACTORY.MultiOpen(
+                     [rdf_client.ClientURN(c) for c in client_ids],
+                     aff4_type=aff4_grr.VFSGRRClient,
+                     token=self.token)]
+
+    return sorted(client_id for client_id, client in clients
+                  if client_rule_set(rdf_foreman.ForemanClientFields(client)))
 
   def _AddForemanRule(self):
     """Adds a foreman rule for this hunt."""
@@ -3,6 +3,9 @@
 """
 
 import logging
+import Queue
+import threading
+import time
 
 from grr.lib import rdfvalue
 from grr.lib import stats
@@ -47,11 +50,52 @@ class ResultsProcessingError(Exception):
     return "\n".join(messages)
 
 
+class ResultsBatch(object):
+  """A batch of hunt results shared by all output plugins of a hunt."""
+
+  def __init__(self, notifications, results, num_plugins):
+    self.notifications = notifications
+    self.results = results
+    self.skipped = None
+    self._pending_plugins = num_plugins
+    self._lock = threading.Lock()
+
+  def ShouldProcess(self, running_too_long_callback):
+    """Decides once, for all plugins, whether this batch gets processed.
+
+    Plugins process batches in order, so the first plugin to reach a batch
+    makes the decision for everybody. This guarantees that either all plugins
+    see a batch or none of them does.
+
+    Args:
+      running_too_long_callback: Returns True if processing should stop.
+
+    Returns:
+      True if the batch should be passed to the output plugins.
+    """
+    with self._lock:
+      if self.skipped is None:
+        self.skipped = running_too_long_callback()
+      return not self.skipped
+
+  def PluginDone(self):
+    """Marks the batch done for one plugin, returns True for the last one."""
+    with self._lock:
+      self._pending_plugins -= 1
+      return self._pending_plugins <= 0
+
+
 class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
   """Periodic cron flow that processes hunt results.
 
   The ProcessHuntResultCollectionsCronFlow reads hunt results stored in
   HuntResultCollections and feeds runs output plugins on them.
+
+  Up to max_parallel_hunts hunts are processed concurrently. For every hunt
+  the results are read in batches which are handed to one worker thread per
+  output plugin, so reading the next batch overlaps with plugins processing
+  the previous ones. Each plugin may lag at most max_batches_in_flight batches
+  behind the reader.
   """
 
   frequency = rdfvalue.Duration("5m")
@@ -61,6 +105,8 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
   args_type = ProcessHuntResultCollectionsCronFlowArgs
 
   DEFAULT_BATCH_SIZE = 5000
+  DEFAULT_MAX_PARALLEL_HUNTS = 4
+  DEFAULT_MAX_BATCHES_IN_FLIGHT = 2
 
   def CheckIfRunningTooLong(self):
     if self.args.max_running_time:
@@ -90,8 +136,13 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
   def RunPlugins(self, hunt_urn, plugins, results, exceptions_by_plugin):
     for plugin_def, plugin in plugins:
       try:
+        start_time = time.time()
         plugin.ProcessResponses(results)
         plugin.Flush()
+        stats.STATS.RecordEvent(
+            "hunt_output_plugin_batch_latency",
+            time.time() - start_time,
+            fields=[plugin_def.plugin_name])
 
         plugin_status = output_plugin.OutputPluginBatchProcessingStatus(
             plugin_descriptor=plugin_def,
@@ -125,56 +176,164 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
           implementation.GRRHunt.PluginErrorCollectionForHID(hunt_urn).Add(
               plugin_status, mutation_pool=pool)
 
+  def RunPluginWorker(self, hunt_urn, plugin_def, plugin, batches,
+                      done_batches, exceptions_by_plugin):
+    """Feeds batches from the batches queue to a single output plugin."""
+    while True:
+      batch = batches.get()
+      if batch is None:
+        return
+
+      try:
+        if batch.ShouldProcess(self.CheckIfRunningTooLong):
+          self.RunPlugins(hunt_urn, [(plugin_def, plugin)], batch.results,
+                          exceptions_by_plugin)
+      except Exception as e:  # pylint: disable=broad-except
+        # The worker has to keep consuming batches, otherwise the reader
+        # blocks forever on a full queue.
+        logging.exception("Error running output plugin %s for hunt %s",
+                          utils.SmartStr(plugin), hunt_urn)
+        exceptions_by_plugin.setdefault(plugin_def, []).append(e)
+
+      if batch.PluginDone():
+        done_batches.put(batch)
+
+  def MarkBatchesProcessed(self, hunt_urn, done_batches, metadata_obj,
+                           num_processed):
+    """Deletes notifications of all batches that went through every plugin."""
+    hunt_id = hunt_urn.Basename()
+    while True:
+      try:
+        batch = done_batches.get_nowait()
+      except Queue.Empty:
+        return num_processed
+
+      if batch.skipped:
+        continue
+
+      hunts_results.HuntResultQueue.DeleteNotifications(
+          batch.notifications, token=self.token)
+      num_processed += len(batch.notifications)
+      stats.STATS.IncrementCounter(
+          "hunt_results_processed",
+          delta=len(batch.notifications),
+          fields=[hunt_id])
+      with self.heartbeat_lock:
+        self.HeartBeat()
+      metadata_obj.Set(metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
+      metadata_obj.UpdateLease(600)
+
   def ProcessOneHunt(self, exceptions_by_hunt):
-    """Reads results for one hunt and process them."""
-    hunt_results_urn, results = (
-        hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
-            start_time=self.args.start_processing_time,
-            token=self.token,
-            lease_time=self.lifetime))
+    """Reads results for one hunt and process them.
+
+    Args:
+      exceptions_by_hunt: A dict the output plugin exceptions are added to.
+
+    Returns:
+      The number of result notifications claimed, 0 if there are none left.
+    """
+    # Hunts that are being processed by another thread are skipped, so each
+    # hunt is only worked on by one thread at a time.
+    with self.hunts_in_progress_lock:
+      hunt_results_urn, results = (
+          hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+              start_time=self.args.start_processing_time,
+              token=self.token,
+              lease_time=self.lifetime,
+              exclude_collections=self.hunts_in_progress))
+      if results:
+        self.hunts_in_progress.add(hunt_results_urn)
+
     logging.debug("Found %d results for hunt %s", len(results),
                   hunt_results_urn)
     if not results:
       return 0
 
+    try:
+      self._ProcessHuntResults(hunt_results_urn, results, exceptions_by_hunt)
+    finally:
+      with self.hunts_in_progress_lock:
+        self.hunts_in_progress.discard(hunt_results_urn)
+
+    return len(results)
+
+  def _ProcessHuntResults(self, hunt_results_urn, results, exceptions_by_hunt):
+    """Sends claimed results of one hunt through its output plugins."""
     hunt_urn = rdfvalue.RDFURN(hunt_results_urn.Dirname())
+    hunt_id = hunt_urn.Basename()
     batch_size = self.args.batch_size or self.DEFAULT_BATCH_SIZE
+    max_batches_in_flight = (
+        self.args.max_batches_in_flight or self.DEFAULT_MAX_BATCHES_IN_FLIGHT)
     metadata_urn = hunt_urn.Add("ResultsMetadata")
     exceptions_by_plugin = {}
-    num_processed_for_hunt = 0
     collection_obj = implementation.GRRHunt.ResultCollectionForHID(hunt_urn)
     try:
       with aff4.FACTORY.OpenWithLock(
           metadata_urn, lease_time=600, token=self.token) as metadata_obj:
         all_plugins, used_plugins = self.LoadPlugins(metadata_obj)
-        num_processed = int(
+        num_processed_before = num_processed = int(
             metadata_obj.Get(metadata_obj.Schema.NUM_PROCESSED_RESULTS))
-        for batch in utils.Grouper(results, batch_size):
-          results = list(
-              collection_obj.MultiResolve(
-                  [r.value.ResultRecord() for r in batch]))
-          self.RunPlugins(hunt_urn, used_plugins, results, exceptions_by_plugin)
-
-          hunts_results.HuntResultQueue.DeleteNotifications(
-              batch, token=self.token)
-          num_processed += len(batch)
-          num_processed_for_hunt += len(batch)
-          self.HeartBeat()
-          metadata_obj.Set(
-              metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
-          metadata_obj.UpdateLease(600)
-          if self.CheckIfRunningTooLong():
-            logging.warning("Run too long, stopping.")
-            break
+
+        done_batches = Queue.Queue()
+        plugin_queues = []
+        workers = []
+        for plugin_def, plugin in used_plugins:
+          plugin_queue = Queue.Queue(maxsize=max_batches_in_flight)
+          worker = threading.Thread(
+              target=self.RunPluginWorker,
+              args=(hunt_urn, plugin_def, plugin, plugin_queue, done_batches,
+                    exceptions_by_plugin),
+              name="HuntOutputPlugin %s" % plugin_def.plugin_name)
+          worker.start()
+          plugin_queues.append(plugin_queue)
+          workers.append(worker)
+
+        try:
+          for batch in utils.Grouper(results, batch_size):
+            batch_results = list(
+                collection_obj.MultiResolve(
+                    [r.value.ResultRecord() for r in batch]))
+            results_batch = ResultsBatch(batch, batch_results,
+                                         len(plugin_queues))
+            if not plugin_queues:
+              done_batches.put(results_batch)
+            # This blocks if a plugin is too far behind the reader.
+            for plugin_queue in plugin_queues:
+              plugin_queue.put(results_batch)
+
+            num_processed = self.MarkBatchesProcessed(
+                hunt_urn, done_batches, metadata_obj, num_processed)
+            stats.STATS.SetGaugeValue(
+                "hunt_results_processing_backlog",
+                len(results) - (num_processed - num_processed_before),
+                fields=[hunt_id])
+            if self.CheckIfRunningTooLong():
+              logging.warning("Run too long, stopping.")
+              break
+        finally:
+          for plugin_queue in plugin_queues:
+            plugin_queue.put(None)
+          for worker in workers:
+            worker.join()
+
+        num_processed = self.MarkBatchesProcessed(hunt_urn, done_batches,
+                                                  metadata_obj, num_processed)
+        num_processed_for_hunt = num_processed - num_processed_before
+        stats.STATS.SetGaugeValue(
+            "hunt_results_processing_backlog",
+            len(results) - num_processed_for_hunt,
+            fields=[hunt_id])
 
         metadata_obj.Set(metadata_obj.Schema.OUTPUT_PLUGINS(all_plugins))
         metadata_obj.Set(
             metadata_obj.Schema.NUM_PROCESSED_RESULTS(num_processed))
     except aff4.LockError:
+      # The hunt is being processed elsewhere, the claimed notifications are
+      # picked up again once their leases expire.
       logging.warn(
           "ProcessHuntResultCollectionsCronFlow: "
           "Could not get lock on hunt metadata %s.", metadata_urn)
-      return 0
+      return
 
     if exceptions_by_plugin:
       for plugin, exceptions in exceptions_by_plugin.items():
@@ -182,7 +341,12 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
             plugin, []).extend(exceptions)
 
     logging.debug("Processed %d results.", num_processed_for_hunt)
-    return len(results)
+
+  def ProcessHunts(self, exceptions_by_hunt):
+    while not self.CheckIfRunningTooLong():
+      count = self.ProcessOneHunt(exceptions_by_hunt)
+      if not count:
+        break
 
   @flow.StateHandler()
   def Start(self):
@@ -193,10 +357,35 @@ class ProcessHuntResultCollectionsCronFlow(cronjobs.SystemCronFlow):
       self.args.max_running_time = rdfvalue.Duration("%ds" % int(
           ProcessHuntResultCollectionsCronFlow.lifetime.seconds * 0.6))
 
-    while not self.CheckIfRunningTooLong():
-      count = self.ProcessOneHunt(exceptions_by_hunt)
-      if not count:
-        break
+    self.heartbeat_lock = threading.Lock()
+    self.hunts_in_progress = set()
+    self.hunts_in_progress_lock = threading.Lock()
+    max_parallel_hunts = (
+        self.args.max_parallel_hunts or self.DEFAULT_MAX_PARALLEL_HUNTS)
+    # Every thread claims hunts on its own, ProcessOneHunt makes sure a hunt
+    # is only processed by one of them at a time.
+    exceptions_by_thread = [{} for _ in range(max_parallel_hunts)]
+    threads = []
+    for thread_exceptions in exceptions_by_thread[1:]:
+      thread = threading.Thread(
+          target=self.ProcessHunts,
+          args=(thread_exceptions,),
+          name="ProcessHuntResults")
+      thread.start()
+      threads.append(thread)
+
+    # The first share of the work is done by this thread.
+    self.ProcessHunts(exceptions_by_thread[0])
+
+    for thread in threads:
+      thread.join()
+
+    # A hunt can be picked up by different threads one after the other.
+    for thread_exceptions in exceptions_by_thread:
+      for hunt_urn, exceptions_by_plugin in thread_exceptions.items():
+        for plugin, exceptions in exceptions_by_plugin.items():
+          exceptions_by_hunt.setdefault(hunt_urn, {}).setdefault(
+              plugin, []).extend(exceptions)
 
     if exceptions_by_hunt:
       e = ResultsProcessingError()
@@ -42,7 +42,8 @@ class HuntResultQueue(aff4_queue.Queue):
                                       token=None,
                                       start_time=None,
                                       lease_time=200,
-                                      collection=None):
+                                      collection=None,
+                                      exclude_collections=None):
     """Return unclaimed hunt result notifications for collection.
 
     Args:
@@ -57,6 +58,10 @@ class HuntResultQueue(aff4_queue.Queue):
       collection: The urn of the collection to find notifications for. If unset,
         the earliest (unclaimed) notification will determine the collection.
 
+      exclude_collections: An optional container of collection urns. When no
+        collection is given, notifications for these collections are skipped
+        while looking for the earliest one.
+
     Returns:
       A pair (collection, results) where collection is the collection
       that notifications were retrieved for and results is a list of
@@ -66,15 +71,18 @@ class HuntResultQueue(aff4_queue.Queue):
 
     class CollectionFilter(object):
 
-      def __init__(self, collection):
+      def __init__(self, collection, exclude_collections):
         self.collection = collection
+        self.exclude_collections = exclude_collections or ()
 
       def FilterRecord(self, notification):
         if self.collection is None:
+          if notification.result_collection_urn in self.exclude_collections:
+            return True
           self.collection = notification.result_collection_urn
         return self.collection != notification.result_collection_urn
 
-    f = CollectionFilter(collection)
+    f = CollectionFilter(collection, exclude_collections)
     results = []
     with aff4.FACTORY.OpenWithLock(
         RESULT_NOTIFICATION_QUEUE,
@@ -101,6 +109,11 @@ class HuntResultQueue(aff4_queue.Queue):
 class HuntResultCollection(sequential_collection.GrrMessageCollection):
   """Sequential HuntResultCollection."""
 
+  # Results written in one flush usually come from the same client flow and
+  # share source, session id and payload type, so blocks save most of the
+  # space they take up.
+  BLOCK_STORAGE = True
+
   @classmethod
   def StaticAdd(cls,
                 collection_urn,
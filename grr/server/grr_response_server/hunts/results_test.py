@@ -141,6 +141,36 @@ class ResultTest(aff4_test_lib.AFF4ObjectTest):
 
     self.assertEqual(sorted(values_read), range(100, 200))
 
+  def testNotificationsForExcludedCollectionsAreSkipped(self):
+    collection_urn_1 = rdfvalue.RDFURN(
+        "aff4:/testNotificationsForExcludedCollectionsAreSkipped/collection_1")
+    collection_urn_2 = rdfvalue.RDFURN(
+        "aff4:/testNotificationsForExcludedCollectionsAreSkipped/collection_2")
+
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(10):
+        hunts_results.HuntResultCollection.StaticAdd(
+            collection_urn_1,
+            rdf_flows.GrrMessage(request_id=i),
+            mutation_pool=pool)
+        hunts_results.HuntResultCollection.StaticAdd(
+            collection_urn_2,
+            rdf_flows.GrrMessage(request_id=10 + i),
+            mutation_pool=pool)
+
+    # Collection 1 has the earliest notification but is excluded, so only
+    # notifications for collection 2 get claimed.
+    results_1 = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token, exclude_collections=set([collection_urn_1]))
+    self.assertEqual(collection_urn_2, results_1[0])
+    self.assertEqual(10, len(results_1[1]))
+
+    # Notifications of collection 1 are still unclaimed.
+    results_2 = hunts_results.HuntResultQueue.ClaimNotificationsForCollection(
+        token=self.token)
+    self.assertEqual(collection_urn_1, results_2[0])
+    self.assertEqual(10, len(results_2[1]))
+
 
 def main(argv):
   test_lib.main(argv)
@@ -540,5 +540,11 @@ class StandardHuntInitHook(registry.InitHook):
         "hunt_output_plugin_errors", fields=[("plugin", str)])
     stats.STATS.RegisterCounterMetric(
         "hunt_results_ran_through_plugin", fields=[("plugin", str)])
+    stats.STATS.RegisterEventMetric(
+        "hunt_output_plugin_batch_latency", fields=[("plugin", str)])
+    stats.STATS.RegisterCounterMetric(
+        "hunt_results_processed", fields=[("hunt", str)])
+    stats.STATS.RegisterGaugeMetric(
+        "hunt_results_processing_backlog", int, fields=[("hunt", str)])
     stats.STATS.RegisterCounterMetric("hunt_results_compacted")
     stats.STATS.RegisterCounterMetric("hunt_results_compaction_locking_errors")
@@ -21,6 +21,7 @@ from grr.lib.rdfvalues import paths as rdf_paths
 from grr.server.grr_response_server import access_control
 from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import flow
+from grr.server.grr_response_server import foreman as rdf_foreman
 from grr.server.grr_response_server import output_plugin
 from grr.server.grr_response_server import queue_manager
 from grr.server.grr_response_server.aff4_objects import aff4_grr
@@ -255,6 +256,49 @@ class StandardHuntTest(notification_test_lib.NotificationTestMixin,
       self.assertEqual(finished, 0)
       self.assertEqual(errors, 0)
 
+  def testHuntAssignsClientsFromIndex(self):
+    client_rule_set = rdf_foreman.ForemanClientRuleSet(rules=[
+        rdf_foreman.ForemanClientRule(
+            rule_type=rdf_foreman.ForemanClientRule.Type.OS,
+            os=rdf_foreman.ForemanOsClientRule(os_linux=True))
+    ])
+    hunt_urn = self.StartHunt(
+        client_rule_set=client_rule_set, assign_clients_from_index=True)
+
+    # The clients are looked up in the index, no foreman rule is needed.
+    with aff4.FACTORY.Open(
+        "aff4:/foreman",
+        mode="r",
+        token=self.token,
+        aff4_type=aff4_grr.GRRForeman) as foreman:
+      foreman_rules = foreman.Get(
+          foreman.Schema.RULES, default=foreman.Schema.RULES())
+      self.assertFalse(foreman_rules)
+
+    self.RunHunt()
+    # Clients that already run the hunt are not started again.
+    self.AssignTasksToClients()
+    self.RunHunt()
+    self.StopHunt(hunt_urn)
+
+    with aff4.FACTORY.Open(
+        hunt_urn, age=aff4.ALL_TIMES, token=self.token) as hunt_obj:
+      started, finished, _ = hunt_obj.GetClientsCounts()
+      self.assertEqual(started, 10)
+      self.assertEqual(finished, 10)
+
+  def testHuntAssignsNonIndexableRulesWithForeman(self):
+    self.StartHunt(assign_clients_from_index=True)
+
+    with aff4.FACTORY.Open(
+        "aff4:/foreman",
+        mode="r",
+        token=self.token,
+        aff4_type=aff4_grr.GRRForeman) as foreman:
+      foreman_rules = foreman.Get(
+          foreman.Schema.RULES, default=foreman.Schema.RULES())
+      self.assertEqual(len(foreman_rules), 1)
+
   def testProcessHunResultsCronFlowDoesNothingWhenThereAreNoResults(self):
     # There's no hunt, nothing. Just assert that cron job completes
     # successfully.
@@ -555,6 +599,82 @@ class StandardHuntTest(notification_test_lib.NotificationTestMixin,
 
     self.assertEqual(errors_count - prev_errors_count, 0)
 
+  def testUpdatesPerHuntProcessingStats(self):
+    hunt_urn = self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+    self.ProcessHuntOutputPlugins(batch_size=3)
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue(
+            "hunt_results_processed", fields=[hunt_urn.Basename()]), 10)
+    self.assertEqual(
+        stats.STATS.GetMetricValue(
+            "hunt_results_processing_backlog", fields=[hunt_urn.Basename()]),
+        0)
+
+  def testEveryOutputPluginGetsAllBatchesInOrder(self):
+    self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin"),
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="StatefulDummyHuntOutputPlugin")
+    ])
+
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+    self.ProcessHuntOutputPlugins(batch_size=1, max_batches_in_flight=1)
+
+    self.assertEqual(hunt_test_lib.DummyHuntOutputPlugin.num_calls, 10)
+    self.assertEqual(hunt_test_lib.DummyHuntOutputPlugin.num_responses, 10)
+    self.assertListEqual(hunt_test_lib.StatefulDummyHuntOutputPlugin.data,
+                         range(10))
+
+    # All notifications are gone, so nothing is processed a second time.
+    self.ProcessHuntOutputPlugins(batch_size=1)
+    self.assertEqual(hunt_test_lib.DummyHuntOutputPlugin.num_calls, 10)
+
+  def testOutputOfManyHuntsIsProcessedInParallel(self):
+    for _ in range(3):
+      self.StartHunt(output_plugins=[
+          output_plugin.OutputPluginDescriptor(
+              plugin_name="DummyHuntOutputPlugin")
+      ])
+
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+    self.ProcessHuntOutputPlugins(max_parallel_hunts=3)
+
+    self.assertEqual(hunt_test_lib.DummyHuntOutputPlugin.num_calls, 3)
+    self.assertEqual(hunt_test_lib.DummyHuntOutputPlugin.num_responses, 30)
+
+  def testHuntLockedElsewhereDoesNotStopProcessing(self):
+    locked_hunt_urn = self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+    # Results of the locked hunt come first in the result queue.
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    self.StartHunt(output_plugins=[
+        output_plugin.OutputPluginDescriptor(
+            plugin_name="DummyHuntOutputPlugin")
+    ])
+    self.AssignTasksToClients()
+    self.RunHunt(failrate=-1)
+
+    with aff4.FACTORY.OpenWithLock(
+        locked_hunt_urn.Add("ResultsMetadata"), token=self.token):
+      self.ProcessHuntOutputPlugins(max_parallel_hunts=1)
+
+    self.assertEqual(hunt_test_lib.DummyHuntOutputPlugin.num_calls, 1)
+    self.assertEqual(hunt_test_lib.DummyHuntOutputPlugin.num_responses, 10)
+
   def testUpdatesStatsCounterOnFailure(self):
     failing_plugin_descriptor = output_plugin.OutputPluginDescriptor(
         plugin_name="FailingDummyHuntOutputPlugin")
@@ -7,7 +7,6 @@ import re
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import utils
-from grr.server.grr_response_server import aff4
 from grr.server.grr_response_server import export
 
 
@@ -100,44 +99,21 @@ class InstantOutputPluginWithExportConversion(InstantOutputPlugin):
 
   BATCH_SIZE = 5000
 
-  def __init__(self, *args, **kwargs):
-    super(InstantOutputPluginWithExportConversion, self).__init__(
-        *args, **kwargs)
-    self._cached_metadata = {}
-
   def _GetMetadataForClients(self, client_urns):
     """Fetches metadata for a given list of clients."""
+    metadata_by_client = export.CLIENT_METADATA_CACHE.GetMetadata(
+        client_urns, token=self.token)
 
-    result = {}
-    metadata_to_fetch = set()
-
+    result = []
     for urn in client_urns:
       try:
-        result[urn] = self._cached_metadata[urn]
+        metadata = metadata_by_client[urn]
       except KeyError:
-        metadata_to_fetch.add(urn)
-
-    if metadata_to_fetch:
-      client_fds = aff4.FACTORY.MultiOpen(
-          metadata_to_fetch, mode="r", token=self.token)
-
-      fetched_metadata = [
-          export.GetMetadata(client_fd, token=self.token)
-          for client_fd in client_fds
-      ]
-      for metadata in fetched_metadata:
-        metadata.source_urn = self.source_urn
-
-        self._cached_metadata[metadata.client_urn] = metadata
-        result[metadata.client_urn] = metadata
-        metadata_to_fetch.remove(metadata.client_urn)
-
-      for urn in metadata_to_fetch:
-        default_mdata = export.ExportedMetadata(source_urn=self.source_urn)
-        result[urn] = default_mdata
-        self._cached_metadata[urn] = default_mdata
+        metadata = export.ExportedMetadata()
+      metadata.source_urn = self.source_urn
+      result.append(metadata)
 
-    return [result[urn] for urn in client_urns]
+    return result
 
   def GetExportOptions(self):
     """Rerturns export options to be used by export converter."""
@@ -281,7 +257,8 @@ def ApplyPluginToMultiTypeCollection(plugin, output_collection,
 
     # pylint: disable=cell-var-from-loop
     def GetValues():
-      for timestamp, value in output_collection.ScanByType(stored_type_name):
+      for timestamp, value in output_collection.ParallelScanByType(
+          stored_type_name):
         _ = timestamp
         if source_urn:
           value.source = source_urn
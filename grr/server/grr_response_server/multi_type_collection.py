@@ -117,6 +117,25 @@ class MultiTypeCollection(object):
         max_records=max_records):
       yield item
 
+  def ParallelScanByType(self, type_name, max_threads=None):
+    """Scans for stored records of a given type, reading ranges in parallel.
+
+    Args:
+      type_name: Type of the records to scan.
+
+      max_threads: The maximum number of ranges to read concurrently.
+
+    Yields:
+      Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
+      timestamp.
+
+    """
+    sub_collection_urn = self.collection_id.Add(type_name)
+    sub_collection = sequential_collection.GrrMessageCollection(
+        sub_collection_urn)
+    for item in sub_collection.ParallelScan(max_threads=max_threads):
+      yield item
+
   def LengthByType(self, type_name):
     sub_collection_urn = self.collection_id.Add(type_name)
     sub_collection = sequential_collection.GrrMessageCollection(
@@ -186,8 +205,13 @@ class MultiTypeCollection(object):
     mutation_pool = data_store.DB.GetMutationPool()
     with mutation_pool:
       mutation_pool.DeleteSubject(self.collection_id)
-      for urn, _, _ in data_store.DB.ScanAttribute(
-          self.collection_id, data_store.DataStore.COLLECTION_ATTRIBUTE):
+      # Sub-collections keep their indexes and record counters.
+      for stored_type in self.ListStoredTypes():
+        mutation_pool.DeleteSubject(self.collection_id.Add(stored_type))
+      for urn, _ in data_store.DB.ScanAttributes(self.collection_id, [
+          data_store.DataStore.COLLECTION_ATTRIBUTE,
+          data_store.DataStore.COLLECTION_BLOCK_ATTRIBUTE
+      ]):
         mutation_pool.DeleteSubject(rdfvalue.RDFURN(urn))
         if mutation_pool.Size() > 50000:
           mutation_pool.Flush()
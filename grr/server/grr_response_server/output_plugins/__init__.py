@@ -12,5 +12,6 @@ except ImportError:
 
 from grr.server.grr_response_server.output_plugins import csv_plugin
 from grr.server.grr_response_server.output_plugins import email_plugin
+from grr.server.grr_response_server.output_plugins import parquet_plugin
 from grr.server.grr_response_server.output_plugins import sqlite_plugin
 from grr.server.grr_response_server.output_plugins import yaml_plugin
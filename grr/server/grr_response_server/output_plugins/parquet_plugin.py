@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""Plugin that exports results as zipped Apache Parquet files."""
+
+import itertools
+import os
+import struct
+import zipfile
+import zlib
+
+import yaml
+
+from grr.lib import rdfvalue
+from grr.lib import utils
+from grr.lib.rdfvalues import structs as rdf_structs
+from grr.server.grr_response_server import instant_output_plugin
+
+# Thrift compact protocol type ids.
+_THRIFT_I32 = 5
+_THRIFT_I64 = 6
+_THRIFT_BINARY = 8
+_THRIFT_LIST = 9
+_THRIFT_STRUCT = 12
+
+# Parquet physical types.
+_PARQUET_BOOLEAN = 0
+_PARQUET_INT64 = 2
+_PARQUET_DOUBLE = 5
+_PARQUET_BYTE_ARRAY = 6
+
+# Parquet converted (logical) types.
+_CONVERTED_UTF8 = 0
+_CONVERTED_TIMESTAMP_MICROS = 10
+_CONVERTED_UINT_64 = 14
+
+_REPETITION_REQUIRED = 0
+_ENCODING_PLAIN = 0
+_ENCODING_RLE = 3
+_CODEC_GZIP = 2
+_PAGE_TYPE_DATA_PAGE = 0
+
+_MAGIC = "PAR1"
+
+
+def _ZigZag(value):
+  return (value << 1) if value >= 0 else ((-value) << 1) - 1
+
+
+class _ThriftCompactEncoder(object):
+  """Encodes Parquet's thrift metadata structures in the compact protocol.
+
+  Structs are given as lists of (field_id, thrift_type, value) tuples. Lists
+  are given as (element_thrift_type, [values]) tuples. Fields with a None
+  value are omitted.
+  """
+
+  @classmethod
+  def EncodeStruct(cls, fields):
+    result = []
+    last_field_id = 0
+    for field_id, thrift_type, value in fields:
+      if value is None:
+        continue
+
+      delta = field_id - last_field_id
+      if 0 < delta <= 15:
+        result.append(chr((delta << 4) | thrift_type))
+      else:
+        result.append(chr(thrift_type))
+        result.append(rdf_structs.VarintEncode(_ZigZag(field_id)))
+      last_field_id = field_id
+
+      result.append(cls.EncodeValue(thrift_type, value))
+
+    result.append("\x00")
+    return "".join(result)
+
+  @classmethod
+  def EncodeValue(cls, thrift_type, value):
+    if thrift_type in (_THRIFT_I32, _THRIFT_I64):
+      return rdf_structs.VarintEncode(_ZigZag(value))
+    elif thrift_type == _THRIFT_BINARY:
+      value = utils.SmartStr(value)
+      return rdf_structs.VarintEncode(len(value)) + value
+    elif thrift_type == _THRIFT_STRUCT:
+      return cls.EncodeStruct(value)
+    elif thrift_type == _THRIFT_LIST:
+      element_type, elements = value
+      if len(elements) < 15:
+        header = chr((len(elements) << 4) | element_type)
+      else:
+        header = chr(0xf0 | element_type) + rdf_structs.VarintEncode(
+            len(elements))
+      return header + "".join(
+          cls.EncodeValue(element_type, e) for e in elements)
+
+    raise ValueError("Unsupported thrift type: %d" % thrift_type)
+
+
+class ParquetColumnType(object):
+  """Describes how RDF values are stored in a Parquet column."""
+
+  def __init__(self, physical_type, converted_type, convert_fn, default):
+    self.physical_type = physical_type
+    self.converted_type = converted_type
+    self.convert_fn = convert_fn
+    self.default = default
+
+  def Convert(self, value):
+    if value is None:
+      return self.default
+    return self.convert_fn(value)
+
+  def EncodePlain(self, values):
+    """Encodes a list of converted values with Parquet's PLAIN encoding."""
+    if self.physical_type == _PARQUET_BOOLEAN:
+      result = bytearray((len(values) + 7) // 8)
+      for i, value in enumerate(values):
+        if value:
+          result[i // 8] |= 1 << (i % 8)
+      return str(result)
+
+    if self.physical_type == _PARQUET_INT64:
+      if self.converted_type == _CONVERTED_UINT_64:
+        return struct.pack("<%dQ" % len(values), *values)
+      return struct.pack("<%dq" % len(values), *values)
+
+    if self.physical_type == _PARQUET_DOUBLE:
+      return struct.pack("<%dd" % len(values), *values)
+
+    return "".join(struct.pack("<I", len(v)) + v for v in values)
+
+
+class Rdf2ParquetAdapter(object):
+  """An adapter for converting RDF values to typed Parquet columns."""
+
+  UTF8_TYPE = ParquetColumnType(_PARQUET_BYTE_ARRAY, _CONVERTED_UTF8,
+                                lambda x: utils.SmartUnicode(x).encode("utf-8"),
+                                "")
+  BYTES_TYPE = ParquetColumnType(_PARQUET_BYTE_ARRAY, None, utils.SmartStr, "")
+  INT_TYPE = ParquetColumnType(_PARQUET_INT64, None, int, 0)
+  UINT_TYPE = ParquetColumnType(_PARQUET_INT64, _CONVERTED_UINT_64, int, 0)
+  BOOL_TYPE = ParquetColumnType(_PARQUET_BOOLEAN, None, bool, False)
+  DOUBLE_TYPE = ParquetColumnType(_PARQUET_DOUBLE, None, float, 0.0)
+
+  # Types for fields that have a semantic type annotation in their protobuf
+  # definition.
+  SEMANTIC_TYPES = {
+      rdfvalue.RDFInteger:
+          INT_TYPE,
+      rdfvalue.RDFBool:
+          BOOL_TYPE,
+      rdfvalue.RDFDatetime:
+          ParquetColumnType(_PARQUET_INT64, _CONVERTED_TIMESTAMP_MICROS,
+                            lambda x: x.AsMicrosecondsSinceEpoch(), 0),
+      rdfvalue.RDFDatetimeSeconds:
+          ParquetColumnType(_PARQUET_INT64, _CONVERTED_TIMESTAMP_MICROS,
+                            lambda x: x.AsSecondsSinceEpoch() * 1000000, 0),
+      rdfvalue.Duration:
+          ParquetColumnType(_PARQUET_INT64, None, lambda x: x.microseconds, 0),
+  }
+
+  # Types for fields that do not have a semantic type annotation in their
+  # protobuf definition.
+  NON_SEMANTIC_TYPES = {
+      rdf_structs.ProtoUnsignedInteger: UINT_TYPE,
+      rdf_structs.ProtoSignedInteger: INT_TYPE,
+      rdf_structs.ProtoFixed32: UINT_TYPE,
+      rdf_structs.ProtoFixed64: UINT_TYPE,
+      rdf_structs.ProtoFloat: DOUBLE_TYPE,
+      rdf_structs.ProtoDouble: DOUBLE_TYPE,
+      rdf_structs.ProtoBoolean: BOOL_TYPE,
+      rdf_structs.ProtoBinary: BYTES_TYPE,
+  }
+
+  @staticmethod
+  def GetColumnType(type_info):
+    if type_info.__class__ is rdf_structs.ProtoRDFValue:
+      return Rdf2ParquetAdapter.SEMANTIC_TYPES.get(type_info.type,
+                                                   Rdf2ParquetAdapter.UTF8_TYPE)
+    else:
+      return Rdf2ParquetAdapter.NON_SEMANTIC_TYPES.get(
+          type_info.__class__, Rdf2ParquetAdapter.UTF8_TYPE)
+
+
+class ParquetColumn(object):
+  """A flattened field of an exported struct stored as a Parquet column."""
+
+  def __init__(self, path, column_type):
+    self.path = path
+    self.name = ".".join(path)
+    self.column_type = column_type
+
+  def GetValue(self, value):
+    for field_name in self.path:
+      value = value.Get(field_name)
+    return self.column_type.Convert(value)
+
+
+class ParquetWriter(object):
+  """A streaming writer of Parquet files with flat, required columns.
+
+  Rows are written in row groups. Every column of a row group is stored as a
+  single PLAIN encoded, gzip compressed data page, so a row group only needs
+  to be kept in memory while it is being written.
+  """
+
+  def __init__(self, columns):
+    self.columns = columns
+    self.row_groups = []
+    self.num_rows = 0
+    self.offset = 0
+
+  def _Output(self, data):
+    self.offset += len(data)
+    return data
+
+  def Start(self):
+    return self._Output(_MAGIC)
+
+  def _WriteColumnChunk(self, column, values):
+    """Returns a column chunk and its metadata as a thrift field list."""
+    data = column.column_type.EncodePlain(values)
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    compressed_data = compressor.compress(data) + compressor.flush()
+
+    page_header = _ThriftCompactEncoder.EncodeStruct([
+        (1, _THRIFT_I32, _PAGE_TYPE_DATA_PAGE),
+        (2, _THRIFT_I32, len(data)),
+        (3, _THRIFT_I32, len(compressed_data)),
+        (5, _THRIFT_STRUCT, [
+            (1, _THRIFT_I32, len(values)),
+            (2, _THRIFT_I32, _ENCODING_PLAIN),
+            (3, _THRIFT_I32, _ENCODING_RLE),
+            (4, _THRIFT_I32, _ENCODING_RLE),
+        ]),
+    ])
+
+    data_page_offset = self.offset
+    chunk = self._Output(page_header + compressed_data)
+    column_metadata = [
+        (1, _THRIFT_I32, column.column_type.physical_type),
+        (2, _THRIFT_LIST, (_THRIFT_I32, [_ENCODING_PLAIN, _ENCODING_RLE])),
+        (3, _THRIFT_LIST, (_THRIFT_BINARY, [column.name])),
+        (4, _THRIFT_I32, _CODEC_GZIP),
+        (5, _THRIFT_I64, len(values)),
+        (6, _THRIFT_I64, len(page_header) + len(data)),
+        (7, _THRIFT_I64, len(chunk)),
+        (9, _THRIFT_I64, data_page_offset),
+    ]
+    column_chunk = [
+        (2, _THRIFT_I64, data_page_offset),
+        (3, _THRIFT_STRUCT, column_metadata),
+    ]
+    return chunk, column_chunk
+
+  def WriteRowGroup(self, rows):
+    """Writes a row group with the given values, returns its bytes."""
+    result = []
+    column_chunks = []
+    total_byte_size = 0
+    for column in self.columns:
+      chunk, column_chunk = self._WriteColumnChunk(
+          column, [column.GetValue(row) for row in rows])
+      result.append(chunk)
+      column_chunks.append(column_chunk)
+      total_byte_size += len(chunk)
+
+    self.row_groups.append([
+        (1, _THRIFT_LIST, (_THRIFT_STRUCT, column_chunks)),
+        (2, _THRIFT_I64, total_byte_size),
+        (3, _THRIFT_I64, len(rows)),
+    ])
+    self.num_rows += len(rows)
+    return "".join(result)
+
+  def Finish(self):
+    """Returns the file footer with the schema and row group metadata."""
+    schema = [[
+        (4, _THRIFT_BINARY, "schema"),
+        (5, _THRIFT_I32, len(self.columns)),
+    ]]
+    for column in self.columns:
+      schema.append([
+          (1, _THRIFT_I32, column.column_type.physical_type),
+          (3, _THRIFT_I32, _REPETITION_REQUIRED),
+          (4, _THRIFT_BINARY, column.name),
+          (6, _THRIFT_I32, column.column_type.converted_type),
+      ])
+
+    footer = _ThriftCompactEncoder.EncodeStruct([
+        (1, _THRIFT_I32, 1),
+        (2, _THRIFT_LIST, (_THRIFT_STRUCT, schema)),
+        (3, _THRIFT_I64, self.num_rows),
+        (4, _THRIFT_LIST, (_THRIFT_STRUCT, self.row_groups)),
+        (6, _THRIFT_BINARY, "GRR"),
+    ])
+    return self._Output(footer + struct.pack("<I", len(footer)) + _MAGIC)
+
+
+class ParquetInstantOutputPlugin(
+    instant_output_plugin.InstantOutputPluginWithExportConversion):
+  """Instant output plugin that writes results to zipped Parquet files."""
+
+  plugin_name = "parquet-zip"
+  friendly_name = "Parquet (zipped)"
+  description = "Output ZIP archive with Apache Parquet files."
+  output_file_extension = ".zip"
+
+  ROW_GROUP_SIZE = 10000
+
+  @property
+  def path_prefix(self):
+    prefix, _ = os.path.splitext(self.output_file_name)
+    return prefix
+
+  def Start(self):
+    # Parquet pages are compressed already.
+    self.archive_generator = utils.StreamingZipGenerator(
+        compression=zipfile.ZIP_STORED)
+    self.export_counts = {}
+    return []
+
+  def _GetParquetColumns(self, value_class, prefix=()):
+    columns = []
+    for type_info in value_class.type_infos:
+      path = prefix + (utils.SmartStr(type_info.name),)
+      if type_info.__class__ is rdf_structs.ProtoEmbedded:
+        columns.extend(self._GetParquetColumns(type_info.type, prefix=path))
+      else:
+        columns.append(
+            ParquetColumn(path, Rdf2ParquetAdapter.GetColumnType(type_info)))
+    return columns
+
+  def ProcessSingleTypeExportedValues(self, original_value_type,
+                                      exported_values):
+    first_value = next(exported_values, None)
+    if not first_value:
+      return
+
+    if not isinstance(first_value, rdf_structs.RDFProtoStruct):
+      raise ValueError("The Parquet plugin only supports export-protos")
+
+    yield self.archive_generator.WriteFileHeader(
+        "%s/%s/from_%s.parquet" % (self.path_prefix,
+                                   first_value.__class__.__name__,
+                                   original_value_type.__name__))
+
+    writer = ParquetWriter(self._GetParquetColumns(first_value.__class__))
+    yield self.archive_generator.WriteFileChunk(writer.Start())
+
+    values = itertools.chain([first_value], exported_values)
+    for batch in utils.Grouper(values, self.ROW_GROUP_SIZE):
+      yield self.archive_generator.WriteFileChunk(writer.WriteRowGroup(batch))
+
+    yield self.archive_generator.WriteFileChunk(writer.Finish())
+    yield self.archive_generator.WriteFileFooter()
+
+    self.export_counts.setdefault(
+        original_value_type.__name__,
+        dict())[first_value.__class__.__name__] = writer.num_rows
+
+  def Finish(self):
+    manifest = {"export_stats": self.export_counts}
+
+    yield self.archive_generator.WriteFileHeader(self.path_prefix + "/MANIFEST")
+    yield self.archive_generator.WriteFileChunk(yaml.safe_dump(manifest))
+    yield self.archive_generator.WriteFileFooter()
+    yield self.archive_generator.Close()
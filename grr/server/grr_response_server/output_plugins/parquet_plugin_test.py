@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""Tests for Parquet output plugin."""
+
+import os
+import struct
+import zipfile
+import zlib
+
+import yaml
+
+from grr.lib import flags
+from grr.lib import utils
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import paths as rdf_paths
+from grr.lib.rdfvalues import structs as rdf_structs
+from grr.server.grr_response_server.output_plugins import parquet_plugin
+from grr.server.grr_response_server.output_plugins import test_plugins
+from grr.test_lib import test_lib
+
+
+def _ReadThriftValue(data, pos, thrift_type):
+  """Decodes a single thrift compact protocol value."""
+  if thrift_type in (1, 2):
+    return thrift_type == 1, pos
+  if thrift_type in (5, 6):
+    value, pos = rdf_structs.VarintReader(data, pos)
+    return (value >> 1) ^ -(value & 1), pos
+  if thrift_type == 8:
+    length, pos = rdf_structs.VarintReader(data, pos)
+    return data[pos:pos + length], pos + length
+  if thrift_type == 9:
+    header = ord(data[pos])
+    pos += 1
+    size = header >> 4
+    if size == 15:
+      size, pos = rdf_structs.VarintReader(data, pos)
+    elements = []
+    for _ in range(size):
+      element, pos = _ReadThriftValue(data, pos, header & 0x0f)
+      elements.append(element)
+    return elements, pos
+  if thrift_type == 12:
+    return _ReadThriftStruct(data, pos)
+  raise ValueError("Unexpected thrift type %d" % thrift_type)
+
+
+def _ReadThriftStruct(data, pos):
+  """Decodes a thrift compact protocol struct into a dict keyed by field id."""
+  result = {}
+  field_id = 0
+  while True:
+    header = ord(data[pos])
+    pos += 1
+    if header == 0:
+      return result, pos
+
+    if header >> 4:
+      field_id += header >> 4
+    else:
+      value, pos = rdf_structs.VarintReader(data, pos)
+      field_id = (value >> 1) ^ -(value & 1)
+    result[field_id], pos = _ReadThriftValue(data, pos, header & 0x0f)
+
+
+def _ReadParquetFile(data):
+  """Returns the row count, row group count and column values of a file."""
+  assert data[:4] == "PAR1"
+  assert data[-4:] == "PAR1"
+  footer_length = struct.unpack("<I", data[-8:-4])[0]
+  metadata, _ = _ReadThriftStruct(data[-8 - footer_length:-8], 0)
+
+  columns = {}
+  converted_types = {}
+  for element in metadata[2][1:]:
+    columns[element[4]] = []
+    converted_types[element[4]] = element.get(6)
+
+  for row_group in metadata[4]:
+    for column_chunk in row_group[1]:
+      column_metadata = column_chunk[3]
+      page_header, pos = _ReadThriftStruct(data, column_metadata[9])
+      page = zlib.decompress(data[pos:pos + page_header[3]],
+                             16 + zlib.MAX_WBITS)
+      num_values = page_header[5][1]
+
+      physical_type = column_metadata[1]
+      if physical_type == 0:
+        values = [bool(ord(page[i // 8]) & (1 << (i % 8)))
+                  for i in range(num_values)]
+      elif physical_type == 2:
+        # Unsigned columns have the UINT_64 converted type.
+        fmt = "Q" if converted_types[column_metadata[3][0]] == 14 else "q"
+        values = list(struct.unpack("<%d%s" % (num_values, fmt), page))
+      elif physical_type == 5:
+        values = list(struct.unpack("<%dd" % num_values, page))
+      else:
+        values = []
+        pos = 0
+        for _ in range(num_values):
+          length = struct.unpack("<I", page[pos:pos + 4])[0]
+          values.append(page[pos + 4:pos + 4 + length])
+          pos += 4 + length
+
+      columns[column_metadata[3][0]].extend(values)
+
+  return metadata[3], len(metadata[4]), columns
+
+
+class ParquetInstantOutputPluginTest(test_plugins.InstantOutputPluginTestBase):
+  """Tests instant Parquet output plugin."""
+
+  plugin_cls = parquet_plugin.ParquetInstantOutputPlugin
+
+  def ProcessValuesToZip(self, values_by_cls):
+    fd_path = self.ProcessValues(values_by_cls)
+    file_basename, _ = os.path.splitext(os.path.basename(fd_path))
+    return zipfile.ZipFile(fd_path), file_basename
+
+  def _CreateStatEntries(self, count):
+    responses = []
+    for i in range(count):
+      responses.append(
+          rdf_client.StatEntry(
+              pathspec=rdf_paths.PathSpec(
+                  path="/foo/bar/%d" % i, pathtype="OS"),
+              st_mode=33184,  # octal = 100640 => u=rw,g=r,o= => -rw-r-----
+              st_ino=1063090,
+              st_dev=64512L,
+              st_nlink=1 + i,
+              st_uid=139592,
+              st_gid=5000,
+              st_size=0,
+              st_atime=1336469177,
+              st_mtime=1336129892,
+              st_ctime=1336129892))
+    return responses
+
+  def testParquetPluginWithValuesOfSameType(self):
+    zip_fd, prefix = self.ProcessValuesToZip({
+        rdf_client.StatEntry: self._CreateStatEntries(10)
+    })
+    self.assertEqual(
+        set(zip_fd.namelist()),
+        set([
+            "%s/MANIFEST" % prefix,
+            "%s/ExportedFile/from_StatEntry.parquet" % prefix
+        ]))
+
+    parsed_manifest = yaml.load(zip_fd.read("%s/MANIFEST" % prefix))
+    self.assertEqual(parsed_manifest, {
+        "export_stats": {
+            "StatEntry": {
+                "ExportedFile": 10
+            }
+        }
+    })
+
+    num_rows, num_row_groups, columns = _ReadParquetFile(
+        zip_fd.read("%s/ExportedFile/from_StatEntry.parquet" % prefix))
+    self.assertEqual(num_rows, 10)
+    self.assertEqual(num_row_groups, 1)
+
+    # Make sure metadata is filled in.
+    self.assertEqual(columns["metadata.client_urn"],
+                     [utils.SmartStr(self.client_id)] * 10)
+    self.assertEqual(columns["metadata.hostname"], ["Host-0"] * 10)
+    self.assertEqual(columns["metadata.source_urn"],
+                     [utils.SmartStr(self.results_urn)] * 10)
+
+    self.assertEqual(columns["urn"], [
+        utils.SmartStr(self.client_id.Add("/fs/os/foo/bar").Add(str(i)))
+        for i in range(10)
+    ])
+    self.assertEqual(columns["st_mode"], ["-rw-r-----"] * 10)
+    self.assertEqual(columns["st_ino"], [1063090] * 10)
+    self.assertEqual(columns["st_dev"], [64512] * 10)
+    self.assertEqual(columns["st_nlink"], range(1, 11))
+    self.assertEqual(columns["st_size"], [0] * 10)
+    self.assertEqual(columns["st_atime"], [1336469177 * 1000000] * 10)
+    self.assertEqual(columns["symlink"], [""] * 10)
+
+  def testParquetPluginWritesRowGroups(self):
+    with utils.Stubber(parquet_plugin.ParquetInstantOutputPlugin,
+                       "ROW_GROUP_SIZE", 3):
+      zip_fd, prefix = self.ProcessValuesToZip({
+          rdf_client.StatEntry: self._CreateStatEntries(10)
+      })
+
+    num_rows, num_row_groups, columns = _ReadParquetFile(
+        zip_fd.read("%s/ExportedFile/from_StatEntry.parquet" % prefix))
+    self.assertEqual(num_rows, 10)
+    self.assertEqual(num_row_groups, 4)
+    self.assertEqual(columns["st_nlink"], range(1, 11))
+
+  def testParquetPluginWithValuesOfMultipleTypes(self):
+    zip_fd, prefix = self.ProcessValuesToZip({
+        rdf_client.StatEntry: [
+            rdf_client.StatEntry(
+                pathspec=rdf_paths.PathSpec(path="/foo/bar", pathtype="OS"))
+        ],
+        rdf_client.Process: [rdf_client.Process(pid=42)]
+    })
+    self.assertEqual(
+        set(zip_fd.namelist()),
+        set([
+            "%s/MANIFEST" % prefix,
+            "%s/ExportedFile/from_StatEntry.parquet" % prefix,
+            "%s/ExportedProcess/from_Process.parquet" % prefix
+        ]))
+
+    parsed_manifest = yaml.load(zip_fd.read("%s/MANIFEST" % prefix))
+    self.assertEqual(
+        parsed_manifest, {
+            "export_stats": {
+                "StatEntry": {
+                    "ExportedFile": 1
+                },
+                "Process": {
+                    "ExportedProcess": 1
+                }
+            }
+        })
+
+    _, _, columns = _ReadParquetFile(
+        zip_fd.read("%s/ExportedProcess/from_Process.parquet" % prefix))
+    self.assertEqual(columns["pid"], [42])
+    self.assertEqual(columns["metadata.hostname"], ["Host-0"])
+
+
+def main(argv):
+  test_lib.main(argv)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -4,6 +4,8 @@
 import collections
 import logging
 import random
+import threading
+import time
 
 from grr import config
 from grr.lib import queues
@@ -16,6 +18,7 @@ from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import objects as rdf_objects
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import fleetspeak_utils
+from grr.server.grr_response_server import threadpool
 
 
 class Error(Exception):
@@ -101,6 +104,11 @@ class QueueManager(object):
 
   notification_expiry_time = 600
 
+  # Reads notification shards concurrently for all queue managers. The threads
+  # are long lived since workers read their shards several times a second.
+  notification_fetcher_pool = None
+  notification_fetcher_pool_lock = threading.Lock()
+
   def __init__(self, store=None, token=None):
     self.token = token
     if store is None:
@@ -489,6 +497,67 @@ class QueueManager(object):
 
     return self._SortByPriority(output_dict.values(), queue)
 
+  def GetNotificationsByPriorityForShards(self, queue, queue_shards):
+    """Same as GetNotificationsByPriority but for the given shards.
+
+    The shards are read concurrently.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      queue_shards: The notification shards of the queue to read.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
+    end_time = self.frozen_timestamp or rdfvalue.RDFDatetime.Now()
+    results = [None] * len(queue_shards)
+    done = threading.Semaphore(0)
+
+    def Fetch(index, queue_shard):
+      try:
+        results[index] = self.data_store.GetNotifications(queue_shard, end_time)
+      finally:
+        done.release()
+
+    if len(queue_shards) > 1:
+      pool = self._GetNotificationFetcherPool()
+      for index, queue_shard in enumerate(queue_shards[1:], 1):
+        pool.AddTask(
+            target=Fetch,
+            args=(index, queue_shard),
+            name="Notifications %s" % queue_shard)
+
+    # The first shard is read by this thread.
+    if queue_shards:
+      Fetch(0, queue_shards[0])
+
+    for _ in queue_shards:
+      done.acquire()
+
+    output_dict = {}
+    for index, notifications in enumerate(results):
+      if notifications is None:
+        raise Error("Unable to read notifications from %s." %
+                    queue_shards[index])
+
+      self._MergeNotifications(notifications, output_dict)
+
+    return self._SortByPriority(output_dict.values(), queue)
+
+  @classmethod
+  def _GetNotificationFetcherPool(cls):
+    with cls.notification_fetcher_pool_lock:
+      if cls.notification_fetcher_pool is None:
+        # One thread per shard, the calling thread reads the first one.
+        size = max(1, config.CONFIG["Worker.queue_shards"] - 1)
+        cls.notification_fetcher_pool = threadpool.ThreadPool.Factory(
+            "notification_fetcher",
+            min_threads=size,
+            max_threads=size,
+            cpu_check=False)
+        cls.notification_fetcher_pool.Start()
+
+      return cls.notification_fetcher_pool
+
   def GetNotifications(self, queue):
     """Returns all queue notifications sorted by priority."""
     queue_shard = self.GetNotificationShard(queue)
@@ -533,7 +602,15 @@ class QueueManager(object):
     if notifications_by_session_id is None:
       notifications_by_session_id = {}
     end_time = self.frozen_timestamp or rdfvalue.RDFDatetime.Now()
-    for notification in self.data_store.GetNotifications(queue_shard, end_time):
+    self._MergeNotifications(
+        self.data_store.GetNotifications(queue_shard, end_time),
+        notifications_by_session_id)
+
+    return notifications_by_session_id
+
+  def _MergeNotifications(self, notifications, notifications_by_session_id):
+    """Merges notifications into a dict keyed by session id."""
+    for notification in notifications:
 
       existing = notifications_by_session_id.get(notification.session_id)
       if existing:
@@ -552,8 +629,6 @@ class QueueManager(object):
       else:
         notifications_by_session_id[notification.session_id] = notification
 
-    return notifications_by_session_id
-
   def NotifyQueue(self, notification, **kwargs):
     """This signals that there are new messages available in a queue."""
     self._MultiNotifyQueue(notification.session_id.Queue(), [notification],
@@ -683,6 +758,146 @@ class WellKnownQueueManager(QueueManager):
       yield response
 
 
+class NotificationShardLeaser(object):
+  """Leases a fair share of the notification shards of a queue.
+
+  Every worker heartbeats into a registry on the queue and leases
+  ceil(shards / live workers) shards using data store subject locks. Workers
+  holding more than their share release the surplus so shards are rebalanced
+  when workers join, and the leases of dead workers expire so their shards are
+  picked up by the others.
+
+  Leases only distribute the polling load. Flows are still processed under
+  their own locks, so a shard briefly polled by two workers is harmless.
+  """
+
+  WORKER_ATTRIBUTE_PREFIX = "worker:"
+
+  def __init__(self, queue, worker_id, store=None, lease_time=None):
+    if store is None:
+      store = data_store.DB
+
+    if lease_time is None:
+      lease_time = config.CONFIG["Worker.notification_shard_lease_time"]
+
+    self.data_store = store
+    self.queue = queue
+    self.worker_id = worker_id
+    self.lease_time = lease_time
+    self.registry_subject = queue.Add("Workers")
+    self.shards = QueueManager(store=store).GetAllNotificationShards(queue)
+
+    # Maps leased shards to their DBSubjectLock.
+    self.leases = {}
+    self.next_refresh = 0
+
+  def _LeaseSubject(self, queue_shard):
+    return queue_shard.Add("ShardLease")
+
+  def _Heartbeat(self):
+    """Registers this worker and returns the number of live workers."""
+    now = rdfvalue.RDFDatetime.Now().AsMicrosecondsSinceEpoch()
+    self.data_store.Set(
+        self.registry_subject,
+        self.WORKER_ATTRIBUTE_PREFIX + self.worker_id,
+        self.worker_id,
+        timestamp=now)
+
+    deadline = now - self.lease_time * 1000000
+    live_workers = 0
+    expired = []
+    for attribute, _, timestamp in self.data_store.ResolvePrefix(
+        self.registry_subject,
+        self.WORKER_ATTRIBUTE_PREFIX,
+        timestamp=self.data_store.NEWEST_TIMESTAMP):
+      if timestamp < deadline:
+        expired.append(attribute)
+      else:
+        live_workers += 1
+
+    if expired:
+      # Only remove heartbeats older than the deadline in case the worker
+      # came back in the meantime.
+      self.data_store.DeleteAttributes(
+          self.registry_subject, expired, end=deadline)
+
+    return max(1, live_workers)
+
+  def _Release(self, queue_shard):
+    lease = self.leases.pop(queue_shard)
+    try:
+      lease.Release()
+    except data_store.Error as e:
+      logging.warning("Unable to release lease on %s: %s", queue_shard, e)
+
+  def GetShards(self):
+    """Returns the leased shards, refreshing the leases when they are due.
+
+    Leases are refreshed about three times per lease time, which is plenty to
+    keep them from expiring. Workers poll much more often than that.
+
+    Returns:
+      A list of notification shards this worker should poll.
+    """
+    if time.time() >= self.next_refresh:
+      return self.Refresh()
+
+    return sorted(self.leases)
+
+  def Refresh(self):
+    """Renews, acquires and releases leases to hold a fair share of shards.
+
+    Returns:
+      A list of notification shards this worker should poll.
+    """
+    if len(self.shards) == 1:
+      return list(self.shards)
+
+    self.next_refresh = time.time() + self.lease_time / 3.0
+
+    live_workers = self._Heartbeat()
+    target = (len(self.shards) + live_workers - 1) // live_workers
+
+    # Renew our leases. Leases which expired in the meantime might have been
+    # picked up by another worker already.
+    for queue_shard, lease in self.leases.items():
+      if not lease.CheckLease():
+        self._Release(queue_shard)
+        continue
+
+      try:
+        lease.UpdateLease(self.lease_time)
+      except data_store.DBSubjectLockError:
+        self._Release(queue_shard)
+
+    # Give up shards if more workers joined.
+    while len(self.leases) > target:
+      self._Release(random.choice(self.leases.keys()))
+
+    candidates = [shard for shard in self.shards if shard not in self.leases]
+    random.shuffle(candidates)
+    for queue_shard in candidates:
+      if len(self.leases) >= target:
+        break
+
+      try:
+        self.leases[queue_shard] = self.data_store.DBSubjectLock(
+            self._LeaseSubject(queue_shard), lease_time=self.lease_time)
+      except data_store.DBSubjectLockError:
+        pass
+
+    stats.STATS.SetGaugeValue(
+        "worker_leased_notification_shards",
+        len(self.leases),
+        fields=[self.queue.Basename()])
+
+    return sorted(self.leases)
+
+  def ReleaseAll(self):
+    for queue_shard in list(self.leases):
+      self._Release(queue_shard)
+
+
 class QueueManagerInit(registry.InitHook):
   """Registers vars used by the QueueManager."""
 
@@ -694,3 +909,5 @@ class QueueManagerInit(registry.InitHook):
         "notification_queue_count",
         int,
         fields=[("queue_name", str), ("priority", str)])
+    stats.STATS.RegisterGaugeMetric(
+        "worker_leased_notification_shards", int, fields=[("queue_name", str)])
@@ -545,6 +545,88 @@ class MultiShardedQueueManagerTest(QueueManagerTest):
     notifications = manager.GetNotificationsForAllShards(queues.HUNTS)
     self.assertEqual(len(notifications), 2)
 
+  def testGetNotificationsByPriorityForShards(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    for flow_name in ["42", "43"]:
+      manager.QueueNotification(
+          session_id=rdfvalue.SessionID(
+              base="aff4:/hunts", queue=queues.HUNTS, flow_name=flow_name))
+      manager.Flush()
+
+    shards = manager.GetAllNotificationShards(queues.HUNTS)
+    by_priority = manager.GetNotificationsByPriorityForShards(
+        queues.HUNTS, shards)
+    self.assertEqual(sum(len(n) for n in by_priority.values()), 2)
+
+    for shard in shards:
+      by_priority = manager.GetNotificationsByPriorityForShards(
+          queues.HUNTS, [shard])
+      self.assertEqual(sum(len(n) for n in by_priority.values()), 1)
+
+  def _Leasers(self, count):
+    return [
+        queue_manager.NotificationShardLeaser(
+            queues.HUNTS, "worker%d" % i, lease_time=60) for i in range(count)
+    ]
+
+  def testShardLeasesAreRebalancedWhenWorkersJoin(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 5}):
+      first, second = self._Leasers(2)
+
+      all_shards = first.Refresh()
+      self.assertEqual(len(all_shards), 5)
+
+      # All shards are taken so the new worker has to wait for the first one
+      # to give up its surplus.
+      self.assertEqual(second.Refresh(), [])
+      self.assertEqual(len(first.Refresh()), 3)
+      self.assertEqual(len(second.Refresh()), 2)
+
+      self.assertItemsEqual(first.Refresh() + second.Refresh(), all_shards)
+
+  def testShardsOfDeadWorkersAreTakenOver(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 5}):
+      first, second = self._Leasers(2)
+
+      with test_lib.FakeTime(1000):
+        first.Refresh()
+        second.Refresh()
+        first.Refresh()
+        self.assertEqual(len(second.Refresh()), 2)
+
+      # The second worker stops renewing its leases.
+      with test_lib.FakeTime(1030):
+        self.assertEqual(len(first.Refresh()), 3)
+
+      with test_lib.FakeTime(1100):
+        self.assertEqual(len(first.Refresh()), 5)
+
+  def testGetShardsOnlyRefreshesWhenDue(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 5}):
+      first, second = self._Leasers(2)
+
+      with test_lib.FakeTime(1000):
+        self.assertEqual(len(first.GetShards()), 5)
+        self.assertEqual(second.GetShards(), [])
+
+      # Leases are not refreshed before a third of the lease time passed.
+      with test_lib.FakeTime(1019):
+        self.assertEqual(len(first.GetShards()), 5)
+        self.assertEqual(second.GetShards(), [])
+
+      with test_lib.FakeTime(1020):
+        self.assertEqual(len(first.GetShards()), 3)
+        self.assertEqual(len(second.GetShards()), 2)
+
+  def testReleasedShardsCanBeLeasedRightAway(self):
+    with test_lib.ConfigOverrider({"Worker.queue_shards": 5}):
+      first, second = self._Leasers(2)
+
+      first.Refresh()
+      first.ReleaseAll()
+
+      self.assertEqual(len(second.Refresh()), 3)
+
   def testNotificationRequeueing(self):
     with test_lib.ConfigOverrider({"Worker.queue_shards": 1}):
       session_id = rdfvalue.SessionID(
@@ -3,6 +3,7 @@
 """
 
 import collections
+import Queue
 import random
 import threading
 import time
@@ -11,6 +12,7 @@ from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import protodict as rdf_protodict
+from grr.lib.rdfvalues import structs as rdf_structs
 
 from grr.server.grr_response_server import data_store
 
@@ -26,6 +28,11 @@ class SequentialCollection(object):
   # The type which we store, subclasses must set this to a subclass of RDFValue.
   RDF_TYPE = None
 
+  # If set, values added without an explicit timestamp and suffix are stored
+  # in compressed blocks, one per mutation pool flush. Values of a block share
+  # a timestamp and fields which are the same in all of them are stored once.
+  BLOCK_STORAGE = False
+
   def __init__(self, collection_id):
     super(SequentialCollection, self).__init__()
     # The collection_id for this collection is a RDFURN for now.
@@ -70,10 +77,6 @@ class SequentialCollection(object):
                        cls.RDF_TYPE.__name__)
     if mutation_pool is None:
       raise ValueError("Mutation pool can't be none.")
-    if timestamp is None:
-      timestamp = rdfvalue.RDFDatetime.Now()
-    if isinstance(timestamp, rdfvalue.RDFDatetime):
-      timestamp = timestamp.AsMicrosecondsSinceEpoch()
 
     if not rdf_value.age:
       rdf_value.age = rdfvalue.RDFDatetime.Now()
@@ -81,6 +84,18 @@ class SequentialCollection(object):
     if not isinstance(collection_urn, rdfvalue.RDFURN):
       collection_urn = rdfvalue.RDFURN(collection_urn)
 
+    if cls.BLOCK_STORAGE and timestamp is None and suffix is None:
+      _, timestamp, suffix = mutation_pool.CollectionAddBlockItem(
+          collection_urn,
+          rdf_value,
+          common_fields=issubclass(cls.RDF_TYPE, rdf_structs.RDFProtoStruct))
+      return timestamp, suffix
+
+    if timestamp is None:
+      timestamp = rdfvalue.RDFDatetime.Now()
+    if isinstance(timestamp, rdfvalue.RDFDatetime):
+      timestamp = timestamp.AsMicrosecondsSinceEpoch()
+
     _, timestamp, suffix = mutation_pool.CollectionAddItem(
         collection_urn, rdf_value, timestamp, suffix=suffix)
 
@@ -259,6 +274,19 @@ class IndexedSequentialCollection(SequentialCollection):
 
   INDEX_WRITE_DELAY = rdfvalue.Duration("3m")
 
+  # ParallelScan reads ranges of at least this many records, split at index
+  # points, using up to SCAN_THREADS threads.
+
+  SCAN_RANGE_SIZE = 16 * 1024
+  SCAN_THREADS = 4
+
+  # Records are counted when they are added, one count delta per mutation pool
+  # flush, and the deltas are merged in the background. Reading the length
+  # merges the counter if more deltas than this were written since the last
+  # merge.
+
+  MAX_UNMERGED_COUNT_DELTAS = 1024
+
   def __init__(self, *args, **kwargs):
     super(IndexedSequentialCollection, self).__init__(*args, **kwargs)
     self._index = None
@@ -322,6 +350,139 @@ class IndexedSequentialCollection(SequentialCollection):
     for (_, _, value) in self._IndexedScan(offset):
       yield value
 
+  def _IndexStartTimestamp(self, i):
+    """Returns the after_timestamp Scan() needs to start at index point i."""
+    timestamp, suffix = self._index[i]
+    return (max(0, timestamp), suffix - 1)
+
+  def _SplitIntoRanges(self, offset, max_records=None):
+    """Splits the indexed records starting around offset into ranges.
+
+    Args:
+      offset: The first record number the ranges have to cover.
+      max_records: The maximum number of records to cover, defaults to all
+          indexed records.
+
+    Returns:
+      A list of (first_record_number, number_of_records) pairs. Every range
+      starts at an index point and the first one may start before offset.
+    """
+    end = self._max_indexed
+    if max_records is not None:
+      end = min(end, offset + max_records)
+
+    points = sorted(i for i in self._index if i <= end)
+    range_start = max(i for i in points if i <= offset)
+
+    ranges = []
+    for point in points:
+      if point - range_start >= self.SCAN_RANGE_SIZE:
+        ranges.append((range_start, point - range_start))
+        range_start = point
+
+    if end > range_start:
+      ranges.append((range_start, end - range_start))
+
+    return ranges
+
+  def _ReadRange(self, first_record, num_records):
+    return list(
+        self.Scan(
+            after_timestamp=self._IndexStartTimestamp(first_record),
+            max_records=num_records))
+
+  def _ReadRangesInParallel(self, ranges, max_threads):
+    """Reads given ranges in parallel, yields their records in order."""
+    num_threads = min(max_threads, len(ranges))
+    # Every thread reads every num_threads-th range and hands its records over
+    # through its own queue, so at most 2 * num_threads ranges are in memory.
+    out_queues = [Queue.Queue(maxsize=1) for _ in xrange(num_threads)]
+    stop = threading.Event()
+
+    def ReadRanges(thread_idx):
+      for range_idx in xrange(thread_idx, len(ranges), num_threads):
+        try:
+          records = self._ReadRange(*ranges[range_idx])
+        except Exception as e:  # pylint: disable=broad-except
+          records = e
+
+        while not stop.is_set():
+          try:
+            out_queues[thread_idx].put(records, timeout=1)
+            break
+          except Queue.Full:
+            pass
+
+        if stop.is_set() or isinstance(records, Exception):
+          return
+
+    for thread_idx in xrange(num_threads):
+      t = threading.Thread(
+          target=ReadRanges,
+          args=(thread_idx,),
+          name="SequentialCollectionRangeReader")
+      t.daemon = True
+      t.start()
+
+    try:
+      for range_idx in xrange(len(ranges)):
+        records = out_queues[range_idx % num_threads].get()
+        if isinstance(records, Exception):
+          raise records
+
+        yield ranges[range_idx][0], records
+    finally:
+      # Let the readers go if the caller stops iterating early.
+      stop.set()
+
+  def ParallelScan(self, offset=0, max_records=None, max_threads=None):
+    """Scans records starting with record number offset.
+
+    Instead of reading the whole collection sequentially, the indexed part of
+    the collection is split into ranges between index points which are read
+    by up to max_threads threads at the same time. Records are still
+    returned in the same order Scan() returns them.
+
+    Args:
+      offset: The record number to start with.
+      max_records: The maximum number of records to return. Defaults to
+          unlimited.
+      max_threads: The maximum number of ranges to read concurrently. Defaults
+          to SCAN_THREADS.
+
+    Yields:
+      Pairs (timestamp, rdf_value), indicating that rdf_value was stored at
+      timestamp.
+    """
+    self._ReadIndex()
+
+    if max_threads is None:
+      max_threads = self.SCAN_THREADS
+
+    ranges = self._SplitIntoRanges(offset, max_records=max_records)
+    if len(ranges) > 1 and max_threads > 1:
+      ranges_records = self._ReadRangesInParallel(ranges, max_threads)
+    else:
+      ranges_records = ((first_record, self._ReadRange(first_record, count))
+                        for first_record, count in ranges)
+
+    next_record = offset
+    for first_record, records in ranges_records:
+      for record in records[max(0, offset - first_record):]:
+        yield record
+        next_record += 1
+
+    if max_records is not None:
+      max_records -= next_record - offset
+      if max_records <= 0:
+        return
+
+    # Records after the last index point are read sequentially, this updates
+    # the index as well.
+    for (_, timestamp, value) in self._IndexedScan(
+        next_record, max_records=max_records):
+      yield (timestamp[0], value)
+
   def __getitem__(self, index):
     if index >= 0:
       for (_, _, value) in self._IndexedScan(index, max_records=1):
@@ -330,14 +491,65 @@ class IndexedSequentialCollection(SequentialCollection):
     else:
       raise RuntimeError("Index must be >= 0")
 
-  def CalculateLength(self):
+  def _CountRecords(self):
+    """Counts records, returns the count and the last record's timestamp."""
     self._ReadIndex()
-    highest_index = None
-    for (i, _, _) in self._IndexedScan(self._max_indexed):
-      highest_index = i
-    if highest_index is None:
-      return 0
-    return highest_index + 1
+    count = 0
+    last_timestamp = None
+    for (i, timestamp, _) in self._IndexedScan(self._max_indexed):
+      count = i + 1
+      last_timestamp = timestamp
+    return count, last_timestamp
+
+  def MergeCount(self, blocking=True):
+    """Merges records added since the last merge into the record counter.
+
+    Collections written before record counters were introduced are counted
+    (using the index) on the first merge.
+
+    Args:
+      blocking: If False, raise when the counter is being merged by someone
+          else instead of waiting.
+
+    Returns:
+      The number of records in the collection.
+
+    Raises:
+      DBSubjectLockError: If the collection could not be locked.
+    """
+    with data_store.DB.LockRetryWrapper(
+        self.collection_id, blocking=blocking, lease_time=600):
+      count, deltas = data_store.DB.CollectionReadCount(self.collection_id)
+      if count is None:
+        count, last_timestamp = self._CountRecords()
+        # Deltas of the records we have just counted must not be added again.
+        # The records of a delta were written together, so if its first record
+        # was counted, all of them were.
+        count += sum(
+            delta_count for timestamp, suffix, delta_count in deltas
+            if last_timestamp is None or (timestamp, suffix) > last_timestamp)
+      else:
+        count += sum(delta_count for _, _, delta_count in deltas)
+
+      # Don't create counters for collections which don't exist.
+      if count or deltas:
+        with data_store.DB.GetMutationPool() as mutation_pool:
+          mutation_pool.CollectionMergeCount(self.collection_id, count, deltas)
+
+    return count
+
+  def CalculateLength(self):
+    count, deltas = data_store.DB.CollectionReadCount(self.collection_id)
+    if count is not None and len(deltas) <= self.MAX_UNMERGED_COUNT_DELTAS:
+      return count + sum(delta_count for _, _, delta_count in deltas)
+
+    try:
+      return self.MergeCount(blocking=False)
+    except data_store.DBSubjectLockError:
+      # The counter is being merged right now, use what we have read.
+      if count is not None:
+        return count + sum(delta_count for _, _, delta_count in deltas)
+      return self._CountRecords()[0]
 
   def __len__(self):
     return self.CalculateLength()
@@ -347,6 +559,11 @@ class IndexedSequentialCollection(SequentialCollection):
     for _ in self._IndexedScan(self._max_indexed):
       pass
 
+    try:
+      self.MergeCount()
+    except data_store.DBSubjectLockError:
+      pass
+
   @classmethod
   def StaticAdd(cls,
                 collection_urn,
@@ -360,6 +577,11 @@ class IndexedSequentialCollection(SequentialCollection):
         timestamp=timestamp,
         suffix=suffix,
         mutation_pool=mutation_pool)
+
+    if not isinstance(collection_urn, rdfvalue.RDFURN):
+      collection_urn = rdfvalue.RDFURN(collection_urn)
+    mutation_pool.CollectionAddCountDelta(collection_urn, *r)
+
     if random.randint(0, cls.INDEX_SPACING) == 0:
       BACKGROUND_INDEX_UPDATER.AddIndexToUpdate(cls, collection_urn)
     return r
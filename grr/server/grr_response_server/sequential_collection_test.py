@@ -7,6 +7,8 @@ import time
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import utils
+from grr.lib.rdfvalues import client as rdf_client
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import sequential_collection
 from grr.test_lib import aff4_test_lib
@@ -175,7 +177,12 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
         _ = collection[0]
         self.assertEqual(sorted(collection._index.keys()), [0])
 
+        # The length is read from the record counter and doesn't touch the
+        # index anymore.
         self.assertEqual(collection.CalculateLength(), 10 * spacing)
+        self.assertEqual(sorted(collection._index.keys()), [0])
+
+        collection.UpdateIndex()
         self.assertEqual(
             sorted(collection._index.keys()), [i * spacing for i in xrange(10)])
         for index in collection._index:
@@ -225,6 +232,150 @@ class IndexedSequentialCollectionTest(aff4_test_lib.AFF4ObjectTest):
         for i in range(data_size - spacing + 5, data_size - spacing - 5, -1):
           self.assertEqual(collection[i], i)
 
+  def testParallelScan(self):
+    isq = sequential_collection.IndexedSequentialCollection
+    with utils.MultiStubber((isq, "INDEX_SPACING", 10),
+                            (isq, "SCAN_RANGE_SIZE", 20)):
+      urn = "aff4:/sequential_collection/testParallelScan"
+      collection = self._TestCollection(urn)
+      with data_store.DB.GetMutationPool() as pool:
+        for i in range(100):
+          collection.StaticAdd(urn, rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                             rdfvalue.Duration("10m")):
+        collection.UpdateIndex()
+
+      # These are not indexed yet and have to be read after the ranges.
+      with data_store.DB.GetMutationPool() as pool:
+        for i in range(100, 115):
+          collection.StaticAdd(urn, rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+      collection = self._TestCollection(urn)
+      expected = [(ts, value) for ts, value in collection.Scan()]
+      self.assertEqual([value for _, value in expected], range(115))
+
+      self.assertEqual(list(collection.ParallelScan()), expected)
+      self.assertEqual(list(collection.ParallelScan(max_threads=1)), expected)
+      for offset, max_records in [(35, 30), (35, None), (0, 1), (95, 10),
+                                  (105, None), (110, 100), (200, None)]:
+        end = None if max_records is None else offset + max_records
+        self.assertEqual(
+            list(collection.ParallelScan(
+                offset=offset, max_records=max_records)),
+            expected[offset:end])
+
+  def testParallelScanReadsRangesConcurrently(self):
+    isq = sequential_collection.IndexedSequentialCollection
+    with utils.MultiStubber((isq, "INDEX_SPACING", 10),
+                            (isq, "SCAN_RANGE_SIZE", 10)):
+      urn = "aff4:/sequential_collection/testParallelScanConcurrently"
+      collection = self._TestCollection(urn)
+      with data_store.DB.GetMutationPool() as pool:
+        for i in range(80):
+          collection.StaticAdd(urn, rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+      with test_lib.FakeTime(rdfvalue.RDFDatetime.Now() +
+                             rdfvalue.Duration("10m")):
+        collection.UpdateIndex()
+
+      collection = self._TestCollection(urn)
+      reader_threads = set()
+      original_read_range = collection._ReadRange
+
+      def ReadRange(first_record, num_records):
+        reader_threads.add(threading.current_thread().name)
+        return original_read_range(first_record, num_records)
+
+      with utils.Stubber(collection, "_ReadRange", ReadRange):
+        values = [value for _, value in collection.ParallelScan(max_threads=3)]
+
+      self.assertEqual(values, range(80))
+      self.assertEqual(reader_threads, set(["SequentialCollectionRangeReader"]))
+
+  def testLengthIsReadFromRecordCounter(self):
+    urn = "aff4:/sequential_collection/testLengthIsReadFromRecordCounter"
+    collection = self._TestCollection(urn)
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(50):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    # All records added through one mutation pool are counted by one delta.
+    count, deltas = data_store.DB.CollectionReadCount(collection.collection_id)
+    self.assertIsNone(count)
+    self.assertEqual(len(deltas), 1)
+    self.assertEqual(deltas[0][2], 50)
+
+    # The first read merges the counter.
+    self.assertEqual(len(collection), 50)
+    self.assertEqual(
+        data_store.DB.CollectionReadCount(collection.collection_id), (50, []))
+
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(10):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    with test_lib.Instrument(sequential_collection.SequentialCollection,
+                             "Scan") as scan:
+      self.assertEqual(len(collection), 60)
+      self.assertEqual(scan.call_count, 0)
+
+    self.assertEqual(collection.MergeCount(), 60)
+    self.assertEqual(
+        data_store.DB.CollectionReadCount(collection.collection_id), (60, []))
+    self.assertEqual(len(collection), 60)
+
+  def testLengthMergesRecordCounter(self):
+    urn = "aff4:/sequential_collection/testLengthMergesRecordCounter"
+    collection = self._TestCollection(urn)
+    self.assertEqual(len(collection), 0)
+
+    with utils.Stubber(sequential_collection.IndexedSequentialCollection,
+                       "MAX_UNMERGED_COUNT_DELTAS", 5):
+      for i in range(12):
+        with data_store.DB.GetMutationPool() as pool:
+          collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+        self.assertEqual(len(collection), i + 1)
+        _, deltas = data_store.DB.CollectionReadCount(collection.collection_id)
+        self.assertLessEqual(len(deltas), 5)
+
+  def testLengthOfCollectionWithoutRecordCounter(self):
+    urn = rdfvalue.RDFURN(
+        "aff4:/sequential_collection/testLengthOfCollectionWithoutCounter")
+    collection = self._TestCollection(urn)
+    # Records written before record counters were introduced.
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(20):
+        pool.CollectionAddItem(urn, rdfvalue.RDFInteger(i),
+                               rdfvalue.RDFDatetime.Now()
+                               .AsMicrosecondsSinceEpoch())
+
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(5):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+
+    self.assertEqual(len(collection), 25)
+    self.assertEqual(
+        data_store.DB.CollectionReadCount(collection.collection_id), (25, []))
+
+  def testDeleteResetsRecordCounter(self):
+    urn = "aff4:/sequential_collection/testDeleteResetsRecordCounter"
+    collection = self._TestCollection(urn)
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(10):
+        collection.Add(rdfvalue.RDFInteger(i), mutation_pool=pool)
+    self.assertEqual(len(collection), 10)
+
+    with data_store.DB.GetMutationPool() as pool:
+      collection.Add(rdfvalue.RDFInteger(10), mutation_pool=pool)
+
+    collection.Delete()
+    self.assertEqual(
+        data_store.DB.CollectionReadCount(collection.collection_id),
+        (None, []))
+    self.assertEqual(len(collection), 0)
+
   def testListing(self):
     test_urn = "aff4:/sequential_collection/testIndexedListing"
     collection = self._TestCollection(test_urn)
@@ -285,6 +436,136 @@ class GeneralIndexedCollectionTest(aff4_test_lib.AFF4ObjectTest):
     self.assertEqual(collection[1], "the meaning of life")
 
 
+class TestBlockCollection(sequential_collection.GrrMessageCollection):
+  BLOCK_STORAGE = True
+
+
+class BlockStorageTest(aff4_test_lib.AFF4ObjectTest):
+
+  def _TestCollection(self, collection_id):
+    return TestBlockCollection(rdfvalue.RDFURN(collection_id))
+
+  def _Message(self, i):
+    return rdf_flows.GrrMessage(
+        source=rdf_client.ClientURN("C.1000000000000000"),
+        session_id="aff4:/C.1000000000000000/flows/F:123456",
+        payload=rdfvalue.RDFInteger(i))
+
+  def _AddMessages(self, collection, start, count):
+    records = []
+    with data_store.DB.GetMutationPool() as pool:
+      for i in range(start, start + count):
+        records.append(
+            collection.Add(self._Message(i), mutation_pool=pool))
+    return records
+
+  def _Blocks(self, collection):
+    return list(
+        data_store.DB.ScanAttribute(
+            collection.collection_id.Add("Results"),
+            data_store.DataStore.COLLECTION_BLOCK_ATTRIBUTE))
+
+  def testAddScan(self):
+    collection = self._TestCollection("aff4:/sequential_collection/testBlocks")
+    block_size = data_store.DataStore.COLLECTION_BLOCK_SIZE
+    records = self._AddMessages(collection, 0, 2 * block_size + 10)
+
+    self.assertEqual(len(self._Blocks(collection)), 3)
+    # Records of a block share its timestamp and have consecutive suffixes.
+    self.assertEqual(records[1], (records[0][0], records[0][1] + 1))
+
+    results = list(collection.Scan(include_suffix=True))
+    self.assertEqual([ts for ts, _ in results], sorted(records))
+    self.assertEqual([msg.payload for _, msg in results],
+                     range(2 * block_size + 10))
+    self.assertEqual(results[0][1].source,
+                     rdf_client.ClientURN("C.1000000000000000"))
+
+  def testScanAfterRecordInBlock(self):
+    collection = self._TestCollection("aff4:/sequential_collection/testBlocks")
+    records = self._AddMessages(collection, 0, 10)
+    # A legacy record stored after the block.
+    with data_store.DB.GetMutationPool() as pool:
+      collection.Add(
+          self._Message(10),
+          timestamp=records[0][0] + 1,
+          suffix=1,
+          mutation_pool=pool)
+
+    results = [
+        msg.payload for _, msg in collection.Scan(after_timestamp=records[4])
+    ]
+    self.assertEqual(results, range(5, 11))
+
+    results = [
+        msg.payload for _, msg in collection.Scan(
+            after_timestamp=records[9], max_records=1)
+    ]
+    self.assertEqual(results, [10])
+
+    results = [
+        msg.payload for _, msg in collection.Scan(
+            after_timestamp=records[2], max_records=3)
+    ]
+    self.assertEqual(results, [3, 4, 5])
+
+  def testIndexedAccess(self):
+    collection = self._TestCollection("aff4:/sequential_collection/testBlocks")
+    self._AddMessages(collection, 0, 300)
+    self._AddMessages(collection, 300, 100)
+
+    self.assertEqual(len(collection), 400)
+    for i in [0, 255, 256, 299, 300, 399]:
+      self.assertEqual(collection[i].payload, i)
+
+  def testMultiResolve(self):
+    collection = self._TestCollection("aff4:/sequential_collection/testBlocks")
+    records = [
+        data_store.Record(
+            queue_id=collection.collection_id,
+            timestamp=ts,
+            suffix=suffix,
+            subpath="Results",
+            value=None) for ts, suffix in self._AddMessages(collection, 0, 300)
+    ]
+
+    results = sorted(
+        msg.payload for msg in collection.MultiResolve(records[::3]))
+    self.assertEqual(results, range(0, 300, 3))
+
+  def testCommonFieldsAreStoredOnce(self):
+    messages = [self._Message(i).SerializeToString() for i in range(100)]
+    block = data_store.DataStore.CollectionPackBlock(
+        messages, common_fields=True)
+    unpacked = list(data_store.DataStore.CollectionUnpackBlock(0x1ff, block))
+
+    self.assertEqual([suffix for suffix, _ in unpacked], range(0x100, 0x164))
+    for i, (_, serialized) in enumerate(unpacked):
+      self.assertEqual(
+          rdf_flows.GrrMessage.FromSerializedString(serialized),
+          rdf_flows.GrrMessage.FromSerializedString(messages[i]))
+
+    self.assertLess(len(block), len("".join(messages)) / 4)
+
+  def testNonProtobufValuesAreNotSplit(self):
+    values = ["\x08\x01abc", "\x08\x01abd"]
+    block = data_store.DataStore.CollectionPackBlock(values)
+    self.assertEqual([
+        value
+        for _, value in data_store.DataStore.CollectionUnpackBlock(0xff, block)
+    ], values)
+
+  def testDelete(self):
+    collection = self._TestCollection("aff4:/sequential_collection/testBlocks")
+    self._AddMessages(collection, 0, 10)
+
+    collection.Delete()
+
+    self.assertEqual(self._Blocks(collection), [])
+    self.assertEqual(list(collection.Scan()), [])
+    self.assertEqual(len(collection), 0)
+
+
 def main(argv):
   # Run the full test suite
   test_lib.main(argv)
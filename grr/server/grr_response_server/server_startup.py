@@ -35,8 +35,13 @@ def DropPrivileges():
 INIT_RAN = False
 
 
-def Init():
-  """Run all required startup routines and initialization hooks."""
+def Init(parse_config=True):
+  """Run all required startup routines and initialization hooks.
+
+  Args:
+    parse_config: If False, the config is expected to be parsed already, e.g.
+      because the caller needed it to decide how to start up.
+  """
   global INIT_RAN
   if INIT_RAN:
     return
@@ -51,12 +56,13 @@ def Init():
     handler = logging.handlers.SysLogHandler()
   syslog_logger.addHandler(handler)
 
-  try:
-    config_lib.SetPlatformArchContext()
-    config_lib.ParseConfigCommandLine()
-  except config_lib.Error:
-    syslog_logger.exception("Died during config initialization")
-    raise
+  if parse_config:
+    try:
+      config_lib.SetPlatformArchContext()
+      config_lib.ParseConfigCommandLine()
+    except config_lib.Error:
+      syslog_logger.exception("Died during config initialization")
+      raise
 
   if hasattr(registry_init, "stats"):
     logging.debug("Using local stats collector.")
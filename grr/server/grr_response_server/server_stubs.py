@@ -214,6 +214,20 @@ class HashBuffer(ClientActionStub):
   out_rdfvalues = [rdf_client.BufferReference]
 
 
+class HashBufferManifest(ClientActionStub):
+  """Hash a buffer from a file in fixed size chunks and return all digests."""
+
+  in_rdfvalue = rdf_client.BlobManifestRequest
+  out_rdfvalues = [rdf_client.BlobManifest]
+
+
+class HashBufferChunks(ClientActionStub):
+  """Hash a buffer from a file in content defined chunks."""
+
+  in_rdfvalue = rdf_client.HashBufferChunksRequest
+  out_rdfvalues = [rdf_client.BufferReference]
+
+
 class HashFile(ClientActionStub):
   """Hash an entire file using multiple algorithms."""
 
@@ -22,6 +22,7 @@ Example usage:
 
 """
 
+import collections
 import itertools
 import logging
 import os
@@ -37,6 +38,9 @@ from grr.lib import utils
 
 STOP_MESSAGE = "Stop message"
 
+# The priority class of tasks which are queued without one.
+DEFAULT_PRIORITY_CLASS = "default"
+
 
 class Error(Exception):
   pass
@@ -62,7 +66,7 @@ class _WorkerThread(threading.Thread):
       queue: A Queue.Queue object that is used by the ThreadPool class to
           communicate with the workers. When a new task arrives, the ThreadPool
           notifies the workers by putting a message into this queue that has the
-          format (target, args, name, queueing_time).
+          format (target, args, name, queueing_time, priority_class, owner).
 
           target - A callable, the function to call.
           args - A tuple of positional arguments to target. Keyword arguments
@@ -71,6 +75,9 @@ class _WorkerThread(threading.Thread):
                  the threading library.
           queueing_time - The timestamp when this task was queued as returned by
                           time.time().
+          priority_class - The priority class this task was scheduled in or
+                           None.
+          owner - The owner this task was scheduled for or None.
 
           Or, alternatively, the message in the queue can be STOP_MESSAGE
           which indicates that the worker should terminate.
@@ -87,12 +94,19 @@ class _WorkerThread(threading.Thread):
     self.idle = True
     self.started = time.time()
 
-  def ProcessTask(self, target, args, name, queueing_time):
+  def ProcessTask(self, target, args, name, queueing_time, priority_class,
+                  owner):
     """Processes the tasks."""
+    _ = owner
 
     if self.pool.name:
       time_in_queue = time.time() - queueing_time
       stats.STATS.RecordEvent(self.pool.name + "_queueing_time", time_in_queue)
+      if priority_class is not None:
+        stats.STATS.RecordEvent(
+            self.pool.name + "_class_queueing_time",
+            time_in_queue,
+            fields=[priority_class])
 
       start_time = time.time()
     try:
@@ -166,6 +180,145 @@ class _WorkerThread(threading.Thread):
         return
 
 
+class _FairTaskQueue(object):
+  """A task queue which implements weighted fair queuing.
+
+  Tasks are grouped into priority classes, each of which has a weight. Every
+  dequeued task advances the virtual time of its class by the inverse of the
+  class weight and workers are handed the next task of the class which would
+  finish earliest in virtual time. While they have pending tasks, classes
+  therefore get a share of the workers proportional to their weight but no
+  class is ever starved. Within a class, tasks are handed out round robin
+  across their owners so a single owner can not monopolize its class.
+
+  The queue is bounded per class: once a class has maxsize pending tasks it is
+  full but tasks of other classes can still be queued. Stop messages are only
+  handed out when no tasks are pending.
+
+  This implements the subset of the Queue.Queue interface used by the
+  ThreadPool.
+  """
+
+  def __init__(self, maxsize, class_weights):
+    self.maxsize = maxsize
+    self.class_weights = dict(class_weights)
+    self.class_weights.setdefault(DEFAULT_PRIORITY_CLASS, 1)
+
+    # Pending tasks keyed by class. Each class maps owners to a deque of their
+    # tasks, in round robin order.
+    self._pending = dict(
+        (priority_class, collections.OrderedDict())
+        for priority_class in self.class_weights)
+    self._class_sizes = dict.fromkeys(self.class_weights, 0)
+    self._virtual_times = dict.fromkeys(self.class_weights, 0.0)
+    # The virtual finish time of the last dequeued task.
+    self._virtual_time = 0.0
+    self._size = 0
+    self._stop_messages = 0
+    self._unfinished_tasks = 0
+
+    self.mutex = threading.Lock()
+    self.not_empty = threading.Condition(self.mutex)
+    self.not_full = threading.Condition(self.mutex)
+    self.all_tasks_done = threading.Condition(self.mutex)
+
+  def qsize(self):
+    with self.mutex:
+      return self._size + self._stop_messages
+
+  def _Wait(self, condition, deadline):
+    """Waits on the condition, returns False once the deadline has passed."""
+    if deadline is None:
+      condition.wait()
+      return True
+
+    remaining = deadline - time.time()
+    if remaining <= 0:
+      return False
+
+    condition.wait(remaining)
+    return True
+
+  def _FinishTimeKey(self, priority_class):
+    weight = self.class_weights[priority_class]
+    return (self._virtual_times[priority_class] + 1.0 / weight, -weight,
+            priority_class)
+
+  def put(self, item, block=True, timeout=None):  # pylint: disable=invalid-name
+    """Queues a task or a STOP_MESSAGE."""
+    deadline = None
+    if block and timeout is not None:
+      deadline = time.time() + timeout
+
+    with self.not_full:
+      if item == STOP_MESSAGE:
+        self._stop_messages += 1
+      else:
+        priority_class, owner = item[4], item[5]
+        while self._class_sizes[priority_class] >= self.maxsize:
+          if not block or not self._Wait(self.not_full, deadline):
+            raise Queue.Full
+
+        if not self._class_sizes[priority_class]:
+          # Classes which were idle do not accumulate credit.
+          self._virtual_times[priority_class] = max(
+              self._virtual_times[priority_class], self._virtual_time)
+
+        owners = self._pending[priority_class]
+        owners.setdefault(owner, collections.deque()).append(item)
+        self._class_sizes[priority_class] += 1
+        self._size += 1
+
+      self._unfinished_tasks += 1
+      self.not_empty.notify()
+
+  def get(self, timeout=None):  # pylint: disable=invalid-name
+    """Returns the next task to process."""
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+
+    with self.not_empty:
+      while not self._size and not self._stop_messages:
+        if not self._Wait(self.not_empty, deadline):
+          raise Queue.Empty
+
+      if not self._size:
+        self._stop_messages -= 1
+        return STOP_MESSAGE
+
+      # Serve the class whose next task has the earliest virtual finish time.
+      # Ties go to the class with the larger weight.
+      priority_class = min(
+          (c for c, size in self._class_sizes.iteritems() if size),
+          key=self._FinishTimeKey)
+      self._virtual_time = self._FinishTimeKey(priority_class)[0]
+      self._virtual_times[priority_class] = self._virtual_time
+
+      owners = self._pending[priority_class]
+      owner, tasks = owners.popitem(last=False)
+      item = tasks.popleft()
+      if tasks:
+        owners[owner] = tasks
+
+      self._class_sizes[priority_class] -= 1
+      self._size -= 1
+      self.not_full.notify_all()
+
+      return item
+
+  def task_done(self):  # pylint: disable=invalid-name
+    with self.all_tasks_done:
+      self._unfinished_tasks -= 1
+      if self._unfinished_tasks <= 0:
+        self.all_tasks_done.notify_all()
+
+  def join(self):  # pylint: disable=invalid-name
+    with self.all_tasks_done:
+      while self._unfinished_tasks:
+        self.all_tasks_done.wait()
+
+
 THREADPOOL = None
 
 
@@ -183,6 +336,11 @@ class ThreadPool(object):
   When threads are idle longer than 60 seconds they automatically exit. This
   ensures that our memory footprint is reduced when load is light.
 
+  By default tasks are processed in FIFO order. If class_weights are given, the
+  pool schedules tasks by priority class and owner using weighted fair queuing
+  instead (see _FairTaskQueue) so one busy class or owner can not starve the
+  others.
+
   Note that this class should not be instantiated directly, but the Factory
   should be used.
   """
@@ -191,12 +349,18 @@ class ThreadPool(object):
   factory_lock = threading.Lock()
 
   @classmethod
-  def Factory(cls, name, min_threads, max_threads=None, cpu_check=True):
+  def Factory(cls,
+              name,
+              min_threads,
+              max_threads=None,
+              cpu_check=True,
+              class_weights=None):
     """Creates a new thread pool with the given name.
 
     If the thread pool of this name already exist, we just return the existing
     one. This allows us to have different pools with different characteristics
-    used by different parts of the code, at the same time.
+    used by different parts of the code, at the same time. The existing pool
+    must schedule tasks the same way, i.e. use the same class_weights.
 
     Args:
       name: The name of the required pool.
@@ -204,19 +368,39 @@ class ThreadPool(object):
       max_threads: The maximum number of threads to grow the pool to. If not set
         we do not grow the pool.
       cpu_check: If false, don't check CPU load when adding new threads.
+      class_weights: If set, a dict mapping priority classes to their weights.
+        Tasks are then scheduled using weighted fair queuing.
 
     Returns:
       A threadpool instance.
+
+    Raises:
+      DuplicateThreadpoolError: If a thread pool with the desired name already
+                                exists but uses different class_weights.
     """
     with cls.factory_lock:
       result = cls.POOLS.get(name)
       if result is None:
         cls.POOLS[name] = result = cls(
-            name, min_threads, max_threads=max_threads, cpu_check=cpu_check)
+            name,
+            min_threads,
+            max_threads=max_threads,
+            cpu_check=cpu_check,
+            class_weights=class_weights)
+      elif (result.class_weights or None) != (class_weights or None):
+        raise DuplicateThreadpoolError(
+            "Thread pool %s already exists with class weights %s, can not use "
+            "it with class weights %s." % (name, result.class_weights,
+                                           class_weights))
 
       return result
 
-  def __init__(self, name, min_threads, max_threads=None, cpu_check=True):
+  def __init__(self,
+               name,
+               min_threads,
+               max_threads=None,
+               cpu_check=True,
+               class_weights=None):
     """This creates a new thread pool using min_threads workers.
 
     Args:
@@ -225,6 +409,8 @@ class ThreadPool(object):
       max_threads: The maximum number of threads to grow the pool to. If not set
         we do not grow the pool.
       cpu_check: If false, don't check CPU load when adding new threads.
+      class_weights: If set, a dict mapping priority classes to their weights.
+        Tasks are then scheduled using weighted fair queuing.
 
 
     Raises:
@@ -239,7 +425,11 @@ class ThreadPool(object):
 
     self.max_threads = max_threads
     self.cpu_check = cpu_check
-    self._queue = Queue.Queue(maxsize=max_threads)
+    self.class_weights = class_weights
+    if class_weights:
+      self._queue = _FairTaskQueue(max_threads, class_weights)
+    else:
+      self._queue = Queue.Queue(maxsize=max_threads)
     self.name = name
     self.started = False
     self.process = psutil.Process(os.getpid())
@@ -269,6 +459,9 @@ class ThreadPool(object):
       stats.STATS.RegisterCounterMetric(self.name + "_task_exceptions")
       stats.STATS.RegisterEventMetric(self.name + "_working_time")
       stats.STATS.RegisterEventMetric(self.name + "_queueing_time")
+      stats.STATS.RegisterEventMetric(
+          self.name + "_class_queueing_time",
+          fields=[("priority_class", str)])
 
   def __del__(self):
     if self.started:
@@ -335,7 +528,9 @@ class ThreadPool(object):
               args,
               name="Unnamed task",
               blocking=True,
-              inline=True):
+              inline=True,
+              priority_class=None,
+              owner=None):
     """Adds a task to be processed later.
 
     Args:
@@ -354,14 +549,27 @@ class ThreadPool(object):
         can generally block the calling thread even after the threadpool is
         available again and therefore decrease efficiency.
 
+      priority_class: The priority class of this task. Only used for scheduling
+        if the pool has class_weights, but queueing times are exported per
+        class in any case.
+
+      owner: The owner of this task, e.g. a client or a hunt. Tasks of the same
+        priority class are scheduled round robin across owners.
+
     Raises:
       Full() if the pool is full and can not accept new jobs.
+      ValueError: if the priority class is unknown to this pool.
     """
     # This pool should have no worker threads - just run the task inline.
     if self.max_threads == 0:
       target(*args)
       return
 
+    if self.class_weights:
+      priority_class = priority_class or DEFAULT_PRIORITY_CLASS
+      if priority_class not in self._queue.class_weights:
+        raise ValueError("Unknown priority class: %s" % priority_class)
+
     if inline:
       blocking = False
 
@@ -369,7 +577,9 @@ class ThreadPool(object):
       while True:
         try:
           # Push the task on the queue but raise if unsuccessful.
-          self._queue.put((target, args, name, time.time()), block=False)
+          self._queue.put(
+              (target, args, name, time.time(), priority_class, owner),
+              block=False)
           return
         except Queue.Full:
           # We increase the number of active threads if we do not exceed the
@@ -395,7 +605,9 @@ class ThreadPool(object):
           elif blocking:
             try:
               self._queue.put(
-                  (target, args, name, time.time()), block=True, timeout=1)
+                  (target, args, name, time.time(), priority_class, owner),
+                  block=True,
+                  timeout=1)
               return
             except Queue.Full:
               continue
@@ -428,8 +640,13 @@ class MockThreadPool(object):
     _ = max_threads
     self.ignore_errors = ignore_errors
 
-  def AddTask(self, target, args, name="Unnamed task"):
-    _ = name
+  def AddTask(self,
+              target,
+              args,
+              name="Unnamed task",
+              priority_class=None,
+              owner=None):
+    _ = name, priority_class, owner
     try:
       target(*args)
       # The real threadpool can not raise from a task. We emulate this here.
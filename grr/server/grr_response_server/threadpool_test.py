@@ -295,6 +295,23 @@ class ThreadPoolTest(test_lib.GRRBaseTest):
     pool2 = threadpool.ThreadPool.Factory(prefix, 10)
     self.assertEqual(pool2.started, True)
 
+  def testDuplicateNameWithDifferentClassWeights(self):
+    """Tests that the factory does not ignore the requested class weights."""
+
+    prefix = "duplicate_name_class_weights"
+
+    pool = threadpool.ThreadPool.Factory(prefix, 10)
+    self.assertRaises(
+        threadpool.DuplicateThreadpoolError,
+        threadpool.ThreadPool.Factory,
+        prefix,
+        10,
+        class_weights={"flow": 1})
+
+    # Pools scheduling tasks the same way are shared.
+    pool2 = threadpool.ThreadPool.Factory(prefix, 10, class_weights={})
+    self.assertIs(pool2, pool)
+
   def testAnonymousThreadpool(self):
     """Tests that we can starts anonymous threadpools."""
     prefix = None
@@ -305,6 +322,150 @@ class ThreadPoolTest(test_lib.GRRBaseTest):
     pool.Stop()
 
 
+class FairTaskQueueTest(test_lib.GRRBaseTest):
+  """Tests for the weighted fair task queue."""
+
+  def _Task(self, priority_class, owner, name):
+    return (None, (), name, time.time(), priority_class, owner)
+
+  def _Drain(self, queue, count=None):
+    result = []
+    while queue.qsize() and len(result) != count:
+      task = queue.get(timeout=0)
+      result.append(task if task == threadpool.STOP_MESSAGE else task[2])
+      queue.task_done()
+    return result
+
+  def testClassesAreServedByWeight(self):
+    queue = threadpool._FairTaskQueue(100, {"flow": 4, "hunt": 1})
+    for i in range(8):
+      queue.put(self._Task("hunt", "H:1", "hunt%d" % i))
+    for i in range(6):
+      queue.put(self._Task("flow", "C.1", "flow%d" % i))
+
+    order = self._Drain(queue)
+
+    # While both classes have pending tasks, flows get four times the share.
+    self.assertEqual(order[:8], [
+        "flow0", "flow1", "flow2", "flow3", "hunt0", "flow4", "flow5", "hunt1"
+    ])
+    self.assertEqual(order[8:], ["hunt%d" % i for i in range(2, 8)])
+
+  def testOwnersAreServedRoundRobin(self):
+    queue = threadpool._FairTaskQueue(100, {"hunt": 1})
+    for i in range(3):
+      queue.put(self._Task("hunt", "C.1", "a%d" % i))
+    queue.put(self._Task("hunt", "C.2", "b0"))
+    queue.put(self._Task("hunt", "C.3", "c0"))
+
+    self.assertEqual(self._Drain(queue), ["a0", "b0", "c0", "a1", "a2"])
+
+  def testIdleClassesDoNotAccumulateCredit(self):
+    queue = threadpool._FairTaskQueue(100, {"flow": 1, "hunt": 1})
+    for i in range(4):
+      queue.put(self._Task("hunt", "H:1", "hunt%d" % i))
+    self.assertEqual(self._Drain(queue, count=2), ["hunt0", "hunt1"])
+
+    # A class becoming active shares the workers fairly from now on instead of
+    # being served exclusively until it catches up.
+    queue.put(self._Task("flow", "C.1", "flow0"))
+    queue.put(self._Task("flow", "C.1", "flow1"))
+    self.assertEqual(self._Drain(queue), ["flow0", "hunt2", "flow1", "hunt3"])
+
+  def testClassesAreBoundedSeparately(self):
+    queue = threadpool._FairTaskQueue(2, {"flow": 1, "hunt": 1})
+    queue.put(self._Task("hunt", "H:1", "hunt0"))
+    queue.put(self._Task("hunt", "H:1", "hunt1"))
+    self.assertRaises(
+        Queue.Full, queue.put, self._Task("hunt", "H:1", "hunt2"), block=False)
+
+    queue.put(self._Task("flow", "C.1", "flow0"), block=False)
+    self.assertEqual(queue.qsize(), 3)
+
+  def testStopMessagesAreServedLast(self):
+    queue = threadpool._FairTaskQueue(10, {"flow": 1})
+    queue.put(self._Task("flow", "C.1", "flow0"))
+    queue.put(threadpool.STOP_MESSAGE)
+    queue.put(self._Task("flow", "C.1", "flow1"))
+
+    self.assertEqual(
+        self._Drain(queue), ["flow0", "flow1", threadpool.STOP_MESSAGE])
+    self.assertRaises(Queue.Empty, queue.get, timeout=0)
+
+
+class FairThreadPoolTest(test_lib.GRRBaseTest):
+  """Tests for thread pools which schedule tasks by priority class."""
+
+  def setUp(self):
+    super(FairThreadPoolTest, self).setUp()
+    self.test_pool = threadpool.ThreadPool.Factory(
+        "pool-%s" % self._testMethodName,
+        1,
+        max_threads=1,
+        class_weights={"flow": 4,
+                       "hunt": 1})
+    self.test_pool.Start()
+
+  def tearDown(self):
+    self.test_pool.Stop()
+    super(FairThreadPoolTest, self).tearDown()
+
+  def testFlowsAreNotStarvedByHunts(self):
+    done_event = threading.Event()
+    started_event = threading.Event()
+    res = []
+
+    def Block():
+      started_event.set()
+      done_event.wait()
+
+    # Occupy the only worker thread.
+    self.test_pool.AddTask(Block, (), priority_class="hunt", owner="H:1")
+    started_event.wait()
+
+    # The hunt class is full now, the flow still gets queued.
+    self.test_pool.AddTask(
+        res.append, ("hunt",), inline=False, blocking=False,
+        priority_class="hunt", owner="H:1")
+    self.assertRaises(
+        threadpool.Full,
+        self.test_pool.AddTask,
+        res.append, ("hunt",),
+        inline=False,
+        blocking=False,
+        priority_class="hunt",
+        owner="H:1")
+    self.test_pool.AddTask(
+        res.append, ("flow",), inline=False, blocking=False,
+        priority_class="flow", owner="C.1")
+
+    done_event.set()
+    self.test_pool.Join()
+
+    self.assertEqual(res, ["flow", "hunt"])
+
+  def testQueueingTimeIsExportedPerClass(self):
+    metric = self.test_pool.name + "_class_queueing_time"
+    self.test_pool.AddTask(lambda: None, (), priority_class="flow")
+    self.test_pool.AddTask(lambda: None, ())
+    self.test_pool.Join()
+
+    self.assertEqual(
+        stats.STATS.GetMetricValue(metric, fields=["flow"]).count, 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue(
+            metric, fields=[threadpool.DEFAULT_PRIORITY_CLASS]).count, 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue(metric, fields=["hunt"]).count, 0)
+
+  def testUnknownClassRaises(self):
+    self.assertRaises(
+        ValueError,
+        self.test_pool.AddTask,
+        lambda: None, (),
+        priority_class="unknown")
+
+
 class DummyConverter(threadpool.BatchConverter):
 
   def __init__(self, **kwargs):
@@ -2,7 +2,9 @@
 """Module with GRRWorker implementation."""
 
 import logging
+import os
 import pdb
+import socket
 import time
 import traceback
 
@@ -88,16 +90,60 @@ class GRRWorker(object):
         threadpool_size = config.CONFIG["Threadpool.size"]
 
       self.__class__.thread_pool = threadpool.ThreadPool.Factory(
-          threadpool_prefix, min_threads=2, max_threads=threadpool_size)
+          threadpool_prefix,
+          min_threads=2,
+          max_threads=threadpool_size,
+          class_weights=self._GetPriorityClassWeights())
 
       self.__class__.thread_pool.Start()
 
     self.token = token
     self.last_active = 0
 
+    # Identifies this worker in the notification shard leases.
+    self.worker_id = "%s:%d:%x" % (socket.gethostname(), os.getpid(),
+                                   utils.PRNG.GetUInt32())
+    # Notification shard leasers keyed by queue.
+    self.shard_leasers = {}
+
     # Well known flows are just instantiated.
     self.well_known_flows = flow.WellKnownFlow.GetAllWellKnownFlows(token=token)
 
+  def _GetPriorityClassWeights(self):
+    """Parses the configured priority class weights."""
+    weights = {}
+    for entry in config.CONFIG["Worker.priority_class_weights"]:
+      priority_class, weight = entry.split(":")
+      weights[priority_class.strip()] = int(weight)
+
+    return weights
+
+  def _GetPriorityClass(self, notification):
+    """Returns the priority class and owner to schedule a notification in.
+
+    Args:
+      notification: The GrrNotification to process.
+
+    Returns:
+      A tuple (priority_class, owner). Owners are clients, hunts or, for flows
+      which belong to neither, the flow itself.
+    """
+    session_id = notification.session_id
+    owner = session_id.Split()[0]
+    if owner in ("flows", "hunts"):
+      owner = str(session_id)
+
+    if notification.priority == rdf_flows.GrrMessage.Priority.LOW_PRIORITY:
+      return "low_priority", owner
+
+    if session_id.Queue() == queues_config.HUNTS:
+      return "hunt", owner
+
+    if notification.priority == rdf_flows.GrrMessage.Priority.HIGH_PRIORITY:
+      return "high_priority", owner
+
+    return "flow", owner
+
   def Run(self):
     """Event loop."""
     try:
@@ -124,6 +170,9 @@ class GRRWorker(object):
     except KeyboardInterrupt:
       logging.info("Caught interrupt, exiting.")
       self.__class__.thread_pool.Join()
+      # Let other workers pick up our shards right away.
+      for leaser in self.shard_leasers.values():
+        leaser.ReleaseAll()
 
   def _ProcessMessageHandlerRequests(self):
     """Processes message handler requests."""
@@ -173,8 +222,9 @@ class GRRWorker(object):
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
-      notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+      notifications_by_priority = (
+          queue_manager.GetNotificationsByPriorityForShards(
+              queue, self.GetLeasedShards(queue)))
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -220,6 +270,15 @@ class GRRWorker(object):
         return processed
     return processed
 
+  def GetLeasedShards(self, queue):
+    """Returns the notification shards of the queue leased by this worker."""
+    leaser = self.shard_leasers.get(queue)
+    if leaser is None:
+      leaser = queue_manager_lib.NotificationShardLeaser(queue, self.worker_id)
+      self.shard_leasers[queue] = leaser
+
+    return leaser.GetShards()
+
   def ProcessStuckFlows(self, stuck_flows, queue_manager):
     stats.STATS.IncrementCounter("grr_flows_stuck", len(stuck_flows))
 
@@ -266,10 +325,13 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
+        priority_class, owner = self._GetPriorityClass(notification)
         self.__class__.thread_pool.AddTask(
             target=self._ProcessMessages,
             args=(notification, queue_manager.Copy()),
-            name=self.__class__.__name__)
+            name=self.__class__.__name__,
+            priority_class=priority_class,
+            owner=owner)
 
     return processed
 
@@ -100,16 +100,16 @@ class MemoryClientMock(ActionMock):
 
   def __init__(self, *args, **kwargs):
     super(MemoryClientMock, self).__init__(
-        standard.HashBuffer, standard.HashFile, standard.GetFileStat,
-        standard.TransferBuffer, *args, **kwargs)
+        standard.HashBuffer, standard.HashBufferManifest, standard.HashFile,
+        standard.GetFileStat, standard.TransferBuffer, *args, **kwargs)
 
 
 class GetFileClientMock(ActionMock):
 
   def __init__(self, *args, **kwargs):
-    super(GetFileClientMock,
-          self).__init__(standard.HashBuffer, standard.GetFileStat,
-                         standard.TransferBuffer, *args, **kwargs)
+    super(GetFileClientMock, self).__init__(
+        standard.HashBuffer, standard.HashBufferManifest, standard.GetFileStat,
+        standard.TransferBuffer, *args, **kwargs)
 
 
 class FileFinderClientMock(ActionMock):
@@ -117,8 +117,8 @@ class FileFinderClientMock(ActionMock):
   def __init__(self, *args, **kwargs):
     super(FileFinderClientMock, self).__init__(
         file_fingerprint.FingerprintFile, searching.Find, searching.Grep,
-        standard.HashBuffer, standard.HashFile, standard.GetFileStat,
-        standard.TransferBuffer, *args, **kwargs)
+        standard.HashBuffer, standard.HashBufferManifest, standard.HashFile,
+        standard.GetFileStat, standard.TransferBuffer, *args, **kwargs)
 
 
 class ListProcessesMock(FileFinderClientMock):
@@ -144,8 +144,9 @@ class MultiGetFileClientMock(ActionMock):
   def __init__(self, *args, **kwargs):
     super(MultiGetFileClientMock, self).__init__(
         standard.HashFile, standard.GetFileStat, standard.HashBuffer,
-        standard.TransferBuffer, file_fingerprint.FingerprintFile, *args,
-        **kwargs)
+        standard.HashBufferChunks, standard.HashBufferManifest,
+        standard.TransferBuffer,
+        file_fingerprint.FingerprintFile, *args, **kwargs)
 
 
 class ListDirectoryClientMock(ActionMock):
@@ -167,8 +168,8 @@ class GrepClientMock(ActionMock):
   def __init__(self, *args, **kwargs):
     super(GrepClientMock, self).__init__(
         file_fingerprint.FingerprintFile, searching.Find, searching.Grep,
-        standard.HashBuffer, standard.GetFileStat, standard.TransferBuffer,
-        *args, **kwargs)
+        standard.HashBuffer, standard.HashBufferManifest, standard.GetFileStat,
+        standard.TransferBuffer, *args, **kwargs)
 
 
 class InterrogatedClient(ActionMock):
@@ -178,8 +179,8 @@ class InterrogatedClient(ActionMock):
     super(InterrogatedClient, self).__init__(
         admin.GetLibraryVersions, file_fingerprint.FingerprintFile,
         searching.Find, standard.GetMemorySize, standard.HashBuffer,
-        standard.HashFile, standard.ListDirectory, standard.GetFileStat,
-        standard.TransferBuffer, *args, **kwargs)
+        standard.HashBufferManifest, standard.HashFile, standard.ListDirectory,
+        standard.GetFileStat, standard.TransferBuffer, *args, **kwargs)
 
   def InitializeClient(self,
                        system="Linux",
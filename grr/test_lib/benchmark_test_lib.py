@@ -38,7 +38,9 @@ class MicroBenchmarks(test_lib.GRRBaseTest):
   def tearDown(self):
     super(MicroBenchmarks, self).tearDown()
     f = 1
-    if self.units == "us":
+    if self.units == "ns":
+      f = 1e9
+    elif self.units == "us":
       f = 1e6
     elif self.units == "ms":
       f = 1e3
@@ -41,6 +41,7 @@ from grr.server.grr_response_server import artifact
 from grr.server.grr_response_server import client_index
 from grr.server.grr_response_server import data_store
 from grr.server.grr_response_server import email_alerts
+from grr.server.grr_response_server import export
 from grr.server.grr_response_server.aff4_objects import aff4_grr
 from grr.server.grr_response_server.aff4_objects import filestore
 from grr.server.grr_response_server.aff4_objects import users
@@ -104,6 +105,7 @@ class GRRBaseTest(unittest.TestCase):
     data_store.REL_DB.delegate.ClearTestDB()
 
     aff4.FACTORY.Flush()
+    export.CLIENT_METADATA_CACHE.Flush()
 
     # Create a Foreman and Filestores, they are used in many tests.
     aff4_grr.GRRAFF4Init().Run()
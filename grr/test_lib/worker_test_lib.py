@@ -20,8 +20,13 @@ class MockThreadPool(object):
   def __init__(self, *_):
     pass
 
-  def AddTask(self, target, args, name="Unnamed task"):
-    _ = name
+  def AddTask(self,
+              target,
+              args,
+              name="Unnamed task",
+              priority_class=None,
+              owner=None):
+    _ = name, priority_class, owner
     try:
       target(*args)
       # The real threadpool can not raise from a task. We emulate this here.
@@ -5,11 +5,15 @@
 import BaseHTTPServer
 import cgi
 import cStringIO
+import errno
 import logging
+import os
 import pdb
+import signal
 import socket
 import SocketServer
 import threading
+import time
 
 
 import ipaddr
@@ -22,6 +26,7 @@ from grr.lib import server_plugins
 
 from grr import config
 from grr.lib import communicator
+from grr.lib import config_lib
 from grr.lib import flags
 from grr.lib import rdfvalue
 from grr.lib import stats
@@ -32,6 +37,7 @@ from grr.server.grr_response_server import front_end
 from grr.server.grr_response_server import master
 from grr.server.grr_response_server import server_logging
 from grr.server.grr_response_server import server_startup
+from grr.server.grr_response_server import threadpool
 
 
 class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
@@ -209,6 +215,25 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       if not header:
         break
 
+  def _GenerateMessageBundles(self, api_version, orig_request):
+    """Yields the bundles of a streaming upload as they arrive."""
+    if self.headers.getheader("transfer-encoding", "").lower() == "chunked":
+      chunks = self.GenerateFileData()
+    else:
+      content_length = self.headers.getheader("content-length")
+      if not content_length:
+        raise IOError("No content-length header provided.")
+      chunks = self._GenerateChunk(int(content_length))
+
+    max_bundle_size = config.CONFIG["Frontend.max_upload_bundle_size"]
+    for data in communicator.UnpackMessageBundles(
+        chunks, max_bundle_size=max_bundle_size):
+      bundle = rdf_flows.ClientCommunication.FromSerializedString(data)
+      if not bundle.api_version:
+        bundle.api_version = api_version
+      bundle.orig_request = orig_request
+      yield bundle
+
   def do_POST(self):  # pylint: disable=g-bad-name
     """Process encrypted message bundles."""
 
@@ -243,52 +268,67 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
       logging.info("Request sent to inactive frontend from %s",
                    self.client_address[0])
 
+    try:
+      params = cgi.parse_qs(self.path.split("?")[1])
+    except IndexError:
+      params = {}
+
     # Get the api version
     try:
-      api_version = int(cgi.parse_qs(self.path.split("?")[1])["api"][0])
-    except (ValueError, KeyError, IndexError):
+      api_version = int(params["api"][0])
+    except (ValueError, KeyError):
       # The oldest api version we support if not specified.
       api_version = 3
 
+    # Streaming uploads send their messages in separately encrypted bundles.
+    streaming = params.get("stream") == ["1"]
+
     with GRRHTTPServerHandler.active_counter_lock:
       GRRHTTPServerHandler.active_counter += 1
       stats.STATS.SetGaugeValue(
           "frontend_active_count", self.active_counter, fields=["http"])
 
     try:
-      content_length = self.headers.getheader("content-length")
-      if not content_length:
-        raise IOError("No content-length header provided.")
-
-      length = int(content_length)
-
-      request_comms = rdf_flows.ClientCommunication.FromSerializedString(
-          self._GetPOSTData(length))
-
-      # If the client did not supply the version in the protobuf we use the get
-      # parameter.
-      if not request_comms.api_version:
-        request_comms.api_version = api_version
-
-      # Reply using the same version we were requested with.
-      responses_comms = rdf_flows.ClientCommunication(
-          api_version=request_comms.api_version)
-
       source_ip = ipaddr.IPAddress(self.client_address[0])
 
       if source_ip.version == 6:
         source_ip = source_ip.ipv4_mapped or source_ip
 
-      request_comms.orig_request = rdf_flows.HttpRequest(
+      orig_request = rdf_flows.HttpRequest(
           timestamp=rdfvalue.RDFDatetime.Now().AsMicrosecondsSinceEpoch(),
           raw_headers=utils.SmartStr(self.headers),
           source_ip=utils.SmartStr(source_ip))
 
+      if streaming:
+        # The bundles are decoded while they are read from the connection.
+        request_comms = self._GenerateMessageBundles(api_version, orig_request)
+        responses_comms = rdf_flows.ClientCommunication(api_version=api_version)
+      else:
+        content_length = self.headers.getheader("content-length")
+        if not content_length:
+          raise IOError("No content-length header provided.")
+
+        length = int(content_length)
+
+        request_comms = rdf_flows.ClientCommunication.FromSerializedString(
+            self._GetPOSTData(length))
+
+        # If the client did not supply the version in the protobuf we use the
+        # get parameter.
+        if not request_comms.api_version:
+          request_comms.api_version = api_version
+
+        # Reply using the same version we were requested with.
+        responses_comms = rdf_flows.ClientCommunication(
+            api_version=request_comms.api_version)
+
+        request_comms.orig_request = orig_request
+
       source, nr_messages = self.server.frontend.HandleMessageBundles(
           request_comms, responses_comms)
 
       server_logging.LOGGER.LogHttpFrontendAccess(
-          request_comms.orig_request, source=source, message_count=nr_messages)
+          orig_request, source=source, message_count=nr_messages)
 
       self.Send(responses_comms.SerializeToString())
 
@@ -341,6 +381,88 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
                                        **kwargs)
 
 
+class GRRPreforkedHTTPServer(GRRHTTPServer):
+  """A GRR HTTP server serving from a socket shared by several processes.
+
+  Instead of spawning a thread per request, requests are handed to a bounded
+  thread pool. Once the pool is saturated, this process stops accepting new
+  connections so they are picked up by the other processes sharing the
+  listening socket.
+  """
+
+  def __init__(self,
+               listening_socket,
+               handler,
+               frontend=None,
+               max_threads=None,
+               threadpool_prefix="frontend_requests"):
+    if max_threads is None:
+      max_threads = config.CONFIG["Frontend.request_threads"]
+
+    self.request_pool = threadpool.ThreadPool.Factory(
+        threadpool_prefix, min_threads=2, max_threads=max_threads)
+    self.request_pool.Start()
+
+    self.listening_socket = listening_socket
+    host, port = listening_socket.getsockname()[:2]
+    GRRHTTPServer.__init__(
+        self, (host, port), handler, frontend=frontend,
+        bind_and_activate=False)
+    self.server_bind()
+
+  def server_bind(self):  # pylint: disable=g-bad-name
+    """Uses the shared listening socket instead of binding a new one."""
+    self.socket.close()
+    self.socket = self.listening_socket
+    self.server_address = self.socket.getsockname()
+    host, port = self.server_address[:2]
+    self.server_name = socket.getfqdn(host)
+    self.server_port = port
+
+  def process_request(self, request, client_address):  # pylint: disable=g-bad-name
+    self.request_pool.AddTask(
+        self.process_request_thread, (request, client_address),
+        name="HTTPRequest",
+        blocking=True,
+        inline=False)
+
+  def Drain(self):
+    """Waits for the requests in flight once serve_forever has returned."""
+    self.request_pool.Join()
+    self.request_pool.Stop()
+    self.server_close()
+
+
+def CreateListeningSocket():
+  """Creates the listening socket shared by preforked frontend processes."""
+  max_port = config.CONFIG.Get("Frontend.port_max",
+                               config.CONFIG["Frontend.bind_port"])
+
+  address = config.CONFIG["Frontend.bind_address"]
+  if ipaddr.IPAddress(address).version == 4:
+    address_family = socket.AF_INET
+  else:
+    address_family = socket.AF_INET6
+
+  for port in range(config.CONFIG["Frontend.bind_port"], max_port + 1):
+    sock = socket.socket(address_family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+      sock.bind((address, port))
+      break
+    except socket.error as e:
+      sock.close()
+      if e.errno == socket.errno.EADDRINUSE and port < max_port:
+        logging.info("Port %s in use, trying %s", port, port + 1)
+      else:
+        raise
+
+  sock.listen(GRRHTTPServer.request_queue_size)
+  sa = sock.getsockname()
+  logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
+  return sock
+
+
 def CreateServer(frontend=None):
   """Start frontend http server."""
   max_port = config.CONFIG.Get("Frontend.port_max",
@@ -364,12 +486,131 @@ def CreateServer(frontend=None):
   return httpd
 
 
+def MonitoringPortForProcess(process_index):
+  """Returns the first monitoring port of a preforked frontend process.
+
+  Every process runs its own monitoring server. The monitoring server tries
+  as many ports as the AdminUI may use, so each process gets its own range of
+  that size.
+
+  Args:
+    process_index: The index of the frontend process.
+
+  Returns:
+    The port, 0 if monitoring is disabled.
+  """
+  monitoring_port = config.CONFIG["Monitoring.http_port"]
+  if not monitoring_port:
+    return 0
+
+  ports_per_process = config.CONFIG.Get(
+      "AdminUI.port_max",
+      config.CONFIG["AdminUI.port"]) - config.CONFIG["AdminUI.port"] + 1
+  return monitoring_port + process_index * ports_per_process
+
+
+def _ServeFromSocket(listening_socket, process_index):
+  """Serves requests from the shared socket until asked to drain."""
+  config.CONFIG.Set("Monitoring.http_port",
+                    MonitoringPortForProcess(process_index))
+
+  # The config was parsed before forking.
+  server_startup.Init(parse_config=False)
+
+  httpd = GRRPreforkedHTTPServer(listening_socket, GRRHTTPServerHandler)
+
+  server_startup.DropPrivileges()
+
+  def Shutdown(unused_signum, unused_frame):
+    # shutdown() blocks until serve_forever() returns so it can not be called
+    # from the thread running it.
+    threading.Thread(target=httpd.shutdown).start()
+
+  signal.signal(signal.SIGTERM, Shutdown)
+  signal.signal(signal.SIGINT, Shutdown)
+
+  httpd.serve_forever()
+
+  logging.info("Draining frontend process %d.", os.getpid())
+  httpd.Drain()
+
+
+def ServePreforked(num_processes):
+  """Serves the frontend from several processes sharing a listening socket.
+
+  Frontend processes which die are restarted. On SIGTERM or SIGINT, all
+  processes stop accepting new connections, finish the requests they are
+  handling and exit.
+
+  Args:
+    num_processes: The number of frontend processes to run.
+  """
+  listening_socket = CreateListeningSocket()
+  # Maps the pids of the frontend processes to their process index.
+  children = {}
+  stopping = []
+
+  def Spawn(process_index):
+    pid = os.fork()
+    if pid == 0:
+      # Replacement children inherit the handlers of the parent. Until the
+      # child installs its own, a signal should just terminate it.
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+      exit_code = 0
+      try:
+        _ServeFromSocket(listening_socket, process_index)
+      except Exception:  # pylint: disable=broad-except
+        logging.exception("Frontend process %d died.", os.getpid())
+        exit_code = 1
+      finally:
+        os._exit(exit_code)  # pylint: disable=protected-access
+
+    children[pid] = process_index
+
+  def Stop(signum, unused_frame):
+    stopping.append(signum)
+    for pid in children:
+      os.kill(pid, signal.SIGTERM)
+
+  for process_index in range(num_processes):
+    Spawn(process_index)
+
+  signal.signal(signal.SIGTERM, Stop)
+  signal.signal(signal.SIGINT, Stop)
+
+  while children:
+    try:
+      pid, status = os.wait()
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        continue
+      raise
+
+    process_index = children.pop(pid, None)
+    if process_index is not None and not stopping:
+      logging.error("Frontend process %d exited with status %d, restarting.",
+                    pid, status)
+      # Avoid spinning if processes die right after starting.
+      time.sleep(1)
+      Spawn(process_index)
+
+
 def main(argv):
   """Main."""
   del argv  # Unused.
   config.CONFIG.AddContext("HTTPServer Context")
 
-  server_startup.Init()
+  # The config decides whether we fork but everything else has to be
+  # initialized in the serving processes.
+  config_lib.SetPlatformArchContext()
+  config_lib.ParseConfigCommandLine()
+  if config.CONFIG["Frontend.processes"] > 1:
+    ServePreforked(config.CONFIG["Frontend.processes"])
+    return
+
+  server_startup.Init(parse_config=False)
 
   httpd = CreateServer()
 
@@ -5,6 +5,7 @@ import hashlib
 import os
 import socket
 import threading
+import time
 
 
 import ipaddr
@@ -13,9 +14,13 @@ import requests
 
 from google.protobuf import json_format
 
+from grr import config
+from grr_response_client import comms
 from grr.lib import flags
+from grr.lib import rdfvalue
 from grr.lib import utils
 from grr.lib.rdfvalues import file_finder as rdf_file_finder
+from grr.lib.rdfvalues import flows as rdf_flows
 from grr.lib.rdfvalues import paths as rdf_paths
 from grr.lib.rdfvalues import rekall_types as rdf_rekall_types
 from grr.server.grr_response_server import aff4
@@ -279,6 +284,153 @@ class GRRHTTPServerTest(test_lib.GRRBaseTest):
     self.assertEqual(profile.version, "v1.0")
     self.assertEqual(profile.data[:2], "\x1f\x8b")
 
+  def testStreamingUpload(self):
+    client_cert = self.ClientCertFromPrivateKey(
+        config.CONFIG["Client.private_key"])
+    with aff4.FACTORY.Create(
+        client_cert.GetCN(), aff4_grr.VFSGRRClient,
+        token=self.token) as client:
+      client.Set(client.Schema.CERT, client_cert)
+
+    received = []
+    # Loading the server certificate updates the config.
+    with test_lib.PreserveConfig(), utils.Stubber(
+        self.httpd.frontend, "ReceiveMessages",
+        lambda _, messages: received.extend(messages)):
+      with test_lib.ConfigOverrider({
+          "Client.server_urls": [self.base_url],
+          "Client.upload_bundle_size": 1024
+      }):
+        client_communicator = comms.GRRHTTPClient(
+            ca_cert=config.CONFIG["CA.certificate"],
+            worker_cls=worker_mocks.DisabledNannyClientWorker)
+        # Disable stats collection.
+        client_communicator.client_worker.last_stats_sent_time = (
+            time.time() + 3600)
+
+        for i in range(10):
+          client_communicator.client_worker.SendReply(
+              rdf_flows.GrrStatus(error_message="x" * 1000),
+              session_id=rdfvalue.SessionID("W:session"),
+              request_id=1,
+              response_id=i)
+
+        status = client_communicator.RunOnce()
+
+    self.assertEqual(status.code, 200)
+    self.assertEqual([m.response_id for m in received], range(10))
+
+
+class GRRPreforkedHTTPServerTest(test_lib.GRRBaseTest):
+  """Test http servers sharing a listening socket."""
+
+  def setUp(self):
+    super(GRRPreforkedHTTPServerTest, self).setUp()
+
+    front_end.FrontendInit().RunOnce()
+
+    port = portpicker.PickUnusedPort()
+    ip = utils.ResolveHostnameToIP("localhost", port)
+    if ipaddr.IPAddress(ip).version == 6:
+      self.base_url = "http://[%s]:%d/" % (ip, port)
+    else:
+      self.base_url = "http://%s:%d/" % (ip, port)
+
+    with test_lib.ConfigOverrider({
+        "Frontend.bind_address": ip,
+        "Frontend.bind_port": port
+    }):
+      listening_socket = frontend.CreateListeningSocket()
+
+    # Two servers in threads stand in for two frontend processes.
+    self.servers = []
+    for i in range(2):
+      httpd = frontend.GRRPreforkedHTTPServer(
+          listening_socket,
+          frontend.GRRHTTPServerHandler,
+          max_threads=2,
+          threadpool_prefix="%s_%d" % (self._testMethodName, i))
+      thread = threading.Thread(target=httpd.serve_forever)
+      thread.daemon = True
+      thread.start()
+      self.servers.append(httpd)
+
+  def tearDown(self):
+    for httpd in self.servers:
+      if httpd.request_pool.started:
+        httpd.shutdown()
+        httpd.Drain()
+
+    super(GRRPreforkedHTTPServerTest, self).tearDown()
+
+  def testServesRequestsFromSharedSocket(self):
+    for _ in range(10):
+      req = requests.get(self.base_url + "server.pem")
+      self.assertEqual(req.status_code, 200)
+      self.assertTrue("BEGIN CERTIFICATE" in req.content)
+
+  def testDrainFinishesRequestsInFlight(self):
+    started = threading.Event()
+    release = threading.Event()
+    server_pem = frontend.GRRHTTPServerHandler.ServerPem
+
+    def BlockingServerPem(handler):
+      started.set()
+      release.wait()
+      server_pem(handler)
+
+    responses = []
+
+    def Get():
+      responses.append(requests.get(self.base_url + "server.pem"))
+
+    with utils.Stubber(frontend.GRRHTTPServerHandler, "ServerPem",
+                       BlockingServerPem):
+      request_thread = threading.Thread(target=Get)
+      request_thread.start()
+      started.wait(10)
+
+      # Stop accepting new connections while the request is still running.
+      for httpd in self.servers:
+        httpd.shutdown()
+
+      release.set()
+      for httpd in self.servers:
+        httpd.Drain()
+
+      request_thread.join(10)
+
+    self.assertEqual(len(responses), 1)
+    self.assertEqual(responses[0].status_code, 200)
+
+
+class MonitoringPortForProcessTest(test_lib.GRRBaseTest):
+  """Test the monitoring ports of preforked frontend processes."""
+
+  def testMonitoringDisabled(self):
+    with test_lib.ConfigOverrider({"Monitoring.http_port": 0}):
+      self.assertEqual(frontend.MonitoringPortForProcess(3), 0)
+
+  def testOnePortPerProcess(self):
+    with test_lib.ConfigOverrider({
+        "Monitoring.http_port": 44451,
+        "AdminUI.port": 8000,
+        "AdminUI.port_max": None
+    }):
+      self.assertEqual(
+          [frontend.MonitoringPortForProcess(i) for i in range(3)],
+          [44451, 44452, 44453])
+
+  def testPortRangePerProcess(self):
+    with test_lib.ConfigOverrider({
+        "Monitoring.http_port": 44451,
+        "AdminUI.port": 8000,
+        "AdminUI.port_max": 8002
+    }):
+      self.assertEqual(
+          [frontend.MonitoringPortForProcess(i) for i in range(3)],
+          [44451, 44454, 44457])
+
 
 def main(args):
   test_lib.main(args)
@@ -218,6 +218,9 @@ class ShardedQueueManager(queue_manager.QueueManager):
   def GetNotificationsByPriority(self, queue):
     return self.GetNotificationsByPriorityForAllShards(queue)
 
+  def GetNotificationsByPriorityForShards(self, queue, unused_queue_shards):
+    return self.GetNotificationsByPriorityForAllShards(queue)
+
   def GetNotifications(self, queue):
     return self.GetNotificationsForAllShards(queue)
 
@@ -304,6 +307,40 @@ class GrrWorkerTest(flow_test_lib.FlowTestsBaseclass):
         flow_obj.context.state == rdf_flows.FlowContext.State.TERMINATED)
     self.assertEqual(flow_obj.context.current_state, "End")
 
+  def testPriorityClasses(self):
+    # Other tests might have left a pool behind, so we create a new one.
+    with utils.Stubber(worker.GRRWorker, "thread_pool", None):
+      worker_obj = worker.GRRWorker(
+          threadpool_prefix="priority-classes-test", token=self.token)
+      thread_pool = worker_obj.thread_pool
+    thread_pool.Stop()
+
+    priority = rdf_flows.GrrMessage.Priority
+
+    client_flow = self.client_id.Add("flows").Add("F:123456")
+    hunt_flow = self.client_id.Add("flows").Add("H:123456")
+    hunt = rdfvalue.RDFURN("aff4:/hunts/H:123456")
+    well_known_flow = rdfvalue.RDFURN("aff4:/flows/W:TransferStore")
+
+    for session_id, notification_priority, expected in [
+        (client_flow, priority.MEDIUM_PRIORITY, ("flow", self.client_id)),
+        (client_flow, priority.HIGH_PRIORITY,
+         ("high_priority", self.client_id)),
+        (client_flow, priority.LOW_PRIORITY, ("low_priority", self.client_id)),
+        (hunt_flow, priority.HIGH_PRIORITY, ("hunt", self.client_id)),
+        (hunt, priority.MEDIUM_PRIORITY, ("hunt", str(hunt))),
+        (well_known_flow, priority.MEDIUM_PRIORITY,
+         ("flow", str(well_known_flow))),
+    ]:
+      notification = rdf_flows.GrrNotification(
+          session_id=session_id, priority=notification_priority)
+      priority_class, owner = worker_obj._GetPriorityClass(notification)
+      self.assertEqual((priority_class, owner), expected)
+
+    self.assertEqual(
+        sorted(thread_pool.class_weights),
+        ["flow", "high_priority", "hunt", "low_priority"])
+
   def testNoNotificationRescheduling(self):
     """Test that no notifications are rescheduled when a flow raises."""
 